@@ -0,0 +1,768 @@
+import struct
+import time
+
+from .CANopenEMCY import CANopenEMCY, CANopenErrorHistory
+from .CANopenLSS import CANopenLSS
+from .CANopenMessage import CANopenMessage
+from .CANopenNMT import CANopenNMT
+from .CANopenPDO import CANopenBusLoad
+from .CANopenSDO import CANopenSDO
+from .CANopenSync import CANopenTimingStats, decode_time_of_day
+
+# Flag of error frames in the identifiers yielded by the readers, as in SocketCAN
+CAN_ERR_FLAG = 0x20000000
+
+
+class CANopenAnalyzedTransfer:
+    """An SDO transfer reassembled by CANopenAnalyzer from the frames of both sides."""
+
+    EXPEDITED_DOWNLOAD = 0
+    EXPEDITED_UPLOAD = 1
+    DOWNLOAD = 2
+    UPLOAD = 3
+    BLOCK_DOWNLOAD = 4
+    BLOCK_UPLOAD = 5
+    KIND_NAMES = ("download", "upload", "segmented download", "segmented upload", "block download", "block upload")
+
+    def __init__(self, node_id, kind, index, subindex, start_ns, size=None):
+        self.node_id = node_id
+        self.kind = kind
+        self.index = index
+        self.subindex = subindex
+        self.size = size  # Size indicated by the initiate frame, if any
+        self.start_ns = start_ns
+        self.end_ns = None
+        self.request_ns = start_ns  # Time of the last initiate request
+        # First bytes of the value, up to the analyzer's max_payload; length counts all of them
+        self.data = bytearray()
+        self.length = 0
+        self.toggle = 0
+        self.last = False  # The last segment was seen
+        # Block transfers: segments expected per sub-block, sequence number and length at the sub-block start
+        self.block_size = 0
+        self.sequence = 0
+        self.subblock_length = 0
+        self.in_subblock = False
+
+    @property
+    def name(self):
+        return self.KIND_NAMES[self.kind]
+
+    @property
+    def duration_ns(self):
+        return None if self.end_ns is None else self.end_ns - self.start_ns
+
+    def add(self, chunk, max_payload):
+        self.length += len(chunk)
+        room = max_payload - len(self.data)
+        if room > 0:
+            self.data += chunk[:room]
+
+    def truncate(self, length):
+        """Drop the bytes after length, e.g. the unused bytes of the last block segment."""
+        if length < self.length:
+            self.length = max(0, length)
+            del self.data[self.length:]
+
+
+class CANopenAnalyzer:
+    """
+    Decoder and statistics of the CANopen traffic on a bus.
+
+    Every frame is passed to process() with its receive time. The analyzer decodes NMT,
+    SYNC, TIME, EMCY, PDO, SDO (reassembling expedited, segmented and block transfers of
+    both directions), heartbeat and LSS frames, and keeps rolling aggregates whose memory
+    does not grow with the traffic: frames per node and COB-ID, per-node frame rates and
+    the bus load over the last window seconds, EMCY, SDO abort and protocol error counts,
+    the recent errors, and SDO round-trip latency percentiles.
+
+    Frames are only turned into text if on_decode is set, so the aggregation alone keeps
+    up with a saturated bus.
+    """
+
+    NMT_COMMAND_NAMES = {
+        CANopenNMT.CMD_START_REMOTE_NODE: "start",
+        CANopenNMT.CMD_STOP_REMOTE_NODE: "stop",
+        CANopenNMT.CMD_ENTER_PRE_OPERATIONAL: "enter pre-operational",
+        CANopenNMT.CMD_RESET_NODE: "reset node",
+        CANopenNMT.CMD_RESET_COMMUNICATION: "reset communication",
+    }
+    NMT_STATE_NAMES = {
+        CANopenNMT.STATE_INITIALIZING: "boot-up",
+        CANopenNMT.STATE_STOPPED: "stopped",
+        CANopenNMT.STATE_OPERATIONAL: "operational",
+        CANopenNMT.STATE_PRE_OPERATIONAL: "pre-operational",
+    }
+    # SDO abort codes of CiA 301
+    ABORT_NAMES = {
+        0x05030000: "Toggle bit not alternated",
+        0x05040000: "SDO protocol timed out",
+        0x05040001: "Command specifier not valid or unknown",
+        0x05040002: "Invalid block size",
+        0x05040003: "Invalid sequence number",
+        0x05040004: "CRC error",
+        0x05040005: "Out of memory",
+        0x06010000: "Unsupported access to an object",
+        0x06010001: "Attempt to read a write only object",
+        0x06010002: "Attempt to write a read only object",
+        0x06020000: "Object does not exist in the object dictionary",
+        0x06040041: "Object cannot be mapped to the PDO",
+        0x06040042: "Mapped objects would exceed the PDO length",
+        0x06040043: "General parameter incompatibility",
+        0x06040047: "General internal incompatibility in the device",
+        0x06060000: "Access failed due to a hardware error",
+        0x06070010: "Data type or length does not match",
+        0x06070012: "Data type does not match, length too high",
+        0x06070013: "Data type does not match, length too low",
+        0x06090011: "Sub-index does not exist",
+        0x06090030: "Invalid value for parameter",
+        0x06090031: "Value of parameter written too high",
+        0x06090032: "Value of parameter written too low",
+        0x06090036: "Maximum value is less than minimum value",
+        0x060A0023: "Resource not available: SDO connection",
+        0x08000000: "General error",
+        0x08000020: "Data cannot be transferred or stored to the application",
+        0x08000021: "Data cannot be transferred or stored because of local control",
+        0x08000022: "Data cannot be transferred or stored in the present device state",
+        0x08000023: "No object dictionary present",
+        0x08000024: "No data available",
+    }
+    PDO_NAMES = {0x180: "TPDO1", 0x200: "RPDO1", 0x280: "TPDO2", 0x300: "RPDO2",
+                 0x380: "TPDO3", 0x400: "RPDO3", 0x480: "TPDO4", 0x500: "RPDO4"}
+    # Distinct abort codes counted individually, the others are counted together under None
+    MAX_ABORT_CODES = 64
+    # Initiate requests to one node awaiting their responses, e.g. of a pipelining master
+    MAX_PIPELINED = 16
+    # Bits of classic frames of every payload length, with worst case bit stuffing
+    FRAME_BITS = tuple(CANopenBusLoad.frame_bits(length) for length in range(9))
+
+    def __init__(self, window=10, latency_window=1024, max_payload=64, history_size=32, bitrate=1000000,
+                 on_decode=None, on_transfer=None):
+        """
+        :param window: Length in seconds of the rolling frame rates and bus load.
+        :param latency_window: SDO round trips kept for the latency percentiles.
+        :param max_payload: Bytes of every SDO transfer kept for display.
+        :param history_size: Number of recent errors kept.
+        :param bitrate: Bit rate of the bus in bit/s, for the bus load.
+        :param on_decode: Optional callable(timestamp_ns, cob_id, data, text) called for every frame.
+        :param on_transfer: Optional callable(CANopenAnalyzedTransfer) called for every completed SDO transfer.
+        """
+        self.window = window
+        self.latency_window = latency_window
+        self.max_payload = max_payload
+        self.bitrate = bitrate
+        self.on_decode = on_decode
+        self.on_transfer = on_transfer
+        self.frames = 0
+        self.other_frames = 0  # Extended frames, which CANopen doesn't use
+        self.error_frames = 0  # Error frames reported by the interface
+        self.first_ns = None
+        self.last_ns = None
+        # Totals per node ID and per 11 bit COB-ID
+        self.node_frames = [0] * 128
+        self.cob_id_frames = [0] * 2048
+        self.emcy_counts = [0] * 128
+        self.sdo_transfers = [0] * 128
+        self.sdo_aborts = [0] * 128
+        self.protocol_errors = [0] * 128
+        self.boot_ups = [0] * 128
+        # Last NMT state reported by the heartbeat of every node, and when
+        self.nmt_states = [None] * 128
+        self.heartbeat_ns = [None] * 128
+        # abort code -> count
+        self.abort_codes = {}
+        # SDO request to response time, of all nodes and per node
+        self.sdo_latency = CANopenTimingStats(latency_window)
+        self.node_sdo_latency = {}
+        # (timestamp_ns, node_id, text) of the recent EMCYs, aborts and protocol errors
+        self.errors = CANopenErrorHistory(history_size)
+        # One slot per second of frames per node and bits on the bus
+        self._rate_slots = [[0] * 128 for _ in range(window)]
+        self._bit_slots = [0] * window
+        self._slot = 0
+        self._second = None
+        # node_id -> segmented or block CANopenAnalyzedTransfer in progress, and time of the last SDO request
+        self._transfers = [None] * 128
+        # node_id -> dict of (index, subindex) -> CANopenAnalyzedTransfer whose initiate request is unanswered
+        self._initiated = [None] * 128
+        self._request_ns = [None] * 128
+        # Handler of every function code (COB-ID bits 7-10)
+        self._handlers = (self._nmt, self._sync_emcy, self._time, self._pdo, self._pdo, self._pdo, self._pdo,
+                          self._pdo, self._pdo, self._pdo, self._pdo, self._sdo_response, self._sdo_request,
+                          self._unknown, self._heartbeat, self._lss)
+
+    def process(self, cob_id, data, timestamp_ns):
+        """
+        Analyse a frame.
+
+        :param cob_id: CAN identifier; CAN_ERR_FLAG marks an error frame.
+        :param data: The payload.
+        :param timestamp_ns: Receive time in ns, from any clock.
+        """
+        self.frames += 1
+        if self.first_ns is None:
+            self.first_ns = self.last_ns = timestamp_ns
+        elif timestamp_ns > self.last_ns:
+            self.last_ns = timestamp_ns
+        second = timestamp_ns // 1000000000
+        if second != self._second:
+            self._advance(second)
+        length = len(data)
+        self._bit_slots[self._slot] += self.FRAME_BITS[length] if length <= 8 else CANopenBusLoad.fd_frame_bits(length)
+        if cob_id > 0x7FF:
+            if cob_id & CAN_ERR_FLAG:
+                self.error_frames += 1
+                self.errors.append((timestamp_ns, None, f"CAN error frame 0x{cob_id & ~CAN_ERR_FLAG:08X}"))
+            else:
+                self.other_frames += 1
+            if self.on_decode is not None:
+                self.on_decode(timestamp_ns, cob_id, data, "error frame" if cob_id & CAN_ERR_FLAG else "extended frame")
+            return
+        self.cob_id_frames[cob_id] += 1
+        node_id = cob_id & 0x7F
+        if node_id:
+            self.node_frames[node_id] += 1
+            self._rate_slots[self._slot][node_id] += 1
+        self._handlers[cob_id >> 7](cob_id, node_id, data, timestamp_ns)
+
+    def process_message(self, message):
+        """Analyse a received CANopenMessage or MCP2515 Message, using its receive timestamp if it has one."""
+        timestamp_ns = getattr(message, "timestamp_ns", None)
+        self.process(message.id, message.data, time.monotonic_ns() if timestamp_ns is None else timestamp_ns)
+
+    def _advance(self, second):
+        if self._second is not None:
+            if second < self._second:
+                # Out of order frames are counted in the current second
+                return
+            for _ in range(min(second - self._second, self.window)):
+                self._slot = (self._slot + 1) % self.window
+                self._rate_slots[self._slot] = [0] * 128
+                self._bit_slots[self._slot] = 0
+        self._second = second
+
+    def _decoded(self, timestamp_ns, cob_id, data, text):
+        if self.on_decode is not None:
+            self.on_decode(timestamp_ns, cob_id, data, text)
+
+    def _error(self, timestamp_ns, node_id, text):
+        self.errors.append((timestamp_ns, node_id, text))
+
+    def _nmt(self, cob_id, node_id, data, timestamp_ns):
+        if self.on_decode is None:
+            return
+        if cob_id != CANopenMessage.COB_ID_NMT or len(data) < 2:
+            return self._unknown(cob_id, node_id, data, timestamp_ns)
+        command = self.NMT_COMMAND_NAMES.get(data[0], f"command 0x{data[0]:02X}")
+        target = f"node {data[1]}" if data[1] else "all nodes"
+        self.on_decode(timestamp_ns, cob_id, data, f"NMT {command} {target}")
+
+    def _sync_emcy(self, cob_id, node_id, data, timestamp_ns):
+        if node_id == 0:
+            if self.on_decode is not None:
+                self.on_decode(timestamp_ns, cob_id, data, f"SYNC counter {data[0]}" if data else "SYNC")
+            return
+        self.emcy_counts[node_id] += 1
+        if len(data) < 3:
+            self.protocol_errors[node_id] += 1
+            return self._error(timestamp_ns, node_id, "EMCY shorter than 3 bytes")
+        error_code, error_register, manufacturer = CANopenEMCY.unpack(data)
+        if error_code == CANopenEMCY.ERR_RESET:
+            text = f"EMCY node {node_id} error reset, register 0x{error_register:02X}"
+        else:
+            text = f"EMCY node {node_id} error 0x{error_code:04X}, register 0x{error_register:02X}, " \
+                   f"data {manufacturer.hex(' ')}"
+            self._error(timestamp_ns, node_id, text)
+        self._decoded(timestamp_ns, cob_id, data, text)
+
+    def _time(self, cob_id, node_id, data, timestamp_ns):
+        if self.on_decode is None:
+            return
+        if node_id or len(data) < 6:
+            return self._unknown(cob_id, node_id, data, timestamp_ns)
+        seconds = decode_time_of_day(data)
+        text = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(seconds)) + f".{int(seconds * 1000) % 1000:03d} UTC"
+        self.on_decode(timestamp_ns, cob_id, data, f"TIME {text}")
+
+    def _pdo(self, cob_id, node_id, data, timestamp_ns):
+        if self.on_decode is not None:
+            self.on_decode(timestamp_ns, cob_id, data, f"{self.PDO_NAMES[cob_id & 0x780]} node {node_id}")
+
+    def _heartbeat(self, cob_id, node_id, data, timestamp_ns):
+        if not data:
+            return self._decoded(timestamp_ns, cob_id, data, f"Node guarding request node {node_id}")
+        state = data[0] & 0x7F
+        previous = self.nmt_states[node_id]
+        self.nmt_states[node_id] = state
+        self.heartbeat_ns[node_id] = timestamp_ns
+        if state == CANopenNMT.STATE_INITIALIZING:
+            self.boot_ups[node_id] += 1
+            if previous == CANopenNMT.STATE_OPERATIONAL:
+                self._error(timestamp_ns, node_id, f"Node {node_id} rebooted while operational")
+        if self.on_decode is None:
+            return
+        name = self.NMT_STATE_NAMES.get(state, f"state 0x{state:02X}")
+        if state == CANopenNMT.STATE_INITIALIZING:
+            text = f"Boot-up node {node_id}"
+        elif previous is not None and previous != state:
+            text = f"Heartbeat node {node_id} {name} (was {self.NMT_STATE_NAMES.get(previous, hex(previous))})"
+        else:
+            text = f"Heartbeat node {node_id} {name}"
+        self.on_decode(timestamp_ns, cob_id, data, text)
+
+    def _lss(self, cob_id, node_id, data, timestamp_ns):
+        if cob_id == CANopenLSS.COB_ID_LSS_MASTER:
+            text = "LSS master"
+        elif cob_id == CANopenLSS.COB_ID_LSS_SLAVE:
+            text = "LSS slave"
+        else:
+            return self._unknown(cob_id, node_id, data, timestamp_ns)
+        self._decoded(timestamp_ns, cob_id, data, f"{text} command 0x{data[0]:02X}" if data else text)
+
+    def _unknown(self, cob_id, node_id, data, timestamp_ns):
+        self._decoded(timestamp_ns, cob_id, data, "")
+
+    def _sdo_request(self, cob_id, node_id, data, timestamp_ns):
+        """Follow a frame of the SDO client (0x600 + node ID)."""
+        self._request_ns[node_id] = timestamp_ns
+        if len(data) > 8:
+            return self._decoded(timestamp_ns, cob_id, data, f"USDO request node {node_id}")
+        if len(data) < 8:
+            # CiA 301 SDO frames always carry 8 bytes; shorter ones are not decoded any further
+            return self._protocol_error(timestamp_ns, node_id, f"SDO request of {len(data)} bytes")
+        command = data[0]
+        transfer = self._transfers[node_id]
+        if transfer is not None and transfer.kind == transfer.BLOCK_DOWNLOAD and transfer.in_subblock:
+            return self._block_segment(transfer, cob_id, data, timestamp_ns, "client")
+        specifier = command & 0xE0
+        text = None
+        if specifier == CANopenSDO.SDO_DOWNLOAD_INITIATE:
+            index, subindex = self._multiplexer(data)
+            if command & CANopenSDO.SDO_EXPEDITED:
+                transfer = CANopenAnalyzedTransfer(node_id, CANopenAnalyzedTransfer.EXPEDITED_DOWNLOAD, index,
+                                                   subindex, timestamp_ns)
+                size = 4 - ((command >> 2) & 0x03) if command & CANopenSDO.SDO_SIZE_INDICATED else 4
+                transfer.add(bytes(data[4:4 + size]), self.max_payload)
+            else:
+                size = struct.unpack_from("<I", data, 4)[0] if command & CANopenSDO.SDO_SIZE_INDICATED else None
+                transfer = CANopenAnalyzedTransfer(node_id, CANopenAnalyzedTransfer.DOWNLOAD, index, subindex,
+                                                   timestamp_ns, size)
+            self._initiate(transfer, timestamp_ns)
+        elif specifier == CANopenSDO.SDO_UPLOAD_INITIATE:
+            index, subindex = self._multiplexer(data)
+            transfer = CANopenAnalyzedTransfer(node_id, CANopenAnalyzedTransfer.EXPEDITED_UPLOAD, index, subindex,
+                                               timestamp_ns)
+            self._initiate(transfer, timestamp_ns)
+        elif specifier == CANopenSDO.SDO_BLOCK_DOWNLOAD and not command & CANopenSDO.SDO_BLOCK_END:
+            index, subindex = self._multiplexer(data)
+            size = struct.unpack_from("<I", data, 4)[0] if command & CANopenSDO.SDO_BLOCK_SIZE_INDICATED else None
+            transfer = CANopenAnalyzedTransfer(node_id, CANopenAnalyzedTransfer.BLOCK_DOWNLOAD, index, subindex,
+                                               timestamp_ns, size)
+            self._initiate(transfer, timestamp_ns)
+        elif specifier == CANopenSDO.SDO_BLOCK_DOWNLOAD_RESPONSE and command & 0x03 == 0:
+            # Block upload initiate; the client commands of block uploads share this specifier
+            index, subindex = self._multiplexer(data)
+            transfer = CANopenAnalyzedTransfer(node_id, CANopenAnalyzedTransfer.BLOCK_UPLOAD, index, subindex,
+                                               timestamp_ns)
+            transfer.block_size = data[4] if len(data) > 4 else 0
+            self._initiate(transfer, timestamp_ns)
+        elif specifier == CANopenSDO.SDO_ABORT:
+            return self._abort(cob_id, node_id, data, timestamp_ns, "client")
+        elif transfer is None:
+            return self._protocol_error(timestamp_ns, node_id, f"SDO request 0x{command:02X} without transfer")
+        elif specifier == CANopenSDO.SDO_DOWNLOAD_SEGMENT and transfer.kind == transfer.DOWNLOAD:
+            if command & CANopenSDO.SDO_TOGGLE != transfer.toggle:
+                self._protocol_error(timestamp_ns, node_id, "SDO download segment toggle bit not alternated")
+            transfer.add(bytes(data[1:8 - ((command >> 1) & 0x07)]), self.max_payload)
+            transfer.last = bool(command & CANopenSDO.SDO_NO_MORE_SEGMENTS)
+            text = f"segment, {transfer.length} bytes" + (", last" if transfer.last else "")
+        elif specifier == CANopenSDO.SDO_UPLOAD_SEGMENT and transfer.kind == transfer.UPLOAD:
+            if command & CANopenSDO.SDO_TOGGLE != transfer.toggle:
+                self._protocol_error(timestamp_ns, node_id, "SDO upload segment request toggle bit not alternated")
+            text = "segment request"
+        elif specifier == CANopenSDO.SDO_BLOCK_DOWNLOAD and transfer.kind == transfer.BLOCK_DOWNLOAD:
+            transfer.truncate(transfer.length - ((command >> 2) & 0x07))
+            text = "block download end"
+        elif specifier == CANopenSDO.SDO_BLOCK_DOWNLOAD_RESPONSE and transfer.kind == transfer.BLOCK_UPLOAD:
+            subcommand = command & 0x03
+            if subcommand == 3:
+                self._start_subblock(transfer)
+                text = "block upload start"
+            elif subcommand == CANopenSDO.SDO_BLOCK_ACK:
+                self._block_ack(transfer, data)
+                if not transfer.last:
+                    self._start_subblock(transfer)
+                text = f"block ack sequence {data[1]}, block size {data[2]}"
+            else:
+                return self._complete(transfer, cob_id, data, timestamp_ns)
+        else:
+            return self._protocol_error(timestamp_ns, node_id, f"unexpected SDO request 0x{command:02X} "
+                                                               f"during {transfer.name}")
+        if self.on_decode is not None:
+            self.on_decode(timestamp_ns, cob_id, data, self._sdo_text(transfer, "client", text))
+
+    def _sdo_response(self, cob_id, node_id, data, timestamp_ns):
+        """Follow a frame of the SDO server (0x580 + node ID)."""
+        if len(data) > 8:
+            return self._decoded(timestamp_ns, cob_id, data, f"USDO response node {node_id}")
+        if len(data) < 8:
+            return self._protocol_error(timestamp_ns, node_id, f"SDO response of {len(data)} bytes")
+        command = data[0]
+        transfer = self._transfers[node_id]
+        if transfer is not None and transfer.kind == transfer.BLOCK_UPLOAD and transfer.in_subblock:
+            return self._block_segment(transfer, cob_id, data, timestamp_ns, "server")
+        specifier = command & 0xE0
+        if specifier == CANopenSDO.SDO_ABORT:
+            self._measure(node_id, timestamp_ns)
+            return self._abort(cob_id, node_id, data, timestamp_ns, "server")
+        text = None
+        if (specifier in (CANopenSDO.SDO_DOWNLOAD_RESPONSE, CANopenSDO.SDO_UPLOAD_RESPONSE)
+                or (specifier == CANopenSDO.SDO_BLOCK_DOWNLOAD_RESPONSE and command & 0x03 == 0)
+                or (specifier == CANopenSDO.SDO_BLOCK_DOWNLOAD and not command & CANopenSDO.SDO_BLOCK_END)):
+            # Responses to initiate requests, which may be pipelined and are matched by index and subindex
+            pending = self._initiated[node_id]
+            transfer = pending.pop(self._multiplexer(data), None) if pending else None
+            if transfer is None:
+                return self._protocol_error(timestamp_ns, node_id, f"SDO response 0x{command:02X} without request")
+            self._latency(node_id, timestamp_ns - transfer.request_ns)
+            if specifier == CANopenSDO.SDO_DOWNLOAD_RESPONSE and transfer.kind == transfer.EXPEDITED_DOWNLOAD:
+                return self._complete(transfer, cob_id, data, timestamp_ns)
+            if specifier == CANopenSDO.SDO_UPLOAD_RESPONSE and transfer.kind == transfer.EXPEDITED_UPLOAD:
+                if command & CANopenSDO.SDO_EXPEDITED:
+                    size = 4 - ((command >> 2) & 0x03) if command & CANopenSDO.SDO_SIZE_INDICATED else 4
+                    transfer.add(bytes(data[4:4 + size]), self.max_payload)
+                    return self._complete(transfer, cob_id, data, timestamp_ns)
+                transfer.kind = transfer.UPLOAD
+                if command & CANopenSDO.SDO_SIZE_INDICATED:
+                    transfer.size = struct.unpack_from("<I", data, 4)[0]
+                text = "upload initiated" + ("" if transfer.size is None else f", {transfer.size} bytes")
+            elif specifier == CANopenSDO.SDO_DOWNLOAD_RESPONSE and transfer.kind == transfer.DOWNLOAD:
+                text = "download initiated"
+            elif specifier == CANopenSDO.SDO_BLOCK_DOWNLOAD_RESPONSE and transfer.kind == transfer.BLOCK_DOWNLOAD:
+                transfer.block_size = data[4]
+                self._start_subblock(transfer)
+                text = f"block download initiated, block size {data[4]}"
+            elif specifier == CANopenSDO.SDO_BLOCK_DOWNLOAD and transfer.kind == transfer.BLOCK_UPLOAD:
+                # Block upload initiate response; the server commands of block uploads share this specifier
+                if command & CANopenSDO.SDO_BLOCK_SIZE_INDICATED:
+                    transfer.size = struct.unpack_from("<I", data, 4)[0]
+                text = "block upload initiated" + ("" if transfer.size is None else f", {transfer.size} bytes")
+            else:
+                return self._protocol_error(timestamp_ns, node_id, f"SDO response 0x{command:02X} does not match "
+                                                                   f"the {transfer.name} request")
+            self._begin(transfer, timestamp_ns)
+        else:
+            self._measure(node_id, timestamp_ns)
+            if transfer is None:
+                return self._protocol_error(timestamp_ns, node_id, f"SDO response 0x{command:02X} without transfer")
+            if specifier == 0x20 and transfer.kind == transfer.DOWNLOAD:
+                # Download segment response
+                if command & CANopenSDO.SDO_TOGGLE != transfer.toggle:
+                    self._protocol_error(timestamp_ns, node_id, "SDO download segment toggle bit not alternated")
+                transfer.toggle ^= CANopenSDO.SDO_TOGGLE
+                if transfer.last:
+                    return self._complete(transfer, cob_id, data, timestamp_ns)
+                text = "segment acknowledged"
+            elif specifier == CANopenSDO.SDO_DOWNLOAD_SEGMENT and transfer.kind == transfer.UPLOAD:
+                # Upload segment response
+                if command & CANopenSDO.SDO_TOGGLE != transfer.toggle:
+                    self._protocol_error(timestamp_ns, node_id, "SDO upload segment toggle bit not alternated")
+                transfer.toggle ^= CANopenSDO.SDO_TOGGLE
+                transfer.add(bytes(data[1:8 - ((command >> 1) & 0x07)]), self.max_payload)
+                if command & CANopenSDO.SDO_NO_MORE_SEGMENTS:
+                    return self._complete(transfer, cob_id, data, timestamp_ns)
+                text = f"segment, {transfer.length} bytes"
+            elif specifier == CANopenSDO.SDO_BLOCK_DOWNLOAD_RESPONSE and transfer.kind == transfer.BLOCK_DOWNLOAD:
+                if command & 0x03 == CANopenSDO.SDO_BLOCK_ACK:
+                    self._block_ack(transfer, data)
+                    if not transfer.last:
+                        self._start_subblock(transfer)
+                    text = f"block ack sequence {data[1]}, block size {data[2]}"
+                else:
+                    return self._complete(transfer, cob_id, data, timestamp_ns)
+            elif specifier == CANopenSDO.SDO_BLOCK_DOWNLOAD and transfer.kind == transfer.BLOCK_UPLOAD:
+                transfer.truncate(transfer.length - ((command >> 2) & 0x07))
+                text = "block upload end"
+            else:
+                return self._protocol_error(timestamp_ns, node_id, f"unexpected SDO response 0x{command:02X} "
+                                                                   f"during {transfer.name}")
+        if self.on_decode is not None:
+            self.on_decode(timestamp_ns, cob_id, data, self._sdo_text(transfer, "server", text))
+
+    @staticmethod
+    def _multiplexer(data):
+        return tuple(struct.unpack_from("<HB", data, 1)) if len(data) >= 4 else (0, 0)
+
+    def _initiate(self, transfer, timestamp_ns):
+        """Record an initiate request until its response arrives; a repeated request replaces the first one."""
+        node_id = transfer.node_id
+        transfer.request_ns = timestamp_ns
+        pending = self._initiated[node_id]
+        if pending is None:
+            pending = self._initiated[node_id] = {}
+        key = (transfer.index, transfer.subindex)
+        if key not in pending and len(pending) >= self.MAX_PIPELINED:
+            del pending[next(iter(pending))]
+            self._protocol_error(timestamp_ns, node_id, f"more than {self.MAX_PIPELINED} SDO requests outstanding")
+        pending[key] = transfer
+
+    def _begin(self, transfer, timestamp_ns):
+        """Make a segmented or block transfer the one the segments of its node belong to."""
+        node_id = transfer.node_id
+        current = self._transfers[node_id]
+        if current is not None:
+            self._protocol_error(timestamp_ns, node_id, f"SDO {current.name} of 0x{current.index:04X}:"
+                                                        f"{current.subindex} interrupted by a new transfer")
+        self._transfers[node_id] = transfer
+
+    def _measure(self, node_id, timestamp_ns):
+        """Record the round trip from the last request of a node to a response within a transfer."""
+        request_ns = self._request_ns[node_id]
+        if request_ns is not None:
+            self._request_ns[node_id] = None
+            self._latency(node_id, timestamp_ns - request_ns)
+
+    @staticmethod
+    def _start_subblock(transfer):
+        transfer.in_subblock = True
+        transfer.sequence = 0
+        transfer.subblock_length = transfer.length
+
+    def _block_segment(self, transfer, cob_id, data, timestamp_ns, side):
+        sequence = data[0] & 0x7F
+        if sequence != transfer.sequence + 1:
+            self._protocol_error(timestamp_ns, transfer.node_id, f"SDO block segment {sequence} out of sequence")
+        transfer.sequence = sequence
+        transfer.add(bytes(data[1:8]), self.max_payload)
+        if data[0] & CANopenSDO.SDO_BLOCK_LAST_SEGMENT:
+            transfer.last = True
+        if transfer.last or sequence >= transfer.block_size:
+            transfer.in_subblock = False
+        if self.on_decode is not None:
+            self.on_decode(timestamp_ns, cob_id, data, self._sdo_text(transfer, side, f"block segment {sequence}"
+                                                                      + (", last" if transfer.last else "")))
+
+    @staticmethod
+    def _block_ack(transfer, data):
+        """Drop the segments after the last one acknowledged, which are sent again."""
+        if data[1] < transfer.sequence:
+            transfer.truncate(transfer.subblock_length + data[1] * CANopenSDO.SDO_BLOCK_SEGMENT_SIZE)
+            transfer.last = False
+        transfer.block_size = data[2]
+
+    def _complete(self, transfer, cob_id, data, timestamp_ns):
+        node_id = transfer.node_id
+        if self._transfers[node_id] is transfer:
+            self._transfers[node_id] = None
+        transfer.end_ns = timestamp_ns
+        self.sdo_transfers[node_id] += 1
+        if transfer.size is not None and transfer.size != transfer.length:
+            self._protocol_error(timestamp_ns, node_id, f"SDO {transfer.name} of 0x{transfer.index:04X}:"
+                                                        f"{transfer.subindex} indicated {transfer.size} bytes "
+                                                        f"but carried {transfer.length}")
+        if self.on_transfer is not None:
+            self.on_transfer(transfer)
+        if self.on_decode is not None:
+            shown = transfer.data.hex(" ") + (" ..." if transfer.length > len(transfer.data) else "")
+            self.on_decode(timestamp_ns, cob_id, data, f"SDO node {node_id} {transfer.name} 0x{transfer.index:04X}:"
+                                                       f"{transfer.subindex} done, {transfer.length} bytes in "
+                                                       f"{transfer.duration_ns / 1e6:.3f} ms: {shown}")
+
+    def _abort(self, cob_id, node_id, data, timestamp_ns, side):
+        abort_code = struct.unpack_from("<I", data, 4)[0] if len(data) >= 8 else 0
+        index, subindex = self._multiplexer(data)
+        pending = self._initiated[node_id]
+        if pending:
+            pending.pop((index, subindex), None)
+        current = self._transfers[node_id]
+        if current is not None and (current.index, current.subindex) == (index, subindex):
+            self._transfers[node_id] = None
+        self.sdo_aborts[node_id] += 1
+        key = abort_code if abort_code in self.abort_codes or len(self.abort_codes) < self.MAX_ABORT_CODES else None
+        self.abort_codes[key] = self.abort_codes.get(key, 0) + 1
+        text = f"SDO node {node_id} {side} abort 0x{index:04X}:{subindex} code 0x{abort_code:08X} " \
+               f"({self.ABORT_NAMES.get(abort_code, 'unknown')})"
+        self._error(timestamp_ns, node_id, text)
+        self._decoded(timestamp_ns, cob_id, data, text)
+
+    def _protocol_error(self, timestamp_ns, node_id, text):
+        self.protocol_errors[node_id] += 1
+        self._error(timestamp_ns, node_id, f"Node {node_id}: {text}")
+        if self.on_decode is not None:
+            self.on_decode(timestamp_ns, None, b"", f"protocol error node {node_id}: {text}")
+
+    @staticmethod
+    def _sdo_text(transfer, side, text):
+        detail = f"{transfer.name} 0x{transfer.index:04X}:{transfer.subindex}" if text is None else text
+        return f"SDO node {transfer.node_id} {side} {detail}"
+
+    def _latency(self, node_id, latency_ns):
+        self.sdo_latency.add(latency_ns)
+        stats = self.node_sdo_latency.get(node_id)
+        if stats is None:
+            stats = self.node_sdo_latency[node_id] = CANopenTimingStats(self.latency_window)
+        stats.add(latency_ns)
+
+    def _window_seconds(self):
+        """Time in seconds covered by the rate slots, from the start of the oldest one or the first frame."""
+        if self._second is None:
+            return 0.0
+        start_ns = max(self.first_ns, (self._second - self.window + 1) * 1000000000)
+        return (self.last_ns - start_ns) / 1e9
+
+    def rate(self, node_id=None):
+        """Return the frames per second of a node, or of the whole bus, over the last window seconds."""
+        seconds = self._window_seconds()
+        if seconds <= 0:
+            return 0.0
+        if node_id is None:
+            return sum(sum(slot) for slot in self._rate_slots) / seconds
+        return sum(slot[node_id] for slot in self._rate_slots) / seconds
+
+    def bus_load(self):
+        """Return the bus load over the last window seconds as a fraction of the bit rate."""
+        seconds = self._window_seconds()
+        return sum(self._bit_slots) / (self.bitrate * seconds) if seconds > 0 else 0.0
+
+    def summary(self):
+        """Return the aggregates as a dict."""
+        nodes = {}
+        for node_id in range(1, 128):
+            if not self.node_frames[node_id]:
+                continue
+            latency = self.node_sdo_latency.get(node_id)
+            state = self.nmt_states[node_id]
+            nodes[node_id] = {
+                "frames": self.node_frames[node_id],
+                "rate": self.rate(node_id),
+                "state": None if state is None else self.NMT_STATE_NAMES.get(state, hex(state)),
+                "boot_ups": self.boot_ups[node_id],
+                "emcy": self.emcy_counts[node_id],
+                "sdo_transfers": self.sdo_transfers[node_id],
+                "sdo_aborts": self.sdo_aborts[node_id],
+                "protocol_errors": self.protocol_errors[node_id],
+                "sdo_latency": None if latency is None else latency.summary(),
+            }
+        return {
+            "frames": self.frames,
+            "duration": 0.0 if self.first_ns is None else (self.last_ns - self.first_ns) / 1e9,
+            "rate": self.rate(),
+            "bus_load": self.bus_load(),
+            "error_frames": self.error_frames,
+            "other_frames": self.other_frames,
+            "sdo_latency": self.sdo_latency.summary(),
+            "abort_codes": dict(self.abort_codes),
+            "nodes": nodes,
+            "errors": list(self.errors),
+        }
+
+    def format_summary(self):
+        """Return the aggregates as a text table."""
+        summary = self.summary()
+        lines = [f"{summary['frames']} frames in {summary['duration']:.3f} s, {summary['rate']:.0f} frames/s, "
+                 f"bus load {summary['bus_load'] * 100:.1f} %, {summary['error_frames']} error frames"]
+        latency = summary["sdo_latency"]
+        if latency["count"]:
+            lines.append(f"SDO latency: {latency['count']} round trips, p50 {self._ms(latency['p50'])}, "
+                         f"p99 {self._ms(latency['p99'])}, max {self._ms(latency['max'])}")
+        lines.append(f"{'node':>4} {'frames':>9} {'rate/s':>8} {'state':<15} {'boot':>4} {'emcy':>5} "
+                     f"{'sdo':>6} {'abort':>5} {'proto':>5} {'sdo p50':>9} {'sdo p99':>9}")
+        for node_id, node in summary["nodes"].items():
+            latency = node["sdo_latency"]
+            lines.append(f"{node_id:>4} {node['frames']:>9} {node['rate']:>8.1f} {node['state'] or '-':<15} "
+                         f"{node['boot_ups']:>4} {node['emcy']:>5} {node['sdo_transfers']:>6} "
+                         f"{node['sdo_aborts']:>5} {node['protocol_errors']:>5} "
+                         f"{self._ms(latency and latency['p50']):>9} {self._ms(latency and latency['p99']):>9}")
+        for abort_code, count in summary["abort_codes"].items():
+            name = "other" if abort_code is None else f"0x{abort_code:08X} {self.ABORT_NAMES.get(abort_code, '')}"
+            lines.append(f"abort {name}: {count}")
+        for timestamp_ns, node_id, text in reversed(summary["errors"]):
+            lines.append(f"error {timestamp_ns / 1e9:.6f} {text}")
+        return "\n".join(lines)
+
+    @staticmethod
+    def _ms(value_ns):
+        return "-" if value_ns is None else f"{value_ns / 1e6:.3f}ms"
+
+
+def format_frame(timestamp_ns, cob_id, data, text):
+    """Format a decoded frame as one line: time, COB-ID, length, data and decoded text."""
+    if cob_id is None:
+        return f"{timestamp_ns / 1e9:17.6f}  {'':>8}  {text}"
+    return f"{timestamp_ns / 1e9:17.6f}  {cob_id:>8X}  [{len(data)}] {bytes(data).hex(' '):<23}  {text}"
+
+
+def read_candump(lines):
+    """
+    Read frames from a candump log (candump -l, "(1436509052.249713) can0 123#DEADBEEF") or from
+    the candump output with timestamps ("(1436509052.249713)  can0  123   [4]  DE AD BE EF").
+    Lines without a timestamp are given the current time.
+
+    :param lines: Iterable of lines, e.g. an open file.
+    :return: Generator of (cob_id, data, timestamp_ns); error frames have CAN_ERR_FLAG set.
+    """
+    for line in lines:
+        fields = line.split()
+        if not fields:
+            continue
+        if fields[0][0] == "(":
+            seconds, _, fraction = fields[0][1:-1].partition(".")
+            timestamp_ns = int(seconds) * 1000000000 + int(fraction[:9].ljust(9, "0"))
+            fields = fields[1:]
+        else:
+            timestamp_ns = time.time_ns()
+        if len(fields) < 2:
+            continue
+        frame = fields[1]
+        try:
+            if "#" in frame:
+                identifier, _, payload = frame.partition("#")
+                if payload[:1] == "#":
+                    # CAN FD frame: "##" and a flags nibble
+                    payload = payload[2:]
+                data = b"" if payload[:1] == "R" else bytes.fromhex(payload)
+            else:
+                identifier = frame
+                data = bytes.fromhex("".join(fields[3:])) if fields[2][:1] == "[" and fields[3:4] != ["remote"] else b""
+            cob_id = int(identifier, 16)
+        except (ValueError, IndexError):
+            continue
+        yield cob_id, data, timestamp_ns
+
+
+def read_socketcan(channel):
+    """
+    Read frames from a Linux SocketCAN interface, including CAN FD and error frames.
+
+    :param channel: Interface name, e.g. "can0".
+    :return: Generator of (cob_id, data, timestamp_ns) with the receive time as time.time_ns();
+        error frames have CAN_ERR_FLAG set.
+    """
+    # Imported here as SocketCAN is only available on Linux hosts
+    import socket
+    sock = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+    try:
+        sock.setsockopt(socket.SOL_CAN_RAW, socket.CAN_RAW_FD_FRAMES, 1)
+    except OSError:
+        pass
+    # CAN_RAW_ERR_FILTER from linux/can/raw.h, which not every Python version exports
+    sock.setsockopt(socket.SOL_CAN_RAW, getattr(socket, "CAN_RAW_ERR_FILTER", 2), socket.CAN_ERR_MASK)
+    sock.bind((channel,))
+    try:
+        while True:
+            frame = sock.recv(72)
+            timestamp_ns = time.time_ns()
+            can_id, length = struct.unpack_from("=IB", frame)
+            if can_id & socket.CAN_RTR_FLAG:
+                data = b""
+            else:
+                data = frame[8:8 + length]
+            if can_id & CAN_ERR_FLAG:
+                cob_id = (can_id & socket.CAN_ERR_MASK) | CAN_ERR_FLAG
+            elif can_id & socket.CAN_EFF_FLAG:
+                cob_id = can_id & socket.CAN_EFF_MASK
+            else:
+                cob_id = can_id & socket.CAN_SFF_MASK
+            yield cob_id, data, timestamp_ns
+    finally:
+        sock.close()
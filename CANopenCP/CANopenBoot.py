@@ -0,0 +1,456 @@
+import struct
+import time
+
+from .CANopenDCF import CANopenDCF
+from .CANopenNMT import CANopenNMT
+from .CANopenSDO import CANopenBlockDownload, CANopenSDO, CANopenSDORequest
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class CANopenBootSlave:
+    """Boot state of one slave of the network list (0x1F81)."""
+
+    # NMT slave assignment (0x1F81) bits
+    ASSIGN_SLAVE = 0x01
+    ASSIGN_BOOT = 0x04
+    ASSIGN_MANDATORY = 0x08
+    ASSIGN_KEEP_ALIVE = 0x10
+    ASSIGN_VERSION_CHECK = 0x20
+
+    # Steps of the boot
+    STEP_BOOT_UP = 0
+    STEP_IDENTITY = 1
+    STEP_VERSION = 2
+    STEP_CONFIGURATION_DATE = 3
+    STEP_CONFIGURE = 4
+    STEP_READY = 5
+    STEP_DONE = 6
+    STEP_NAMES = ("boot-up", "identity", "version", "configuration date", "configure", "ready", "done")
+
+    # Boot error status of CiA 302-2
+    ERROR_NO_RESPONSE = "B"  # No boot-up, or no response to reading the device type
+    ERROR_DEVICE_TYPE = "C"
+    ERROR_VENDOR_ID = "D"
+    ERROR_SOFTWARE_VERSION = "G"
+    ERROR_CONFIGURATION = "J"
+    ERROR_PRODUCT_CODE = "M"
+    ERROR_REVISION = "N"
+    ERROR_SERIAL = "O"
+
+    def __init__(self, node_id, assignment):
+        """
+        :param node_id: Node ID of the slave.
+        :param assignment: Its NMT slave assignment (0x1F81).
+        """
+        self.node_id = node_id
+        self.assignment = assignment
+        self.step = self.STEP_BOOT_UP
+        self.error = None
+        self.abort_code = None
+        # True if the slave was found operational and kept alive instead of being reset
+        self.kept_alive = False
+        # Outstanding SDO requests of the current step, and the block download of the configuration
+        self.requests = []
+        self.transfer = None
+        self.retries_left = 0
+        # time.monotonic() of the reset, and of the boot-up frame the boot started from
+        self.reset_time = None
+        self.boot_up_time = None
+        self.end_time = None
+
+    @property
+    def mandatory(self):
+        return bool(self.assignment & self.ASSIGN_MANDATORY)
+
+    @property
+    def failed(self):
+        return self.error is not None
+
+    @property
+    def busy(self):
+        """True while the slave is between its boot-up and the end of its checks and configuration."""
+        return not self.failed and self.STEP_IDENTITY <= self.step < self.STEP_READY
+
+    def progress(self):
+        """Return a dict describing the state of the boot."""
+        return {
+            "node_id": self.node_id,
+            "mandatory": self.mandatory,
+            "step": self.STEP_NAMES[self.step],
+            "error": self.error,
+            "abort_code": self.abort_code,
+            "kept_alive": self.kept_alive,
+            "time": None if self.end_time is None or self.reset_time is None else self.end_time - self.reset_time,
+        }
+
+
+class CANopenBootMaster:
+    """
+    NMT master boot-up of a whole network in the manner of CiA 302-2.
+
+    The slaves to boot and how to boot them come from the master's own object dictionary:
+    NMT startup (0x1F80), the NMT slave assignment (0x1F81), the expected identity
+    (0x1F84-0x1F88), the expected application software date and time (0x1F53/0x1F54), the
+    Concise DCF of every slave (0x1F22) and the expected configuration date and time
+    (0x1F26/0x1F27), and the boot time (0x1F89).
+
+    All slaves are reset at once, and every slave is checked, configured and started as soon
+    as its own boot-up frame arrives, so the network is up after about the time the slowest
+    slave needs. A mandatory slave failing stops the boot of the network; an optional slave
+    failing, or not booting in time, is reported and booted later if its boot-up arrives while
+    process() is being called.
+    """
+
+    # NMT startup (0x1F80) bits
+    STARTUP_NMT_MASTER = 0x01
+    STARTUP_START_ALL = 0x02
+    STARTUP_NO_SELF_START = 0x04
+    STARTUP_APPLICATION_START = 0x08
+    STARTUP_STOP_ALL_ON_ERROR = 0x40
+
+    INDEX_NMT_STARTUP = 0x1F80
+    INDEX_SLAVE_ASSIGNMENT = 0x1F81
+    INDEX_SOFTWARE_DATE = 0x1F53
+    INDEX_SOFTWARE_TIME = 0x1F54
+    INDEX_CONFIGURATION_DATE = 0x1F26
+    INDEX_CONFIGURATION_TIME = 0x1F27
+    INDEX_BOOT_TIME = 0x1F89
+
+    # (entry read from the slave, master object with the expected value, error on mismatch)
+    IDENTITY_CHECKS = (
+        (0x1000, 0, 0x1F84, CANopenBootSlave.ERROR_DEVICE_TYPE),
+        (0x1018, 1, 0x1F85, CANopenBootSlave.ERROR_VENDOR_ID),
+        (0x1018, 2, 0x1F86, CANopenBootSlave.ERROR_PRODUCT_CODE),
+        (0x1018, 3, 0x1F87, CANopenBootSlave.ERROR_REVISION),
+        (0x1018, 4, 0x1F88, CANopenBootSlave.ERROR_SERIAL),
+    )
+    # Application software date and time (0x1F52) and configuration date and time (0x1020) of a slave
+    SLAVE_SOFTWARE_VERSION = ((0x1F52, 1), (0x1F52, 2))
+    SLAVE_CONFIGURATION_DATE = ((0x1020, 1), (0x1020, 2))
+
+    # Boot time used if 0x1F89 is not configured, in seconds
+    DEFAULT_BOOT_TIME = 10.0
+    # Error of a mandatory slave still busy with a step at the end of the boot time
+    STEP_ERRORS = {
+        CANopenBootSlave.STEP_IDENTITY: CANopenBootSlave.ERROR_NO_RESPONSE,
+        CANopenBootSlave.STEP_VERSION: CANopenBootSlave.ERROR_SOFTWARE_VERSION,
+        CANopenBootSlave.STEP_CONFIGURATION_DATE: CANopenBootSlave.ERROR_CONFIGURATION,
+        CANopenBootSlave.STEP_CONFIGURE: CANopenBootSlave.ERROR_CONFIGURATION,
+    }
+
+    def __init__(self, master, configuration, timeout=2.0, retries=3, boot_time=None, on_progress=None):
+        """
+        :param master: The CANopenMasterNode booting the network.
+        :param configuration: The master's object dictionary, a dict of (index, subindex) -> value as
+            bytes or int, or a CANopenDCF. A Concise DCF in 0x1F22 may also be a dict or a CANopenDCF.
+        :param timeout: Seconds without a response from a slave before its configuration download is
+            retransmitted; SDO requests use the master's adaptive timeouts.
+        :param retries: Retransmissions of the configuration download before the slave fails.
+        :param boot_time: Seconds for all mandatory slaves to boot, 0x1F89 if None.
+        :param on_progress: Optional callable(CANopenBootSlave) run whenever a slave makes progress.
+        """
+        self.master = master
+        self.configuration = configuration.entries if isinstance(configuration, CANopenDCF) else configuration
+        self.timeout = timeout
+        self.retries = retries
+        self.on_progress = on_progress
+        self.startup = self._value(self.INDEX_NMT_STARTUP, 0)
+        if (self.INDEX_NMT_STARTUP, 0) in self.configuration and not self.startup & self.STARTUP_NMT_MASTER:
+            raise Exception("The NMT startup (0x1F80) does not configure the device as NMT master.")
+        if boot_time is None:
+            boot_time = self._value(self.INDEX_BOOT_TIME, 0) / 1000 or self.DEFAULT_BOOT_TIME
+        self.boot_time = boot_time
+        # node_id -> CANopenBootSlave of every slave in the network list
+        self.slaves = {}
+        for node_id in range(1, 128):
+            assignment = self._value(self.INDEX_SLAVE_ASSIGNMENT, node_id)
+            if assignment & CANopenBootSlave.ASSIGN_SLAVE:
+                self.slaves[node_id] = CANopenBootSlave(node_id, assignment)
+        self.started = False
+        self.deadline = None
+        self.start_time = None
+        self.end_time = None
+
+    def _value(self, index, subindex):
+        value = self.configuration.get((index, subindex), 0)
+        if isinstance(value, (bytes, bytearray)):
+            return int.from_bytes(value, "little")
+        return value
+
+    @property
+    def failed(self):
+        """True if a mandatory slave failed to boot."""
+        return any(slave.mandatory and slave.failed for slave in self.slaves.values())
+
+    def run(self):
+        """
+        Boot the network and return once every mandatory slave is up, or one of them failed.
+
+        Optional slaves are waited for until the boot time is over; those still missing
+        keep the error ERROR_NO_RESPONSE until their boot-up arrives while process() is called.
+
+        :return: Dict mapping node ID to None on success, or to the CiA 302-2 error status.
+        """
+        self.start_time = time.monotonic()
+        self.deadline = self.start_time + self.boot_time
+        self.started = False
+        self._reset_slaves()
+        while not self._finished():
+            self.master.poll()
+            self.process()
+        self.end_time = time.monotonic()
+        return {node_id: slave.error for node_id, slave in self.slaves.items()}
+
+    def _reset_slaves(self):
+        to_reset = []
+        for slave in self.slaves.values():
+            slave.step = slave.STEP_BOOT_UP
+            slave.error = None
+            slave.abort_code = None
+            slave.kept_alive = False
+            slave.reset_time = self.start_time
+            heartbeat = self.master.heartbeats.get(slave.node_id)
+            if (slave.assignment & slave.ASSIGN_KEEP_ALIVE and heartbeat is not None
+                    and heartbeat[0] == CANopenNMT.STATE_OPERATIONAL):
+                # Check the running slave without interrupting it
+                slave.kept_alive = True
+                self._boot(slave, self.start_time)
+            elif slave.assignment & slave.ASSIGN_BOOT:
+                to_reset.append(slave)
+            else:
+                # Neither configured nor started by the master
+                slave.step = slave.STEP_DONE
+        if not to_reset:
+            return
+        if len(to_reset) == len(self.slaves):
+            self.master.send_nmt(CANopenNMT.CMD_RESET_COMMUNICATION, 0)
+        else:
+            for slave in to_reset:
+                self.master.send_nmt(CANopenNMT.CMD_RESET_COMMUNICATION, slave.node_id)
+
+    def _finished(self):
+        if self.failed:
+            return True
+        # Slaves still missing fail at the deadline
+        return not any(slave.busy or (slave.step == slave.STEP_BOOT_UP and not slave.failed)
+                       for slave in self.slaves.values())
+
+    def process(self):
+        """
+        Advance the boot of all slaves: start the boot of every slave whose boot-up frame arrived,
+        check for timeouts, and start the slaves that are ready. Called by run(); keep calling it
+        with the master's poll() afterwards to boot optional slaves that show up late, and slaves
+        that rebooted.
+        """
+        now = time.monotonic()
+        boot_ups = self.master.boot_ups
+        for slave in self.slaves.values():
+            boot_up = boot_ups.get(slave.node_id)
+            booted = slave.assignment & slave.ASSIGN_BOOT and boot_up is not None and \
+                boot_up >= slave.reset_time and (slave.boot_up_time is None or boot_up > slave.boot_up_time)
+            late = self.deadline is not None and now >= self.deadline
+            if booted:
+                self._boot(slave, boot_up)
+            elif slave.busy:
+                # Kept alive slaves are checked too, whether the master boots them or not
+                started = slave.reset_time if slave.boot_up_time is None else slave.boot_up_time
+                if late and slave.mandatory and started < self.deadline:
+                    self._fail(slave, self.STEP_ERRORS[slave.step])
+                else:
+                    self._check(slave, now)
+            elif slave.step == slave.STEP_BOOT_UP and not slave.failed and slave.assignment & slave.ASSIGN_BOOT \
+                    and late:
+                self._fail(slave, slave.ERROR_NO_RESPONSE)
+        self._start_ready()
+
+    def _boot(self, slave, boot_up_time):
+        """Start the boot of a slave from its boot-up frame."""
+        if not slave.kept_alive:
+            slave.boot_up_time = boot_up_time
+        for request in slave.requests:
+            self.master.cancel(request)
+        slave.error = None
+        slave.abort_code = None
+        self.master.cache.clear(slave.node_id)
+        slave.step = slave.STEP_IDENTITY
+        self._start_step(slave)
+
+    def _start_step(self, slave):
+        slave.requests = []
+        if slave.step == slave.STEP_IDENTITY:
+            # The device type is always read, as the check that the slave is there
+            entries = [(index, subindex) for index, subindex, expected_index, _ in self.IDENTITY_CHECKS
+                       if index == 0x1000 or self._value(expected_index, slave.node_id)]
+        elif slave.step == slave.STEP_VERSION:
+            if not slave.assignment & slave.ASSIGN_VERSION_CHECK:
+                slave.step += 1
+                return self._start_step(slave)
+            if not (self._value(self.INDEX_SOFTWARE_DATE, slave.node_id)
+                    or self._value(self.INDEX_SOFTWARE_TIME, slave.node_id)):
+                logger.error(f"No expected software version configured for node {slave.node_id}.")
+                return self._fail(slave, slave.ERROR_SOFTWARE_VERSION)
+            entries = self.SLAVE_SOFTWARE_VERSION
+        elif slave.step == slave.STEP_CONFIGURATION_DATE:
+            if self.configuration.get((CANopenDCF.CONCISE_DCF_INDEX, slave.node_id)) is None:
+                slave.step = slave.STEP_READY
+                return self._start_step(slave)
+            if not (self._value(self.INDEX_CONFIGURATION_DATE, slave.node_id)
+                    or self._value(self.INDEX_CONFIGURATION_TIME, slave.node_id)):
+                slave.step += 1
+                return self._start_step(slave)
+            entries = self.SLAVE_CONFIGURATION_DATE
+        elif slave.step == slave.STEP_CONFIGURE:
+            configuration = self.configuration[(CANopenDCF.CONCISE_DCF_INDEX, slave.node_id)]
+            if isinstance(configuration, dict):
+                configuration = CANopenDCF(configuration)
+            if isinstance(configuration, CANopenDCF):
+                configuration = configuration.to_concise()
+            slave.retries_left = self.retries
+            slave.transfer = CANopenBlockDownload(slave.node_id, CANopenDCF.CONCISE_DCF_INDEX, slave.node_id,
+                                                  configuration, self._on_transfer_done)
+            self.master.start_transfer(slave.transfer)
+            self._report(slave)
+            return
+        else:
+            slave.end_time = time.monotonic()
+            self._report(slave)
+            return
+        # All reads of a step go out back-to-back
+        slave.requests = [CANopenSDORequest(slave.node_id, index, subindex, callback=self._on_request_done)
+                          for index, subindex in entries]
+        self._report(slave)
+        for request in slave.requests:
+            self.master.submit(request, fail_fast=False)
+
+    def _check(self, slave, now):
+        if slave.step == slave.STEP_CONFIGURE:
+            if slave.transfer is not None:
+                slave.retries_left = self.master.check_transfer(slave.transfer, self.timeout, slave.retries_left)
+        else:
+            for request in list(slave.requests):
+                self.master.check_request(request, now)
+
+    def _on_request_done(self, request):
+        slave = self.slaves.get(request.node_id)
+        if slave is None or request not in slave.requests:
+            return
+        if request.abort_code is not None:
+            slave.abort_code = request.abort_code
+            if slave.step == slave.STEP_IDENTITY and request.index == 0x1000:
+                error = slave.ERROR_NO_RESPONSE if request.abort_code == CANopenSDO.ABORT_TIMEOUT \
+                    else slave.ERROR_DEVICE_TYPE
+            elif slave.step == slave.STEP_IDENTITY:
+                error = next(check[3] for check in self.IDENTITY_CHECKS if check[:2] == request.key[1:])
+            elif slave.step == slave.STEP_VERSION:
+                error = slave.ERROR_SOFTWARE_VERSION
+            else:
+                # The configuration date can't be read, so configure the slave anyway
+                slave.abort_code = None
+                error = None
+            if error is not None:
+                return self._fail(slave, error)
+        if any(not request.done for request in slave.requests):
+            return
+        values = {request.key[1:]: self._unpack(request.result) for request in slave.requests}
+        if slave.step == slave.STEP_IDENTITY:
+            for index, subindex, expected_index, error in self.IDENTITY_CHECKS:
+                expected = self._value(expected_index, slave.node_id)
+                if (index, subindex) in values and expected and values[(index, subindex)] != expected:
+                    return self._fail(slave, error)
+            slave.step += 1
+        elif slave.step == slave.STEP_VERSION:
+            if (values[self.SLAVE_SOFTWARE_VERSION[0]] != self._value(self.INDEX_SOFTWARE_DATE, slave.node_id)
+                    or values[self.SLAVE_SOFTWARE_VERSION[1]] != self._value(self.INDEX_SOFTWARE_TIME, slave.node_id)):
+                return self._fail(slave, slave.ERROR_SOFTWARE_VERSION)
+            slave.step += 1
+        else:
+            date, time_of_day = (values[entry] for entry in self.SLAVE_CONFIGURATION_DATE)
+            configured = (all(request.abort_code is None for request in slave.requests)
+                          and date == self._value(self.INDEX_CONFIGURATION_DATE, slave.node_id)
+                          and time_of_day == self._value(self.INDEX_CONFIGURATION_TIME, slave.node_id))
+            # A slave holding the expected configuration is not configured again
+            slave.step = slave.STEP_READY if configured else slave.STEP_CONFIGURE
+        self._start_step(slave)
+
+    @staticmethod
+    def _unpack(value):
+        if value is None or len(value) != 4:
+            return None
+        return struct.unpack("<I", value)[0]
+
+    def _on_transfer_done(self, transfer):
+        slave = self.slaves.get(transfer.node_id)
+        if slave is None or slave.transfer is not transfer:
+            return
+        slave.transfer = None
+        self.master.cache.clear(slave.node_id)
+        if transfer.abort_code is not None:
+            slave.abort_code = transfer.abort_code
+            return self._fail(slave, slave.ERROR_CONFIGURATION)
+        slave.step = slave.STEP_READY
+        self._start_step(slave)
+
+    def _fail(self, slave, error):
+        for request in slave.requests:
+            self.master.cancel(request)
+        slave.requests = []
+        if slave.transfer is not None:
+            transfer = slave.transfer
+            slave.transfer = None
+            self.master.abort_transfer(transfer, CANopenSDO.ABORT_TIMEOUT)
+        slave.error = error
+        slave.end_time = time.monotonic()
+        kind = "Mandatory" if slave.mandatory else "Optional"
+        logger.error(f"{kind} slave {slave.node_id} failed to boot at step {slave.STEP_NAMES[slave.step]}: "
+                     f"error {error}" + ("" if slave.abort_code is None else f", abort code 0x{slave.abort_code:08X}"))
+        if slave.mandatory and self.startup & self.STARTUP_STOP_ALL_ON_ERROR:
+            self.master.send_nmt(CANopenNMT.CMD_STOP_REMOTE_NODE, 0)
+        self._report(slave)
+
+    def _start_ready(self):
+        """Start the slaves whose boot is complete, as far as the NMT startup allows."""
+        if self.failed:
+            return
+        ready = [slave for slave in self.slaves.values() if slave.step == slave.STEP_READY and not slave.failed]
+        if not self.started:
+            if not any(slave.mandatory and slave.step < slave.STEP_READY for slave in self.slaves.values()):
+                self.started = True
+                if not self.startup & self.STARTUP_NO_SELF_START:
+                    self.master.nmt.transition(CANopenNMT.CMD_START_REMOTE_NODE)
+                if (self.startup & self.STARTUP_START_ALL and not self.startup & self.STARTUP_APPLICATION_START
+                        and not any(slave.failed for slave in self.slaves.values())):
+                    # One broadcast starts all slaves at once, unless a failed slave must not be started
+                    self.master.send_nmt(CANopenNMT.CMD_START_REMOTE_NODE, 0)
+                    for slave in ready:
+                        self._started(slave)
+                    return
+            elif self.startup & self.STARTUP_START_ALL:
+                # Wait for the mandatory slaves to start all slaves with one broadcast
+                return
+        if self.startup & self.STARTUP_APPLICATION_START:
+            return
+        for slave in ready:
+            if not slave.kept_alive:
+                self.master.send_nmt(CANopenNMT.CMD_START_REMOTE_NODE, slave.node_id)
+            self._started(slave)
+
+    def start(self, node_ids=None):
+        """
+        Start slaves that are ready, for an NMT startup that leaves starting them to the application.
+
+        :param node_ids: Node IDs to start, all ready slaves if None.
+        """
+        for slave in self.slaves.values():
+            if slave.step == slave.STEP_READY and not slave.failed and (node_ids is None or slave.node_id in node_ids):
+                self.master.send_nmt(CANopenNMT.CMD_START_REMOTE_NODE, slave.node_id)
+                self._started(slave)
+
+    def _started(self, slave):
+        slave.step = slave.STEP_DONE
+        self._report(slave)
+
+    def _report(self, slave):
+        if self.on_progress:
+            self.on_progress(slave)
@@ -0,0 +1,122 @@
+import time
+from collections import OrderedDict
+
+
+class CANopenObjectCache:
+    """Bounded LRU cache of object dictionary values read from remote nodes."""
+
+    # Cache policies
+    POLICY_CONSTANT = 0  # Never expires, e.g. device type or identity.
+    POLICY_TTL = 1  # Expires after a time-to-live in seconds.
+    POLICY_INVALIDATE = 2  # Valid until written or until a bound PDO is received.
+
+    def __init__(self, max_entries=256, default_ttl=1.0):
+        """
+        Initialize the cache.
+
+        :param max_entries: Maximum number of cached values before the least recently used is evicted.
+        :param default_ttl: Time-to-live in seconds for entries without an explicit policy.
+        """
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        # (node_id, index, subindex) -> [value, policy, expires, cob_id]
+        self._entries = OrderedDict()
+        # cob_id -> set of cache keys invalidated when that PDO is received
+        self._pdo_bindings = {}
+        # (index, subindex) or (index, None) -> (policy, ttl, cob_id)
+        self.policies = {
+            (0x1000, 0): (self.POLICY_CONSTANT, None, None),
+            (0x1018, None): (self.POLICY_CONSTANT, None, None),
+        }
+        self.hits = 0
+        self.misses = 0
+
+    def set_policy(self, index, subindex=None, policy=POLICY_TTL, ttl=None, cob_id=None):
+        """
+        Set the cache policy for an object dictionary entry.
+
+        :param index: Object dictionary index.
+        :param subindex: Subindex, or None to apply to all subindexes of the index.
+        :param policy: One of the POLICY_* constants.
+        :param ttl: Time-to-live in seconds for POLICY_TTL, defaults to default_ttl.
+        :param cob_id: For POLICY_INVALIDATE, the COB-ID of the PDO that carries this entry.
+        """
+        self.policies[(index, subindex)] = (policy, ttl, cob_id)
+
+    def get_policy(self, index, subindex):
+        policy = self.policies.get((index, subindex))
+        if policy is None:
+            policy = self.policies.get((index, None))
+        if policy is None:
+            policy = (self.POLICY_TTL, None, None)
+        return policy
+
+    def get(self, node_id, index, subindex):
+        """Return the cached value, or None on a miss."""
+        key = (node_id, index, subindex)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry[1] == self.POLICY_TTL and time.monotonic() >= entry[2]:
+            self._remove(key)
+            self.misses += 1
+            return None
+        # Re-insert to mark the entry as most recently used
+        del self._entries[key]
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[0]
+
+    def put(self, node_id, index, subindex, value):
+        """Store a value read from a remote node."""
+        key = (node_id, index, subindex)
+        policy, ttl, cob_id = self.get_policy(index, subindex)
+        expires = None
+        if policy == self.POLICY_TTL:
+            expires = time.monotonic() + (self.default_ttl if ttl is None else ttl)
+        if key in self._entries:
+            self._remove(key)
+        elif len(self._entries) >= self.max_entries:
+            self._remove(next(iter(self._entries)))
+        self._entries[key] = [value, policy, expires, cob_id]
+        if policy == self.POLICY_INVALIDATE and cob_id is not None:
+            self._pdo_bindings.setdefault(cob_id, set()).add(key)
+
+    def invalidate(self, node_id, index, subindex):
+        """Drop a single entry, e.g. after it was written, or that of every node if node_id is 0 (broadcast)."""
+        if node_id == 0:
+            for key in [key for key in self._entries if key[1] == index and key[2] == subindex]:
+                self._remove(key)
+            return
+        key = (node_id, index, subindex)
+        if key in self._entries:
+            self._remove(key)
+
+    def invalidate_pdo(self, cob_id):
+        """Drop all entries bound to the PDO with the given COB-ID."""
+        keys = self._pdo_bindings.pop(cob_id, None)
+        if keys:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self, node_id=None):
+        """Drop all entries, or only those of one remote node."""
+        if node_id is None:
+            self._entries.clear()
+            self._pdo_bindings.clear()
+            return
+        for key in [key for key in self._entries if key[0] == node_id]:
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        cob_id = entry[3]
+        if cob_id is not None and cob_id in self._pdo_bindings:
+            self._pdo_bindings[cob_id].discard(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
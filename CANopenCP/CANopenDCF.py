@@ -0,0 +1,167 @@
+import struct
+
+
+class CANopenDCF:
+    """Device configuration that can be compiled to the Concise DCF format (object 0x1F22)."""
+
+    # Object holding the Concise DCF on the device being configured
+    CONCISE_DCF_INDEX = 0x1F22
+
+    # CANopen data types -> struct format
+    DATA_TYPES = {
+        0x0001: "<?",  # BOOLEAN
+        0x0002: "<b",  # INTEGER8
+        0x0003: "<h",  # INTEGER16
+        0x0004: "<i",  # INTEGER32
+        0x0005: "<B",  # UNSIGNED8
+        0x0006: "<H",  # UNSIGNED16
+        0x0007: "<I",  # UNSIGNED32
+        0x0008: "<f",  # REAL32
+        0x0011: "<d",  # REAL64
+        0x0015: "<q",  # INTEGER64
+        0x001B: "<Q",  # UNSIGNED64
+    }
+    TYPE_VISIBLE_STRING = 0x0009
+    TYPE_OCTET_STRING = 0x000A
+    TYPE_DOMAIN = 0x000F
+
+    def __init__(self, entries=None):
+        """
+        :param entries: Optional dict mapping (index, subindex) to the value as bytes.
+        """
+        self.entries = dict(entries) if entries else {}
+
+    def set(self, index, subindex, value, data_type=None):
+        """
+        Add an entry to the configuration.
+
+        :param value: The value as bytes, or a number packed according to data_type.
+        :param data_type: CANopen data type code, required when value is not bytes.
+        """
+        if not isinstance(value, (bytes, bytearray)):
+            value = self.encode(value, data_type)
+        self.entries[(index, subindex)] = bytes(value)
+
+    @classmethod
+    def encode(cls, value, data_type):
+        if data_type == cls.TYPE_VISIBLE_STRING:
+            return str(value).encode()
+        if data_type in (cls.TYPE_OCTET_STRING, cls.TYPE_DOMAIN):
+            return bytes.fromhex(str(value).replace(" ", ""))
+        data_format = cls.DATA_TYPES.get(data_type)
+        if data_format is None:
+            raise ValueError(f"Unsupported data type: 0x{data_type:04X}")
+        return struct.pack(data_format, value)
+
+    @classmethod
+    def from_file(cls, path, node_id=None):
+        """Load the configured parameter values of a DCF file."""
+        with open(path) as dcf_file:
+            return cls.parse(dcf_file.read(), node_id)
+
+    @classmethod
+    def parse(cls, text, node_id=None):
+        """
+        Parse the text of a DCF file.
+
+        Only entries with a ParameterValue (or a DefaultValue when no ParameterValue is present)
+        that are writable are included. "$NODEID" in values is replaced by node_id, or by the
+        NodeID of the [DeviceComissioning] section.
+
+        :param text: The contents of the DCF file.
+        :param node_id: Node ID used to resolve "$NODEID" expressions.
+        """
+        sections = {}
+        section = None
+        for line in text.splitlines():
+            line = line.strip()
+            if not line or line[0] == ";":
+                continue
+            if line[0] == "[" and line[-1] == "]":
+                section = sections.setdefault(line[1:-1].strip().lower(), {})
+            elif section is not None and "=" in line:
+                key, value = line.split("=", 1)
+                section[key.strip().lower()] = value.strip()
+
+        if node_id is None:
+            commissioning = sections.get("devicecomissioning", {})
+            if commissioning.get("nodeid"):
+                node_id = cls._to_int(commissioning["nodeid"], 0)
+
+        dcf = cls()
+        for name, keys in sections.items():
+            index, subindex = cls._parse_section_name(name)
+            if index is None:
+                continue
+            value = keys.get("parametervalue", keys.get("defaultvalue"))
+            access = keys.get("accesstype", "rw").lower()
+            if not value or "datatype" not in keys or access in ("ro", "const"):
+                continue
+            data_type = cls._to_int(keys["datatype"], node_id)
+            if data_type in (cls.TYPE_VISIBLE_STRING, cls.TYPE_OCTET_STRING, cls.TYPE_DOMAIN):
+                dcf.set(index, subindex, value, data_type)
+            elif data_type in (0x0008, 0x0011):
+                dcf.set(index, subindex, float(value), data_type)
+            else:
+                dcf.set(index, subindex, cls._to_int(value, node_id), data_type)
+        return dcf
+
+    @staticmethod
+    def _parse_section_name(name):
+        try:
+            if "sub" in name:
+                index, subindex = name.split("sub", 1)
+                return int(index, 16), int(subindex, 16)
+            return int(name, 16), 0
+        except ValueError:
+            return None, None
+
+    @staticmethod
+    def _to_int(value, node_id):
+        """Parse an integer value, which may be a sum with $NODEID anywhere in it, e.g. 0x180+$NODEID."""
+        value = value.replace(" ", "")
+        if "$" not in value:
+            return int(value, 0)
+        total = 0
+        for term in value.split("+"):
+            if term.upper() == "$NODEID":
+                if node_id is None:
+                    raise ValueError("$NODEID used but no node ID is known.")
+                total += node_id
+            elif term:
+                total += int(term, 0)
+        return total
+
+    def to_concise(self):
+        """
+        Compile the configuration to Concise DCF format.
+
+        The format is the number of entries (UNSIGNED32) followed by, for every entry,
+        the index (UNSIGNED16), subindex (UNSIGNED8), data size (UNSIGNED32) and data.
+        """
+        parts = [struct.pack("<I", len(self.entries))]
+        for (index, subindex), value in sorted(self.entries.items()):
+            parts.append(struct.pack("<HBI", index, subindex, len(value)))
+            parts.append(value)
+        return b"".join(parts)
+
+    @staticmethod
+    def iter_concise(data):
+        """Yield (index, subindex, value) from a Concise DCF."""
+        data = memoryview(bytes(data))
+        count, = struct.unpack_from("<I", data, 0)
+        offset = 4
+        for _ in range(count):
+            index, subindex, size = struct.unpack_from("<HBI", data, offset)
+            offset += 7
+            if offset + size > len(data):
+                raise ValueError("Concise DCF is truncated.")
+            yield index, subindex, bytes(data[offset:offset + size])
+            offset += size
+
+    @classmethod
+    def from_concise(cls, data):
+        return cls({(index, subindex): value for index, subindex, value in cls.iter_concise(data)})
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,249 @@
+import os
+
+try:
+    import mmap
+except ImportError:
+    # CircuitPython has no mmap; file and memory storage still work
+    mmap = None
+
+
+def replace_file(source, destination):
+    """Rename the file source to destination, replacing destination if it exists."""
+    if hasattr(os, "replace"):
+        os.replace(source, destination)
+    else:
+        # CircuitPython has no os.replace, and its rename doesn't overwrite
+        try:
+            os.remove(destination)
+        except OSError:
+            pass
+        os.rename(source, destination)
+
+
+class CANopenDomain:
+    """
+    DOMAIN object dictionary entry backed by memory, a file or a memory map.
+
+    SDO transfers read and write it at an offset through a caller supplied buffer,
+    so a transfer never holds more than one segment of the value in RAM.
+    """
+
+    # Appended to the path of a file-backed domain for the file receiving its next value
+    REPLACEMENT_SUFFIX = ".part"
+    # The domain a replacement from open_replacement() is for, None for other domains
+    replaces = None
+
+    def __init__(self, storage=None):
+        """
+        :param storage: None or bytes/bytearray for an in-memory value, a binary file object
+            opened for reading (and writing to accept downloads), or an mmap object.
+        """
+        if storage is None:
+            storage = bytearray()
+        elif isinstance(storage, bytes):
+            storage = bytearray(storage)
+        self.storage = storage
+        self._memory = isinstance(storage, bytearray)
+        self._mmap = mmap is not None and isinstance(storage, mmap.mmap)
+        self._size = len(storage) if self._memory or self._mmap else None
+
+    @classmethod
+    def open(cls, path, writable=True, use_mmap=False):
+        """
+        Back a domain with a file.
+
+        :param path: Path of the file; it is created if it does not exist and writable is True.
+        :param writable: Open the file so that SDO downloads can replace its contents.
+        :param use_mmap: Memory-map the file instead of using seek/readinto, for read-only domains.
+        """
+        if use_mmap:
+            if mmap is None:
+                raise ValueError("mmap is not available on this platform.")
+            with open(path, "rb") as domain_file:
+                return cls(mmap.mmap(domain_file.fileno(), 0, access=mmap.ACCESS_READ))
+        try:
+            domain_file = open(path, "r+b" if writable else "rb")
+        except OSError:
+            if not writable:
+                raise
+            domain_file = open(path, "w+b")
+        return cls(domain_file)
+
+    @property
+    def size(self):
+        if self._size is None:
+            self._size = self.storage.seek(0, 2)
+        return self._size
+
+    def readinto(self, offset, buffer):
+        """
+        Read bytes starting at offset into buffer.
+
+        :return: The number of bytes read, 0 at the end of the domain.
+        """
+        count = min(len(buffer), max(0, self.size - offset))
+        if count == 0:
+            return 0
+        if self._memory or self._mmap:
+            buffer[:count] = memoryview(self.storage)[offset:offset + count]
+            return count
+        self.storage.seek(offset)
+        if count < len(buffer):
+            return self.storage.readinto(memoryview(buffer)[:count])
+        return self.storage.readinto(buffer)
+
+    def write(self, offset, data):
+        """Write data at offset, extending the domain if needed."""
+        if self._mmap:
+            raise OSError("Memory mapped domains are read-only.")
+        end = offset + len(data)
+        if self._memory:
+            if end > len(self.storage):
+                self.storage.extend(bytes(end - len(self.storage)))
+            self.storage[offset:end] = data
+        else:
+            self.storage.seek(offset)
+            self.storage.write(data)
+        self._size = max(self.size, end)
+
+    def truncate(self, size):
+        """Cut the domain to size bytes, e.g. before receiving a new value."""
+        if self._mmap:
+            raise OSError("Memory mapped domains are read-only.")
+        if self._memory:
+            del self.storage[size:]
+        else:
+            self.storage.truncate(size)
+            if hasattr(self.storage, "flush"):
+                self.storage.flush()
+        self._size = size
+
+    def open_replacement(self):
+        """
+        Return a new domain receiving a new value, which replace() swaps in once it is complete.
+
+        A file-backed domain gets a file next to its own, so an aborted or failed download
+        leaves the stored value intact without holding the new one in RAM; other domains
+        get a memory buffer.
+        """
+        if self._mmap:
+            raise OSError("Memory mapped domains are read-only.")
+        path = getattr(self.storage, "name", None)
+        if self._memory or not isinstance(path, str):
+            replacement = CANopenDomain()
+        else:
+            replacement = CANopenDomain(open(path + self.REPLACEMENT_SUFFIX, "w+b"))
+        replacement.replaces = self
+        return replacement
+
+    def replace(self, replacement):
+        """Take over the value of a complete replacement returned by open_replacement()."""
+        replacement.replaces = None
+        if self._memory:
+            self.storage = replacement.storage
+            self._size = replacement.size
+            return
+        if replacement._memory:
+            self.truncate(0)
+            self.write(0, replacement.storage)
+            return
+        path = self.storage.name
+        replacement.close()
+        self.storage.close()
+        replace_file(replacement.storage.name, path)
+        self.storage = open(path, "r+b")
+        self._size = None
+
+    def discard(self):
+        """Drop a replacement returned by open_replacement() whose download failed."""
+        if self.replaces is None:
+            return
+        self.replaces = None
+        self.close()
+        if not self._memory:
+            os.remove(self.storage.name)
+
+    def at_end(self, offset):
+        """Return True if there is no data at or after offset."""
+        return offset >= self.size
+
+    def release(self, offset):
+        """Tell the domain that data before offset will not be read again."""
+        pass
+
+    def getvalue(self):
+        """Return the whole value as bytes; only meant for small domains."""
+        if self._memory or self._mmap:
+            return bytes(self.storage[:self.size])
+        data = bytearray(self.size)
+        self.readinto(0, data)
+        return bytes(data)
+
+    def close(self):
+        if not self._memory and hasattr(self.storage, "close"):
+            self.storage.close()
+
+    def __len__(self):
+        return self.size
+
+
+class CANopenStreamDomain(CANopenDomain):
+    """
+    Read-only domain fed by an iterator of byte chunks, e.g. a firmware image being received.
+
+    Only the data not yet released is kept, so a transfer can repeat unacknowledged
+    segments without the whole stream being held in RAM.
+    """
+
+    def __init__(self, chunks, size=None):
+        """
+        :param chunks: Iterable yielding bytes.
+        :param size: Total size if known in advance, else it is known once the iterator is exhausted.
+        """
+        super().__init__()
+        self._chunks = iter(chunks)
+        self._start = 0  # Stream offset of the first buffered byte
+        self._size = size
+        self._exhausted = False
+
+    @property
+    def size(self):
+        """The total size, or None while unknown."""
+        return self._size
+
+    def _fill(self, end):
+        """Buffer data until the stream offset end, or until the stream is exhausted."""
+        while not self._exhausted and self._start + len(self.storage) < end:
+            try:
+                self.storage.extend(next(self._chunks))
+            except StopIteration:
+                self._exhausted = True
+                self._size = self._start + len(self.storage)
+
+    def readinto(self, offset, buffer):
+        if offset < self._start:
+            raise ValueError("Stream data before the released offset cannot be read again.")
+        self._fill(offset + len(buffer))
+        position = offset - self._start
+        count = max(0, min(len(buffer), len(self.storage) - position))
+        if count:
+            buffer[:count] = memoryview(self.storage)[position:position + count]
+        return count
+
+    def at_end(self, offset):
+        self._fill(offset + 1)
+        return self._exhausted and offset >= self._size
+
+    def release(self, offset):
+        if offset > self._start:
+            del self.storage[:offset - self._start]
+            self._start = offset
+
+    def write(self, offset, data):
+        raise OSError("Stream domains are read-only.")
+
+    def truncate(self, size):
+        raise OSError("Stream domains are read-only.")
+
+    def open_replacement(self):
+        raise OSError("Stream domains are read-only.")
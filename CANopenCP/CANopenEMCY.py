@@ -0,0 +1,260 @@
+import struct
+import time
+
+from .CANopenMessage import CANopenMessage
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class CANopenErrorHistory:
+    """Fixed-size ring buffer of error entries, newest first."""
+
+    def __init__(self, size=8):
+        self.size = size
+        self._entries = [None] * size
+        self._head = 0  # Slot of the next entry
+        self.count = 0
+
+    def append(self, entry):
+        self._entries[self._head] = entry
+        self._head = (self._head + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def clear(self):
+        self._entries = [None] * self.size
+        self._head = 0
+        self.count = 0
+
+    def __getitem__(self, position):
+        """Return the entry at position, 0 being the newest."""
+        if not 0 <= position < self.count:
+            raise IndexError("error history index out of range")
+        return self._entries[(self._head - 1 - position) % self.size]
+
+    def __iter__(self):
+        for position in range(self.count):
+            yield self[position]
+
+    def __len__(self):
+        return self.count
+
+
+class CANopenEMCY:
+    """CANopen Emergency objects."""
+
+    COB_ID_EMCY = CANopenMessage.COB_ID_EMCY
+
+    # Object dictionary entries
+    INDEX_ERROR_REGISTER = 0x1001
+    INDEX_ERROR_FIELD = 0x1003
+    INDEX_INHIBIT_TIME = 0x1015
+
+    # Error register (0x1001) bits
+    ERR_REG_GENERIC = 0x01
+    ERR_REG_CURRENT = 0x02
+    ERR_REG_VOLTAGE = 0x04
+    ERR_REG_TEMPERATURE = 0x08
+    ERR_REG_COMMUNICATION = 0x10
+    ERR_REG_DEVICE_PROFILE = 0x20
+    ERR_REG_MANUFACTURER = 0x80
+
+    # Error codes
+    ERR_RESET = 0x0000
+    ERR_GENERIC = 0x1000
+    ERR_CURRENT = 0x2000
+    ERR_VOLTAGE = 0x3000
+    ERR_TEMPERATURE = 0x4000
+    ERR_COMMUNICATION = 0x8100
+    ERR_CAN_OVERRUN = 0x8110
+    ERR_PDO_LENGTH = 0x8210
+
+    @staticmethod
+    def pack(error_code, error_register, data=b""):
+        return struct.pack("<HB5s", error_code, error_register, bytes(data))
+
+    @staticmethod
+    def unpack(data):
+        """Return (error code, error register, manufacturer specific bytes) of an EMCY frame."""
+        error_code, error_register = struct.unpack("<HB", bytes(data[:3]))
+        return error_code, error_register, bytes(data[3:8])
+
+
+class CANopenEMCYProducer(CANopenEMCY):
+    """Emergency producer with inhibit time coalescing."""
+
+    def __init__(self, node, history_size=8, max_pending=8):
+        """
+        :param node: The CANopenSlaveNode producing the emergencies; 0x1001, 0x1003 and
+            0x1015 are kept in its data_dict.
+        :param history_size: Number of entries of the pre-defined error field (0x1003).
+        :param max_pending: Maximum number of distinct EMCYs queued during the inhibit time.
+        """
+        self.node = node
+        self.history = CANopenErrorHistory(history_size)
+        self.max_pending = max_pending
+        # error code -> error register bits, of errors that have not been reset
+        self.active = {}
+        # error code -> data of the EMCYs waiting for the inhibit time to expire
+        self._pending = {}
+        # Their error codes, oldest first (CircuitPython dicts don't keep the insertion order)
+        self._pending_order = []
+        self._last_sent = None
+        self.coalesced = 0
+        node.data_dict.setdefault((self.INDEX_ERROR_REGISTER, 0), b"\x00")
+        node.data_dict.setdefault((self.INDEX_INHIBIT_TIME, 0), b"\x00\x00")
+        self._sync_error_field()
+
+    @property
+    def cob_id(self):
+        return self.COB_ID_EMCY + self.node.node_id
+
+    @property
+    def inhibit_time(self):
+        """Inhibit time from 0x1015 in seconds (the object holds multiples of 100 us)."""
+        value, = struct.unpack("<H", bytes(self.node.data_dict[(self.INDEX_INHIBIT_TIME, 0)]))
+        return value / 10000
+
+    @property
+    def error_register(self):
+        return self.node.data_dict[(self.INDEX_ERROR_REGISTER, 0)][0]
+
+    def error(self, error_code, register_bits=CANopenEMCY.ERR_REG_GENERIC, data=b""):
+        """
+        Signal an error condition.
+
+        The error is recorded in 0x1003 and 0x1001 at once. Its EMCY frame is sent right away
+        unless the inhibit time is running; then it is queued and merged with any queued EMCY
+        of the same error code.
+        """
+        self.active[error_code] = register_bits
+        self._update_register()
+        self.history.append(struct.pack("<I", error_code))
+        self._sync_error_field()
+        self._queue(error_code, data)
+
+    def reset(self, error_code=None):
+        """
+        Clear one active error, or all when error_code is None.
+
+        An error reset EMCY (code 0x0000) is produced when no error remains active.
+        """
+        if error_code is None:
+            self.active.clear()
+            self._pending.clear()
+            self._pending_order.clear()
+        else:
+            self.active.pop(error_code, None)
+            if error_code in self._pending:
+                del self._pending[error_code]
+                self._pending_order.remove(error_code)
+        self._update_register()
+        if not self.active:
+            self._queue(self.ERR_RESET, b"")
+
+    def clear_history(self):
+        """Clear the pre-defined error field, like writing 0 to 0x1003:0."""
+        self.history.clear()
+        self._sync_error_field()
+
+    def process(self, now=None):
+        """
+        Send the oldest queued EMCY if the inhibit time has expired.
+
+        Call this from the application loop.
+        """
+        if not self._pending:
+            return False
+        now = time.monotonic() if now is None else now
+        if self._last_sent is not None and now - self._last_sent < self.inhibit_time:
+            return False
+        error_code = self._pending_order.pop(0)
+        self._send(error_code, self._pending.pop(error_code), now)
+        return True
+
+    def _queue(self, error_code, data):
+        if error_code in self._pending:
+            # Merge with the EMCY already waiting for the same error
+            self._pending_order.remove(error_code)
+            self.coalesced += 1
+        elif len(self._pending) >= self.max_pending:
+            del self._pending[self._pending_order.pop(0)]
+            self.coalesced += 1
+        self._pending[error_code] = data
+        self._pending_order.append(error_code)
+        self.process()
+
+    def _send(self, error_code, data, now):
+        message = CANopenMessage(self.cob_id)
+        message.data = self.pack(error_code, self.error_register, data)
+        self.node.send(message)
+        self._last_sent = now
+
+    def _update_register(self):
+        register = 0
+        for bits in self.active.values():
+            register |= bits
+        if register:
+            register |= self.ERR_REG_GENERIC
+        self.node.data_dict[(self.INDEX_ERROR_REGISTER, 0)] = bytes([register])
+
+    def _sync_error_field(self):
+        data_dict = self.node.data_dict
+        data_dict[(self.INDEX_ERROR_FIELD, 0)] = bytes([len(self.history)])
+        for subindex in range(1, self.history.size + 1):
+            if subindex <= len(self.history):
+                data_dict[(self.INDEX_ERROR_FIELD, subindex)] = self.history[subindex - 1]
+            else:
+                data_dict.pop((self.INDEX_ERROR_FIELD, subindex), None)
+
+
+class CANopenEMCYConsumer(CANopenEMCY):
+    """Emergency consumer aggregating the EMCYs of all nodes on a master."""
+
+    def __init__(self, master, history_size=16, on_emergency=None):
+        """
+        :param master: The CANopenMasterNode receiving the EMCY frames.
+        :param history_size: Number of EMCYs kept per node.
+        :param on_emergency: Optional callable(node_id, error_code, error_register, data).
+        """
+        self.master = master
+        self.history_size = history_size
+        self.on_emergency = on_emergency
+        # node_id -> CANopenErrorHistory of (time, error code, error register, data)
+        self.histories = {}
+        # node_id -> number of EMCYs received
+        self.counts = {}
+        # node_id -> error register of the last EMCY
+        self.error_registers = {}
+        # Frames on EMCY COB-IDs too short to hold an error code and register, ignored
+        self.invalid_frames = 0
+        for node_id in range(1, 128):
+            master.add_handler(self.COB_ID_EMCY + node_id, self.process)
+
+    def process(self, message):
+        node_id = message.id - self.COB_ID_EMCY
+        if len(message.data) < 3:
+            # Malformed, or a frame of another protocol, which must not break the master's dispatch
+            self.invalid_frames += 1
+            return
+        error_code, error_register, data = self.unpack(message.data)
+        history = self.histories.get(node_id)
+        if history is None:
+            history = self.histories[node_id] = CANopenErrorHistory(self.history_size)
+        history.append((time.monotonic(), error_code, error_register, data))
+        self.counts[node_id] = self.counts.get(node_id, 0) + 1
+        self.error_registers[node_id] = error_register
+        if error_code != self.ERR_RESET:
+            logger.warning(f"EMCY from node {node_id}: error 0x{error_code:04X}, register 0x{error_register:02X}")
+        if self.on_emergency:
+            self.on_emergency(node_id, error_code, error_register, data)
+
+    def nodes_in_error(self):
+        """Return the node IDs whose last EMCY left the error register set."""
+        return [node_id for node_id, register in self.error_registers.items() if register]
+
+    def last_error(self, node_id):
+        """Return (time, error code, error register, data) of the newest EMCY of a node, or None."""
+        history = self.histories.get(node_id)
+        return history[0] if history else None
@@ -0,0 +1,372 @@
+import asyncio
+import base64
+import struct
+import time
+
+from .CANopenNetwork import CANopenNetwork
+from .CANopenNMT import CANopenNMT
+from .CANopenSDO import CANopenBlockDownload, CANopenSDORequest, CANopenSegmentedUpload
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class _CommandError(Exception):
+    def __init__(self, code):
+        super().__init__(code)
+        self.code = code
+
+
+class CANopenGateway:
+    """
+    CiA 309-3 ASCII gateway to a CANopen network, served over TCP with asyncio.
+
+    Every client sends one command per line, e.g. ``[1] 5 r 0x1018 1 u32`` or
+    ``[2] 1 5 w 0x1017 0 u16 1000``, and receives ``[1] <value>``, ``[2] OK`` or
+    ``[n] ERROR:<code>``. Commands of all clients are multiplexed onto the SDO client of one
+    CANopenMasterNode, or of the master of the addressed bus of a CANopenNetwork: commands for
+    different nodes run concurrently, commands for the same node in the order they were
+    received, and responses are returned as soon as they are available, so they may arrive out
+    of order and are matched by their sequence number.
+    """
+
+    # Gateway error codes
+    ERR_NOT_SUPPORTED = 100
+    ERR_SYNTAX = 101
+    ERR_NOT_PROCESSED = 102
+    ERR_TIMEOUT = 103
+    ERR_NO_DEFAULT_NET = 104
+    ERR_NO_DEFAULT_NODE = 105
+    ERR_UNSUPPORTED_NET = 106
+    ERR_UNSUPPORTED_NODE = 107
+
+    # Data type -> struct format of the fixed size types
+    DATA_TYPES = {
+        "b": "<?",
+        "i8": "<b",
+        "i16": "<h",
+        "i32": "<i",
+        "i64": "<q",
+        "u8": "<B",
+        "u16": "<H",
+        "u32": "<I",
+        "u64": "<Q",
+        "r32": "<f",
+        "r64": "<d",
+    }
+    # Variable size types: visible string, octet string (hex) and domain (base64)
+    STRING_TYPES = ("vs", "os", "d")
+
+    NMT_COMMANDS = {
+        "start": CANopenNMT.CMD_START_REMOTE_NODE,
+        "stop": CANopenNMT.CMD_STOP_REMOTE_NODE,
+        "preop": CANopenNMT.CMD_ENTER_PRE_OPERATIONAL,
+        "preoperational": CANopenNMT.CMD_ENTER_PRE_OPERATIONAL,
+    }
+    RESET_COMMANDS = {
+        "node": CANopenNMT.CMD_RESET_NODE,
+        "comm": CANopenNMT.CMD_RESET_COMMUNICATION,
+        "communication": CANopenNMT.CMD_RESET_COMMUNICATION,
+    }
+
+    HEARTBEAT_INDEX = 0x1017
+
+    def __init__(self, master, net=1, sdo_timeout=1.0, poll_interval=0.001):
+        """
+        :param master: The CANopenMasterNode whose SDO client serves all connections,
+            or a CANopenNetwork whose buses are addressed by their network numbers.
+        :param net: The network number of the master's bus, or the default network of a CANopenNetwork.
+        :param sdo_timeout: Seconds without a response after which a segmented or block transfer is aborted.
+            Expedited requests use the master's adaptive timeouts.
+        :param poll_interval: Seconds between polls of the bus.
+        """
+        # net -> CANopenMasterNode
+        self.masters = dict(master.buses) if isinstance(master, CANopenNetwork) else {net: master}
+        self.net = net if net in self.masters else min(self.masters, default=None)
+        self._poll = master.poll
+        self.sdo_timeout = sdo_timeout
+        self.poll_interval = poll_interval
+        # (net, node_id) -> asyncio.Lock serializing the SDO commands for that node
+        self._locks = {}
+        # Outstanding (master, request) and (master, transfer) driven by the pump task
+        self._requests = []
+        self._transfers = []
+        self._server = None
+        self._pump_task = None
+        self._sessions = set()
+
+    async def start(self, host="127.0.0.1", port=0):
+        """
+        Start serving clients and polling the bus.
+
+        :return: The TCP port the gateway listens on.
+        """
+        self._server = await asyncio.start_server(self._serve_client, host, port)
+        self._pump_task = asyncio.ensure_future(self._pump())
+        return self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for task in list(self._sessions):
+            task.cancel()
+        if self._pump_task is not None:
+            self._pump_task.cancel()
+            try:
+                await self._pump_task
+            except asyncio.CancelledError:
+                pass
+
+    async def _pump(self):
+        while True:
+            self._poll()
+            now = time.monotonic()
+            for master, request in self._requests:
+                master.check_request(request, now)
+            for master, transfer in self._transfers:
+                master.check_transfer(transfer, self.sdo_timeout)
+            self._requests = [entry for entry in self._requests if not entry[1].done]
+            self._transfers = [entry for entry in self._transfers if not entry[1].done]
+            await asyncio.sleep(self.poll_interval)
+
+    async def _serve_client(self, reader, writer):
+        session = asyncio.current_task()
+        self._sessions.add(session)
+        # Default network and node of this connection
+        defaults = {"net": self.net, "node": None}
+        commands = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.decode("ascii", "replace").strip()
+                if not line or line.startswith("#"):
+                    continue
+                # Each command runs in its own task so that slow nodes don't hold up the others
+                command = asyncio.ensure_future(self._answer(line, defaults, writer))
+                commands.add(command)
+                command.add_done_callback(commands.discard)
+            if commands:
+                await asyncio.gather(*commands, return_exceptions=True)
+        except (asyncio.CancelledError, ConnectionError):
+            for command in commands:
+                command.cancel()
+        finally:
+            self._sessions.discard(session)
+            writer.close()
+
+    async def _answer(self, line, defaults, writer):
+        seq = None
+        if line.startswith("["):
+            end = line.find("]")
+            if end > 0:
+                seq, line = line[1:end].strip(), line[end + 1:]
+        try:
+            response = await self.execute(line, defaults)
+        except _CommandError as e:
+            response = f"ERROR:{e.code}"
+        except Exception as e:
+            logger.warning(f"Gateway command '{line.strip()}' failed: {e}")
+            response = f"ERROR:{self.ERR_NOT_PROCESSED}"
+        if seq is not None:
+            response = f"[{seq}] {response}"
+        writer.write(response.encode("ascii", "replace") + b"\r\n")
+
+    async def execute(self, line, defaults=None):
+        """
+        Execute one command without its sequence number.
+
+        :param defaults: Dict with the default "net" and "node" of the connection, updated by set commands.
+        :return: The response text.
+        """
+        if defaults is None:
+            defaults = {"net": self.net, "node": None}
+        tokens = line.split()
+        numbers = []
+        while tokens and len(numbers) < 2 and tokens[0][0].isdigit():
+            numbers.append(self._parse_int(tokens.pop(0)))
+        if not tokens:
+            raise _CommandError(self.ERR_SYNTAX)
+        net = numbers[0] if len(numbers) == 2 else defaults["net"]
+        node_id = numbers[-1] if numbers else defaults["node"]
+        command = tokens[0].lower()
+        args = tokens[1:]
+
+        if command == "set":
+            return await self._set(args, net, node_id, defaults)
+        if net is None:
+            raise _CommandError(self.ERR_NO_DEFAULT_NET)
+        if net not in self.masters:
+            raise _CommandError(self.ERR_UNSUPPORTED_NET)
+
+        if command in self.NMT_COMMANDS or command == "reset":
+            if command == "reset":
+                if len(args) != 1 or args[0].lower() not in self.RESET_COMMANDS:
+                    raise _CommandError(self.ERR_SYNTAX)
+                nmt_command = self.RESET_COMMANDS[args[0].lower()]
+            else:
+                nmt_command = self.NMT_COMMANDS[command]
+            # Without a node the command addresses all nodes
+            node_id = self._check_node(node_id if numbers else 0, allow_broadcast=True)
+            self.masters[net].send_nmt(nmt_command, node_id)
+            return "OK"
+
+        if command in ("r", "read"):
+            if len(args) != 3:
+                raise _CommandError(self.ERR_SYNTAX)
+            node_id = self._check_node(node_id)
+            index, subindex, data_type = self._parse_int(args[0]), self._parse_int(args[1]), args[2].lower()
+            value = await self.read(node_id, index, subindex, data_type, net)
+            return self.format_value(value, data_type)
+
+        if command in ("w", "write"):
+            if len(args) < 4:
+                raise _CommandError(self.ERR_SYNTAX)
+            node_id = self._check_node(node_id)
+            index, subindex, data_type = self._parse_int(args[0]), self._parse_int(args[1]), args[2].lower()
+            await self.write(node_id, index, subindex, self.parse_value(args[3:], data_type), net)
+            return "OK"
+
+        raise _CommandError(self.ERR_NOT_SUPPORTED)
+
+    async def _set(self, args, net, node_id, defaults):
+        if len(args) != 2:
+            raise _CommandError(self.ERR_SYNTAX)
+        name, value = args[0].lower(), self._parse_int(args[1])
+        if name == "network":
+            if value not in self.masters:
+                raise _CommandError(self.ERR_UNSUPPORTED_NET)
+            defaults["net"] = value
+        elif name == "node":
+            defaults["node"] = self._check_node(value)
+        elif name == "sdo_timeout":
+            self.sdo_timeout = value / 1000
+        elif name == "heartbeat":
+            if net not in self.masters:
+                raise _CommandError(self.ERR_UNSUPPORTED_NET)
+            await self.write(self._check_node(node_id), self.HEARTBEAT_INDEX, 0, struct.pack("<H", value), net)
+        else:
+            raise _CommandError(self.ERR_NOT_SUPPORTED)
+        return "OK"
+
+    def _check_node(self, node_id, allow_broadcast=False):
+        if node_id is None:
+            raise _CommandError(self.ERR_NO_DEFAULT_NODE)
+        if not (0 if allow_broadcast else 1) <= node_id <= 127:
+            raise _CommandError(self.ERR_UNSUPPORTED_NODE)
+        return node_id
+
+    @staticmethod
+    def _parse_int(token):
+        try:
+            return int(token, 0)
+        except ValueError:
+            raise _CommandError(CANopenGateway.ERR_SYNTAX)
+
+    def parse_value(self, tokens, data_type):
+        """Convert the value tokens of a write command to bytes."""
+        try:
+            if data_type in self.DATA_TYPES:
+                if len(tokens) != 1:
+                    raise _CommandError(self.ERR_SYNTAX)
+                value = float(tokens[0]) if data_type[0] == "r" else int(tokens[0], 0)
+                return struct.pack(self.DATA_TYPES[data_type], value)
+            if data_type == "vs":
+                text = " ".join(tokens)
+                if len(text) >= 2 and text[0] == text[-1] == '"':
+                    text = text[1:-1]
+                return text.encode("utf-8")
+            if data_type == "os":
+                return bytes.fromhex("".join(tokens))
+            if data_type == "d":
+                return base64.b64decode("".join(tokens), validate=True)
+        except (ValueError, struct.error):
+            raise _CommandError(self.ERR_SYNTAX)
+        raise _CommandError(self.ERR_NOT_SUPPORTED)
+
+    def format_value(self, data, data_type):
+        """Convert bytes read from a node to the text of a read response."""
+        if data_type in self.DATA_TYPES:
+            data_format = self.DATA_TYPES[data_type]
+            if len(data) != struct.calcsize(data_format):
+                raise _CommandError(self.ERR_NOT_PROCESSED)
+            value, = struct.unpack(data_format, data)
+            return str(int(value) if data_type == "b" else value)
+        if data_type == "vs":
+            return data.decode("utf-8", "replace")
+        if data_type == "os":
+            return data.hex()
+        return base64.b64encode(data).decode("ascii")
+
+    def _lock(self, net, node_id):
+        lock = self._locks.get((net, node_id))
+        if lock is None:
+            lock = self._locks[(net, node_id)] = asyncio.Lock()
+        return lock
+
+    def _master(self, net):
+        master = self.masters.get(self.net if net is None else net)
+        if master is None:
+            raise _CommandError(self.ERR_UNSUPPORTED_NET)
+        return master
+
+    async def read(self, node_id, index, subindex, data_type="d", net=None):
+        """
+        Read an entry of a remote node.
+
+        Fixed size types of up to 4 bytes use an expedited request with adaptive timeouts,
+        all other types a segmented upload.
+
+        :param net: The network of the node, the default network if None.
+        :return: The value as bytes.
+        """
+        master = self._master(net)
+        if data_type in self.DATA_TYPES and struct.calcsize(self.DATA_TYPES[data_type]) <= 4:
+            value = master.cache.get(node_id, index, subindex)
+            if value is not None:
+                return value
+            async with self._lock(net, node_id):
+                request = await self._run_request(master, CANopenSDORequest(node_id, index, subindex))
+            self._check_abort(request)
+            return request.result
+        if data_type not in self.DATA_TYPES and data_type not in self.STRING_TYPES:
+            raise _CommandError(self.ERR_NOT_SUPPORTED)
+        async with self._lock(net, node_id):
+            transfer = await self._run_transfer(master, CANopenSegmentedUpload(node_id, index, subindex))
+        self._check_abort(transfer)
+        return transfer.domain.getvalue()
+
+    async def write(self, node_id, index, subindex, data, net=None):
+        """Write bytes to an entry of a remote node, with a block download if they don't fit in one frame."""
+        master = self._master(net)
+        master.cache.invalidate(node_id, index, subindex)
+        async with self._lock(net, node_id):
+            if len(data) <= 4:
+                result = await self._run_request(master, CANopenSDORequest(node_id, index, subindex, data))
+            else:
+                result = await self._run_transfer(master, CANopenBlockDownload(node_id, index, subindex, data))
+        self._check_abort(result)
+
+    @staticmethod
+    def _check_abort(result):
+        if result.abort_code is not None:
+            raise _CommandError(f"0x{result.abort_code:08X}")
+
+    async def _run_request(self, master, request):
+        future = asyncio.get_running_loop().create_future()
+        request.callback = lambda done: future.done() or future.set_result(done)
+        master.submit(request)
+        if not request.done:
+            self._requests.append((master, request))
+        return await future
+
+    async def _run_transfer(self, master, transfer):
+        future = asyncio.get_running_loop().create_future()
+        transfer.callback = lambda done: future.done() or future.set_result(done)
+        master.start_transfer(transfer)
+        if not transfer.done:
+            self._transfers.append((master, transfer))
+        return await future
@@ -0,0 +1,336 @@
+import struct
+import time
+
+from .CANopenMessage import CANopenMessage
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class CANopenLSS:
+    """Layer Setting Services (CiA 305)."""
+
+    # Default COB-IDs for LSS
+    COB_ID_LSS_MASTER = 0x7E5
+    COB_ID_LSS_SLAVE = 0x7E4
+
+    # LSS command specifiers
+    CS_SWITCH_STATE_GLOBAL = 0x04
+    CS_SWITCH_STATE_SELECTIVE_VENDOR = 0x40
+    CS_SWITCH_STATE_SELECTIVE_PRODUCT = 0x41
+    CS_SWITCH_STATE_SELECTIVE_REVISION = 0x42
+    CS_SWITCH_STATE_SELECTIVE_SERIAL = 0x43
+    CS_SWITCH_STATE_SELECTIVE_RESPONSE = 0x44
+    CS_CONFIGURE_NODE_ID = 0x11
+    CS_CONFIGURE_BIT_TIMING = 0x13
+    CS_ACTIVATE_BIT_TIMING = 0x15
+    CS_STORE_CONFIGURATION = 0x17
+    CS_IDENTIFY_NON_CONFIGURED = 0x4C
+    CS_IDENTIFY_NON_CONFIGURED_RESPONSE = 0x50
+    CS_IDENTIFY_SLAVE = 0x4F
+    CS_FAST_SCAN = 0x51
+    CS_INQUIRE_VENDOR = 0x5A
+    CS_INQUIRE_PRODUCT = 0x5B
+    CS_INQUIRE_REVISION = 0x5C
+    CS_INQUIRE_SERIAL = 0x5D
+    CS_INQUIRE_NODE_ID = 0x5E
+
+    # LSS states
+    STATE_WAITING = 0x00
+    STATE_CONFIGURATION = 0x01
+
+    # Error codes of configure and store responses
+    ERROR_NONE = 0x00
+    ERROR_NOT_SUPPORTED = 0x01
+    ERROR_ACCESS = 0x02
+
+    # bitChecked value that restarts a fast scan
+    FAST_SCAN_CONFIRM = 0x80
+    # Node ID of a device that has not been configured
+    NODE_ID_UNCONFIGURED = 0xFF
+
+    # Standard bit timing table, index -> bit rate in bit/s
+    BIT_RATES = (1000000, 800000, 500000, 250000, 125000, None, 50000, 20000, 10000)
+
+
+class CANopenLSSMaster(CANopenLSS):
+    """LSS master running on top of a CANopenNode."""
+
+    def __init__(self, node, timeout=0.05):
+        """
+        :param node: The CANopenNode whose controller is used. Frames other than LSS responses
+            are handed to node.dispatch() if the node has one.
+        :param timeout: Seconds to wait for an LSS slave response.
+        """
+        self.node = node
+        self.timeout = timeout
+
+    def send_command(self, data):
+        # Several slaves may have answered the previous command; drop their stale responses
+        while True:
+            message = self.node.mcp.read_message()
+            if message is None:
+                break
+            if message.id != self.COB_ID_LSS_SLAVE and hasattr(self.node, "dispatch"):
+                self.node.dispatch(message)
+        message = CANopenMessage(self.COB_ID_LSS_MASTER)
+        message.data = struct.pack("<8s", data)
+        self.node.send(message)
+
+    def wait_response(self, command_specifier, timeout=None):
+        """
+        Wait for an LSS slave response with the given command specifier.
+
+        :return: The response data, or None on timeout.
+        """
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        while time.monotonic() < deadline:
+            message = self.node.mcp.read_message()
+            if message is None:
+                continue
+            if message.id == self.COB_ID_LSS_SLAVE and message.data[0] == command_specifier:
+                return message.data
+            if hasattr(self.node, "dispatch"):
+                self.node.dispatch(message)
+        return None
+
+    def request(self, command_specifier, data=b"", timeout=None):
+        self.send_command(bytes([command_specifier]) + data)
+        return self.wait_response(command_specifier, timeout)
+
+    def switch_state_global(self, state):
+        """Switch all LSS slaves to STATE_WAITING or STATE_CONFIGURATION."""
+        self.send_command(bytes([self.CS_SWITCH_STATE_GLOBAL, state]))
+
+    def switch_state_selective(self, vendor_id, product_code, revision, serial):
+        """
+        Switch the LSS slave with the given identity to configuration state.
+
+        :return: True if the slave confirmed.
+        """
+        for position, value in enumerate((vendor_id, product_code, revision, serial)):
+            self.send_command(struct.pack("<BI", self.CS_SWITCH_STATE_SELECTIVE_VENDOR + position, value))
+        response = self.wait_response(self.CS_SWITCH_STATE_SELECTIVE_RESPONSE)
+        return response is not None
+
+    def _configure(self, command_specifier, data):
+        response = self.request(command_specifier, data)
+        if response is None:
+            raise Exception("No response from LSS slave.")
+        if response[1] != self.ERROR_NONE:
+            raise Exception(f"LSS slave rejected command 0x{command_specifier:02X} with error {response[1]}.")
+
+    def configure_node_id(self, node_id):
+        """Set the pending node ID of the slave in configuration state."""
+        if not 1 <= node_id <= 127 and node_id != self.NODE_ID_UNCONFIGURED:
+            raise ValueError(f"Invalid node ID: {node_id}")
+        self._configure(self.CS_CONFIGURE_NODE_ID, bytes([node_id]))
+
+    def configure_bit_timing(self, bit_rate):
+        """Set the pending bit rate of the slave in configuration state, in bit/s."""
+        if bit_rate not in self.BIT_RATES:
+            raise ValueError(f"Unsupported bit rate: {bit_rate}")
+        self._configure(self.CS_CONFIGURE_BIT_TIMING, bytes([0, self.BIT_RATES.index(bit_rate)]))
+
+    def activate_bit_timing(self, switch_delay_ms):
+        """Make all slaves switch to their pending bit rate after the switch delay."""
+        self.send_command(struct.pack("<BH", self.CS_ACTIVATE_BIT_TIMING, switch_delay_ms))
+
+    def store_configuration(self):
+        """Make the slave in configuration state store its node ID and bit timing."""
+        self._configure(self.CS_STORE_CONFIGURATION, b"")
+
+    def inquire_identity(self):
+        """
+        Read the identity of the slave in configuration state.
+
+        :return: Tuple of (vendor ID, product code, revision, serial number).
+        """
+        identity = []
+        for command in (self.CS_INQUIRE_VENDOR, self.CS_INQUIRE_PRODUCT,
+                        self.CS_INQUIRE_REVISION, self.CS_INQUIRE_SERIAL):
+            response = self.request(command)
+            if response is None:
+                raise Exception("No response from LSS slave.")
+            identity.append(struct.unpack("<I", bytes(response[1:5]))[0])
+        return tuple(identity)
+
+    def inquire_node_id(self):
+        response = self.request(self.CS_INQUIRE_NODE_ID)
+        if response is None:
+            raise Exception("No response from LSS slave.")
+        return response[1]
+
+    def identify_non_configured(self):
+        """Return True if any slave without a valid node ID is on the bus."""
+        self.send_command(bytes([self.CS_IDENTIFY_NON_CONFIGURED]))
+        return self.wait_response(self.CS_IDENTIFY_NON_CONFIGURED_RESPONSE) is not None
+
+    def _fast_scan_step(self, id_number, bit_checked, lss_sub, lss_next):
+        self.send_command(struct.pack("<BIBBB", self.CS_FAST_SCAN, id_number, bit_checked, lss_sub, lss_next))
+        return self.wait_response(self.CS_IDENTIFY_SLAVE) is not None
+
+    def fast_scan(self):
+        """
+        Find one unconfigured slave by binary search over its 128-bit identity.
+
+        Each of the four identity values is determined bit by bit: a bit is kept at 0 if any
+        unconfigured slave answers, otherwise it is set to 1. The found slave ends up in
+        configuration state.
+
+        :return: Tuple of (vendor ID, product code, revision, serial number), or None if no
+            unconfigured slave answered.
+        """
+        if not self._fast_scan_step(0, self.FAST_SCAN_CONFIRM, 0, 0):
+            return None
+        identity = [0, 0, 0, 0]
+        for lss_sub in range(4):
+            for bit in range(31, -1, -1):
+                if not self._fast_scan_step(identity[lss_sub], bit, lss_sub, lss_sub):
+                    identity[lss_sub] |= 1 << bit
+            lss_next = (lss_sub + 1) & 0x03
+            if not self._fast_scan_step(identity[lss_sub], 0, lss_sub, lss_next):
+                logger.warning(f"LSS fast scan lost the slave at identity value {lss_sub}.")
+                return None
+        return tuple(identity)
+
+    def assign_node_ids(self, node_ids, store=True):
+        """
+        Find all unconfigured slaves with fast scan and give each the next free node ID.
+
+        :param node_ids: Iterable of node IDs to hand out in order.
+        :param store: Make each slave store its new node ID.
+        :return: Dict mapping the assigned node ID to the slave identity.
+        """
+        assigned = {}
+        for node_id in node_ids:
+            identity = self.fast_scan()
+            if identity is None:
+                break
+            self.configure_node_id(node_id)
+            if store:
+                self.store_configuration()
+            self.switch_state_global(self.STATE_WAITING)
+            assigned[node_id] = identity
+        return assigned
+
+
+class CANopenLSSSlave(CANopenLSS):
+    """LSS slave attached to a CANopenNode."""
+
+    def __init__(self, node, vendor_id, product_code, revision, serial, on_store=None, on_bit_timing=None):
+        """
+        :param node: The CANopenNode whose node ID is configured.
+        :param vendor_id: Vendor ID of the identity object (0x1018:1).
+        :param product_code: Product code (0x1018:2).
+        :param revision: Revision number (0x1018:3).
+        :param serial: Serial number (0x1018:4).
+        :param on_store: Callable(node_id, bit_rate) that persists the configuration, returns True on success.
+        :param on_bit_timing: Callable(bit_rate, switch_delay_ms) that switches the controller bit rate.
+        """
+        self.node = node
+        self.identity = (vendor_id, product_code, revision, serial)
+        self.on_store = on_store
+        self.on_bit_timing = on_bit_timing
+        self.state = self.STATE_WAITING
+        self.pending_node_id = node.node_id
+        self.pending_bit_rate = None
+        self._selective = 0  # Number of matched selective switch values
+        self._fast_scan_sub = 0
+
+    @property
+    def configured(self):
+        return self.node.node_id != self.NODE_ID_UNCONFIGURED
+
+    def respond(self, data):
+        message = CANopenMessage(self.COB_ID_LSS_SLAVE)
+        message.data = struct.pack("<8s", data)
+        self.node.send(message)
+
+    def process(self, message):
+        """
+        Handle a frame from the LSS master.
+
+        :return: True if the frame was an LSS request.
+        """
+        if message.id != self.COB_ID_LSS_MASTER:
+            return False
+        data = message.data
+        command = data[0]
+        if command == self.CS_SWITCH_STATE_GLOBAL:
+            self._switch_state(data[1])
+        elif self.CS_SWITCH_STATE_SELECTIVE_VENDOR <= command <= self.CS_SWITCH_STATE_SELECTIVE_SERIAL:
+            self._switch_state_selective(command - self.CS_SWITCH_STATE_SELECTIVE_VENDOR, data)
+        elif command == self.CS_FAST_SCAN:
+            self._fast_scan(data)
+        elif command == self.CS_IDENTIFY_NON_CONFIGURED:
+            if not self.configured:
+                self.respond(bytes([self.CS_IDENTIFY_NON_CONFIGURED_RESPONSE]))
+        elif self.state != self.STATE_CONFIGURATION:
+            pass
+        elif command == self.CS_CONFIGURE_NODE_ID:
+            valid = 1 <= data[1] <= 127 or data[1] == self.NODE_ID_UNCONFIGURED
+            if valid:
+                self.pending_node_id = data[1]
+            self.respond(bytes([command, self.ERROR_NONE if valid else self.ERROR_NOT_SUPPORTED]))
+        elif command == self.CS_CONFIGURE_BIT_TIMING:
+            valid = data[1] == 0 and data[2] < len(self.BIT_RATES) and self.BIT_RATES[data[2]] is not None
+            if valid:
+                self.pending_bit_rate = self.BIT_RATES[data[2]]
+            self.respond(bytes([command, self.ERROR_NONE if valid else self.ERROR_NOT_SUPPORTED]))
+        elif command == self.CS_ACTIVATE_BIT_TIMING:
+            if self.on_bit_timing and self.pending_bit_rate:
+                self.on_bit_timing(self.pending_bit_rate, struct.unpack("<H", bytes(data[1:3]))[0])
+        elif command == self.CS_STORE_CONFIGURATION:
+            if self.on_store is None:
+                error = self.ERROR_NOT_SUPPORTED
+            elif self.on_store(self.pending_node_id, self.pending_bit_rate):
+                error = self.ERROR_NONE
+            else:
+                error = self.ERROR_ACCESS
+            self.respond(bytes([command, error]))
+        elif self.CS_INQUIRE_VENDOR <= command <= self.CS_INQUIRE_SERIAL:
+            self.respond(struct.pack("<BI", command, self.identity[command - self.CS_INQUIRE_VENDOR]))
+        elif command == self.CS_INQUIRE_NODE_ID:
+            self.respond(bytes([command, self.node.node_id]))
+        return True
+
+    def _switch_state(self, state):
+        if self.state == self.STATE_CONFIGURATION and state == self.STATE_WAITING:
+            if self.pending_node_id != self.node.node_id:
+                # The new node ID becomes active like after an NMT reset communication
+                logger.info(f"LSS node ID changed from {self.node.node_id} to {self.pending_node_id}.")
+                self.node.node_id = self.pending_node_id
+                self.node.nmt.node_id = self.pending_node_id
+        self.state = state
+        self._selective = 0
+        self._fast_scan_sub = 0
+
+    def _switch_state_selective(self, position, data):
+        if position == self._selective and struct.unpack("<I", bytes(data[1:5]))[0] == self.identity[position]:
+            self._selective += 1
+        else:
+            self._selective = 0
+        if self._selective == 4:
+            self._selective = 0
+            self.state = self.STATE_CONFIGURATION
+            self.respond(bytes([self.CS_SWITCH_STATE_SELECTIVE_RESPONSE]))
+
+    def _fast_scan(self, data):
+        if self.configured or self.state != self.STATE_WAITING:
+            return
+        id_number, bit_checked, lss_sub, lss_next = struct.unpack("<IBBB", bytes(data[1:8]))
+        if bit_checked == self.FAST_SCAN_CONFIRM:
+            self._fast_scan_sub = 0
+            self.respond(bytes([self.CS_IDENTIFY_SLAVE]))
+            return
+        if lss_sub != self._fast_scan_sub or bit_checked > 31:
+            return
+        if (self.identity[lss_sub] ^ id_number) >> bit_checked:
+            return
+        if bit_checked == 0:
+            if lss_next < lss_sub:
+                # All four identity values matched
+                self.state = self.STATE_CONFIGURATION
+            self._fast_scan_sub = lss_next
+        self.respond(bytes([self.CS_IDENTIFY_SLAVE]))
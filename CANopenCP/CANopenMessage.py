@@ -1,4 +1,5 @@
 import struct
+import time
 from adafruit_mcp2515 import Message
 
 class CANopenMessage(Message):
@@ -21,13 +22,70 @@ class CANopenMessage(Message):
     COB_ID_SDO_RX = 0x600
     COB_ID_HEARTBEAT = 0x700
 
-    def __init__(self, cob_id, data=bytes(), extended=False):
+    # Maximum payload of classic CAN and CAN FD frames
+    MAX_DATA_LENGTH = 8
+    FD_MAX_DATA_LENGTH = 64
+    # Payload length of every CAN FD DLC (data length code) 0-15
+    FD_DLC_LENGTHS = (0, 1, 2, 3, 4, 5, 6, 7, 8, 12, 16, 20, 24, 32, 48, 64)
+
+    # True for CAN FD frames (FDF bit), which carry up to 64 bytes
+    fd = False
+    # Receive time in time.monotonic_ns(), set by stamp()
+    timestamp_ns = None
+
+    def __init__(self, cob_id, data=bytes(), extended=False, fd=False):
         """Initialize a CANopen message."""
+        self.fd = fd  # Set first, as it decides the maximum length of the data
         super().__init__(cob_id, data)  # Use the COB_ID as the CAN ID.
         self.extended = extended  # Allows setting extended IDs if needed.
         self.cob_id = cob_id
         self.data = data
 
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, new_data):
+        # Validated here rather than through Message.data, as CircuitPython properties have no fset
+        kind = "CAN FD" if self.fd else "CAN"
+        if not isinstance(new_data, (bytes, bytearray)):
+            raise AttributeError(f"{kind} message data must be of type bytes or bytearray")
+        max_length = self.FD_MAX_DATA_LENGTH if self.fd else self.MAX_DATA_LENGTH
+        if len(new_data) > max_length:
+            raise AttributeError(f"{kind} message data must be of length {max_length} or less")
+        self._data = bytearray(new_data)
+
+    @staticmethod
+    def stamp(message, controller=None):
+        """
+        Record the receive time of a frame in message.timestamp_ns, in time.monotonic_ns().
+
+        A controller whose hardware_timestamps attribute is True stamps frames itself when they
+        arrive, and its timestamps are kept; otherwise the frame is stamped now, when it is
+        read from the controller. Call this as soon as a frame is read.
+        """
+        if not getattr(controller, "hardware_timestamps", False) or getattr(message, "timestamp_ns", None) is None:
+            message.timestamp_ns = time.monotonic_ns()
+
+    @classmethod
+    def length_to_dlc(cls, length):
+        """Return the smallest CAN FD DLC whose payload holds length bytes."""
+        for dlc, dlc_length in enumerate(cls.FD_DLC_LENGTHS):
+            if dlc_length >= length:
+                return dlc
+        raise ValueError(f"{length} bytes don't fit in a CAN FD frame.")
+
+    @classmethod
+    def dlc_to_length(cls, dlc):
+        """Return the payload length of a CAN FD DLC."""
+        return cls.FD_DLC_LENGTHS[dlc]
+
+    @classmethod
+    def fd_padded_length(cls, length):
+        """Return the length of length bytes of data padded to the next CAN FD payload size."""
+        return cls.FD_DLC_LENGTHS[cls.length_to_dlc(length)]
+
     def set_data(self, data_format, *values):
         """
         Set the data for the message based on a format string and values.
@@ -35,7 +93,11 @@ class CANopenMessage(Message):
         :param data_format: A format string as used by the struct module to pack the data.
         :param values: Values to pack into the message data.
         """
-        self.data = struct.pack(data_format, *values)
+        if len(self.data) == struct.calcsize(data_format):
+            # Pack in place, so a message reused in a loop doesn't allocate
+            struct.pack_into(data_format, self.data, 0, *values)
+        else:
+            self.data = struct.pack(data_format, *values)
 
     def get_data(self, data_format):
         """
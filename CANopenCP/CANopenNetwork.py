@@ -0,0 +1,139 @@
+import time
+
+from .CANopenMessage import CANopenMessage
+from .CANopenNode import CANopenMasterNode
+
+
+class CANopenNetwork:
+    """
+    Several CAN buses managed from one loop.
+
+    Every bus has its own CANopenMasterNode, and thereby its own node-ID namespace, cache and
+    SDO client. poll() drains all interfaces round-robin in batches, so a busy bus can't starve
+    the others, and forwards frames along the configured routes as soon as they are read.
+    While a master waits for an SDO response, it keeps servicing the other buses too.
+    """
+
+    def __init__(self, batch_size=16, sync_period=0.0):
+        """
+        :param batch_size: Frames read from one bus before moving on to the next.
+        :param sync_period: Period in seconds of a SYNC sent on all buses at once by poll(), 0 to disable.
+        """
+        self.batch_size = batch_size
+        self.sync_period = sync_period
+        # net -> CANopenMasterNode
+        self.buses = {}
+        # (net, COB-ID) -> list of (net, COB-ID) the frame is forwarded to
+        self.routes = {}
+        self._masters = []
+        self._next_sync = None
+
+    def add_bus(self, net, mcp, node_id=1, master=None):
+        """
+        Add a bus.
+
+        :param net: Network number of the bus.
+        :param mcp: The CAN interface of the bus.
+        :param node_id: Node ID of the master on this bus.
+        :param master: An existing CANopenMasterNode to use instead of creating one.
+        :return: The master of the bus.
+        """
+        if net in self.buses:
+            raise Exception(f"Network {net} already exists.")
+        if master is None:
+            master = CANopenMasterNode(node_id, mcp)
+        master.network = self
+        self.buses[net] = master
+        self._masters.append(master)
+        return master
+
+    def master(self, net):
+        master = self.buses.get(net)
+        if master is None:
+            raise Exception(f"Unknown network {net}.")
+        return master
+
+    def add_route(self, source_net, cob_id, target_net, target_cob_id=None):
+        """
+        Forward the frames with a COB-ID received on one bus to another bus.
+
+        The handler already registered for the COB-ID on the source bus keeps receiving the
+        frames, so register it before adding the route.
+
+        :param target_cob_id: COB-ID of the forwarded frame, the original one if None.
+        """
+        self.master(target_net)
+        source = self.master(source_net)
+        targets = self.routes.get((source_net, cob_id))
+        if targets is None:
+            targets = self.routes[(source_net, cob_id)] = []
+            previous = None
+
+            def forward(message):
+                self._forward(message, targets)
+                if previous is not None:
+                    previous(message)
+
+            previous = source.add_handler(cob_id, forward)
+        targets.append((target_net, cob_id if target_cob_id is None else target_cob_id))
+
+    def bridge(self, net_a, net_b, cob_ids):
+        """Forward the given COB-IDs in both directions between two buses."""
+        for cob_id in cob_ids:
+            self.add_route(net_a, cob_id, net_b)
+            self.add_route(net_b, cob_id, net_a)
+
+    def _forward(self, message, targets):
+        for net, cob_id in targets:
+            if cob_id == message.id:
+                self.buses[net].send(message)
+            else:
+                self.buses[net].send(CANopenMessage(cob_id, message.data))
+
+    def poll(self):
+        """
+        Drain all buses and dispatch their frames, and send the SYNC when it is due.
+
+        :return: The number of frames processed.
+        """
+        if self.sync_period:
+            now = time.monotonic()
+            if self._next_sync is None or now >= self._next_sync:
+                self.send_sync()
+                if self._next_sync is None:
+                    self._next_sync = now + self.sync_period
+                else:
+                    # Skip the periods missed entirely, but stay on the grid
+                    self._next_sync += self.sync_period * ((now - self._next_sync) // self.sync_period + 1)
+        total = 0
+        while True:
+            count = 0
+            for master in self._masters:
+                count += master.receive(self.batch_size)
+            if count == 0:
+                return total
+            total += count
+
+    def send_sync(self, nets=None):
+        """Send a SYNC on several buses back-to-back, all of them by default."""
+        for net in self.buses if nets is None else nets:
+            self.buses[net].send(CANopenMessage(CANopenMessage.COB_ID_SYNC))
+
+    async def run(self, interval=0.001):
+        """Poll all buses forever from an asyncio task."""
+        # Imported here so that the network can be used without asyncio
+        import asyncio
+        while True:
+            self.poll()
+            await asyncio.sleep(interval)
+
+    def read(self, net, node_id, index, subindex, timeout=None):
+        return self.master(net).read(node_id, index, subindex, timeout)
+
+    def write(self, net, node_id, index, subindex, data, timeout=None):
+        self.master(net).write(node_id, index, subindex, data, timeout)
+
+    def send_nmt(self, command, node_id=0, net=None):
+        """Send an NMT command on one bus, or on all buses if net is None."""
+        for master in self._masters if net is None else [self.master(net)]:
+            master.send_nmt(command, node_id)
@@ -1,10 +1,19 @@
 import struct
+import time
 
 import adafruit_mcp2515
 from adafruit_mcp2515 import Message
 
 from . import CANopenClientSDO, CANopenSDO, CANopenServerSDO
+from .CANopenCache import CANopenObjectCache
+from .CANopenDCF import CANopenDCF
+from .CANopenDomain import CANopenDomain
 from .CANopenMessage import CANopenMessage
+from .CANopenObjectDictionary import CANopenObjectDictionary
+from .CANopenPDO import CANopenMPDO
+from .CANopenTimeout import CANopenCircuitBreaker, CANopenRTTEstimator
+from .CANopenSDO import CANopenBlockDownload, CANopenSDORequest, CANopenSegmentedUpload, crc16, to_domain
+from .CANopenUSDO import CANopenUSDODownload, CANopenUSDOUpload
 from .CANopenNMT import CANopenNMT
 from States import CANopenSDOStates as State
 
@@ -22,10 +31,60 @@ class CANopenNode:
         self.nmt = CANopenNMT(node_id)
         self.current_state = State.CO_SDO_ST_IDLE
         self.on_transfer_complete = on_transfer_complete
+        # COB-ID -> CANopenEventTPDO deciding whether a TPDO goes on the bus
+        self.event_tpdos = {}
+        # COB-ID -> CANopenReceivePDO applying received RPDOs to the object dictionary
+        self.rpdos = {}
+        # Optional CANopenBusLoad fed with every transmitted and received frame
+        self.bus_load = None
+        # Stamp received frames with time.monotonic_ns() in read_frame(). Off by default, as the stamp is
+        # an int allocated for every frame; turned on by add_rpdo() for consumers that need the stamps
+        self.timestamps = False
+        # Receive time in time.monotonic_ns() of the last frame read from the controller, if it was stamped
+        self.last_timestamp_ns = None
+
+    def read_frame(self):
+        """
+        Read a frame from the controller, stamping its receive time if timestamps is set (see CANopenMessage.stamp()).
+
+        Frames stamped by a controller with hardware timestamps keep their stamps either way.
+
+        :return: The message, or None if no frame is available.
+        """
+        message = self.mcp.read_message()
+        if message is not None:
+            if self.timestamps:
+                CANopenMessage.stamp(message, self.mcp)
+            self.last_timestamp_ns = getattr(message, "timestamp_ns", None)
+        return message
 
     def send(self, message: CANopenMessage):
-        mcp_message = adafruit_mcp2515.Message(message.id, message.data)
-        self.mcp.send(mcp_message)
+        """
+        Send a message, unless it is an event-driven TPDO whose payload need not be sent.
+
+        :return: True if the message was put on the bus.
+        """
+        event_tpdo = self.event_tpdos.get(message.id)
+        if event_tpdo is not None and not event_tpdo.should_send(message.data):
+            return False
+        if not isinstance(message, Message):
+            message = Message(message.id, message.data)
+        self.mcp.send(message)
+        if self.bus_load is not None:
+            self.bus_load.add_frame(len(message.data))
+        return True
+
+    def add_event_tpdo(self, event_tpdo):
+        """Register a CANopenEventTPDO so that TPDOs sent on its COB-ID are only transmitted on change."""
+        self.event_tpdos[event_tpdo.cob_id] = event_tpdo
+        return event_tpdo
+
+    def add_rpdo(self, rpdo):
+        """Register a CANopenReceivePDO applied to every frame received on its COB-ID."""
+        self.rpdos[rpdo.cob_id] = rpdo
+        if getattr(rpdo, "needs_timestamps", False):
+            self.timestamps = True
+        return rpdo
 
     def initiate_block_transfer(self, direction, size):
         """
@@ -49,15 +108,21 @@ class CANopenNode:
         """
         Sends a block of data.
 
-        :param data: The block of data to be sent.
+        :param data: The block of data to be sent: bytes, a CANopenDomain or a binary file object.
         """
         try:
-            # Segment the data if needed and send it
-            segments = [data[i:i + self.BLOCK_SIZE] for i in range(0, len(data), self.BLOCK_SIZE)]
-
-            for segment in segments:
+            # Read the data one segment at a time into a reusable buffer and send it
+            domain = to_domain(data)
+            buffer = bytearray(self.BLOCK_SIZE)
+            segment = memoryview(buffer)
+            offset = 0
+            while True:
+                count = domain.readinto(offset, buffer)
+                if count == 0:
+                    break
+                offset += count
                 # Send each segment
-                self.send_segment(segment)
+                self.send_segment(segment[:count])
                 if not self.wait_for_ack():
                     raise Exception("Acknowledgment not received for segment.")
         except Exception as e:
@@ -70,14 +135,17 @@ class CANopenNode:
         self.mcp.send(segment, command=State.CO_SDO_ST_UPLOAD_SEGMENT_REQ.value)
 
     def wait_for_ack(self, timeout=2.0):
-        """Waits for an acknowledgment from the server."""
-        response = self.mcp.read_message()
-
-        # Check the response for acknowledgment (modify as per actual protocol)
-        if response == State.CO_SDO_ST_UPLOAD_SEGMENT_RSP.value:
-            return True
-        else:
-            return False
+        """Waits for an acknowledgment from the server, for at most timeout seconds."""
+        deadline = time.monotonic() + timeout
+        while True:
+            response = self.mcp.read_message()
+            if response is not None:
+                # Check the response for acknowledgment (modify as per actual protocol)
+                data = getattr(response, "data", None)
+                return (response == State.CO_SDO_ST_UPLOAD_SEGMENT_RSP.value
+                        or bool(data) and data[0] == State.CO_SDO_ST_UPLOAD_SEGMENT_RSP.value)
+            if time.monotonic() >= deadline:
+                return False
 
     def block_transfer(self, direction, data):
         """
@@ -105,17 +173,24 @@ class CANopenNode:
         if self.on_transfer_complete:
             self.on_transfer_complete(direction)
 
-    def send_with_retry(self, message, retries=3, timeout=2.0):
+    def send_with_retry(self, message, retries=3, timeout=2.0, max_timeout=None):
+        """
+        Send a message until it is acknowledged, doubling the timeout after every attempt.
+
+        :param timeout: Timeout of the first attempt in seconds.
+        :param max_timeout: Cap of the timeout in seconds, defaults to 8 times timeout.
+        """
+        max_timeout = 8 * timeout if max_timeout is None else max_timeout
         for attempt in range(retries):
             self.mcp.send(message)
-            if self.wait_for_ack(timeout):
+            if self.wait_for_ack(min(max_timeout, timeout * (2 ** attempt))):
                 return True
-            # Log the failed attempt or sleep for a short duration before retrying
+            logger.warning(f"No acknowledgment on attempt {attempt + 1} of {retries}.")
         raise Exception("Failed to send message after multiple retries.")
 
     def receive_segment(self):
-        """Receives a single segment of data."""
-        message = self.mcp.read_message()
+        """Receives a single segment of data; its receive time is kept in last_timestamp_ns."""
+        message = self.read_frame()
         if message:
             # parse the message and return the data
             return message.data
@@ -123,14 +198,24 @@ class CANopenNode:
             return None
 
 
-    def receive_data_block(self):
-        data = bytearray()
+    def receive_data_block(self, sink=None):
+        """
+        Receive segments until none is available.
+
+        :param sink: CANopenDomain or binary file object the segments are written to as they arrive.
+        :return: The received data, or the number of bytes written to the sink.
+        """
+        domain = CANopenDomain() if sink is None else to_domain(sink)
+        offset = 0
         while True:
             segment = self.receive_segment()
             if segment is None:
                 break
-            data.extend(segment)
-        return data
+            domain.write(offset, segment)
+            offset += len(segment)
+        if sink is None:
+            return bytearray(domain.storage)
+        return offset
 
     def recover_from_error(self):
         """
@@ -146,9 +231,313 @@ class CANopenNode:
 
 
 class CANopenMasterNode(CANopenNode):
-    def __init__(self, node_id, mcp):
+    # Entries read from every node by scan()
+    IDENTITY_ENTRIES = ((0x1000, 0), (0x1018, 1), (0x1018, 2), (0x1018, 3), (0x1018, 4))
+    IDENTITY_NAMES = ("device_type", "vendor_id", "product_code", "revision", "serial")
+
+    def __init__(self, node_id, mcp, cache_size=256):
         super().__init__(node_id, mcp)
         self.state = State.CO_SDO_ST_IDLE
+        # Cache of values read from remote nodes
+        self.cache = CANopenObjectCache(cache_size)
+        # (node_id, index, subindex) -> list of outstanding CANopenSDORequest
+        self._pending = {}
+        # node_id -> active block transfer, which owns the SDO responses of that node
+        self._transfers = {}
+        # COB-ID -> callable(message) for frames not consumed by the SDO client
+        self._handlers = {}
+        # node_id -> (NMT state, time.monotonic()) of the last boot-up or heartbeat frame
+        self.heartbeats = {}
+        # node_id -> time.monotonic() of the last boot-up frame, kept when heartbeats follow it
+        self.boot_ups = {}
+        # node_id -> CANopenRTTEstimator deriving SDO timeouts from measured round trips
+        self.rtt = {}
+        # Round trips of all nodes, giving the initial timeout of nodes not measured yet
+        self.network_rtt = CANopenRTTEstimator()
+        # node_id -> CANopenCircuitBreaker failing requests to unresponsive nodes fast
+        self.breakers = {}
+        # Retries of an SDO request with adaptive timeouts before it fails
+        self.sdo_retries = 3
+        # CANopenNetwork this master's bus belongs to; poll() then services all buses of the network
+        self.network = None
+
+    def add_handler(self, cob_id, handler):
+        """
+        Register a callable(message) for frames received with the given COB-ID.
+
+        :return: The handler it replaces, or None.
+        """
+        previous = self._handlers.get(cob_id)
+        self._handlers[cob_id] = handler
+        return previous
+
+    def remove_handler(self, cob_id):
+        self._handlers.pop(cob_id, None)
+
+    def get_rtt(self, node_id):
+        estimator = self.rtt.get(node_id)
+        if estimator is None:
+            estimator = self.rtt[node_id] = CANopenRTTEstimator(initial_timeout=self.network_rtt.rto)
+        return estimator
+
+    def get_breaker(self, node_id):
+        breaker = self.breakers.get(node_id)
+        if breaker is None:
+            breaker = self.breakers[node_id] = CANopenCircuitBreaker()
+        return breaker
+
+    def submit(self, request: CANopenSDORequest, fail_fast=True):
+        """
+        Send an SDO request without waiting for the response.
+
+        The request is completed by poll() once the response arrives.
+
+        :param fail_fast: Complete the request at once with a timeout abort, without sending it,
+            while the circuit breaker of the node is open.
+        """
+        if fail_fast and not self.get_breaker(request.node_id).allow():
+            request.complete(abort_code=CANopenSDO.ABORT_TIMEOUT)
+            return request
+        self._pending.setdefault(request.key, []).append(request)
+        self._send_request(request)
+        return request
+
+    def _send_request(self, request):
+        request.attempts += 1
+        request.sent_time = time.monotonic()
+        self.send(request.to_message())
+
+    def poll(self):
+        """
+        Drain all frames available from the controller, or from all buses of the network, and dispatch them.
+
+        :return: The number of frames processed.
+        """
+        if self.network is not None:
+            return self.network.poll()
+        return self.receive()
+
+    def receive(self, max_frames=None):
+        """
+        Dispatch the frames available from this master's controller.
+
+        :param max_frames: Maximum number of frames to process, None to drain the controller.
+        :return: The number of frames processed.
+        """
+        count = 0
+        while max_frames is None or count < max_frames:
+            message = self.read_frame()
+            if message is None:
+                return count
+            if self.bus_load is not None:
+                self.bus_load.add_frame(len(message.data))
+            self.dispatch(message)
+            count += 1
+        return count
+
+    def dispatch(self, message):
+        """Route a received frame to the SDO client, the cache or a registered handler."""
+        cob_id = message.id
+        if CANopenSDO.COB_ID_SDO_TX < cob_id <= CANopenSDO.COB_ID_SDO_TX + 0x7F and len(message.data) >= 4:
+            transfer = self._transfers.get(cob_id - CANopenSDO.COB_ID_SDO_TX)
+            if transfer is not None:
+                transfer.process_response(message.data)
+                if transfer.done:
+                    if transfer.abort_code is None:
+                        self.get_breaker(transfer.node_id).record_success()
+                    if self._transfers.get(transfer.node_id) is transfer:
+                        del self._transfers[transfer.node_id]
+                return
+            index, subindex = struct.unpack("<HB", bytes(message.data[1:4]))
+            requests = self._pending.get((cob_id - CANopenSDO.COB_ID_SDO_TX, index, subindex))
+            if requests:
+                request = requests.pop(0)
+                if not requests:
+                    del self._pending[request.key]
+                if request.attempts == 1:
+                    # Only unambiguous round trips are measured (Karn's algorithm)
+                    rtt = time.monotonic() - request.sent_time
+                    self.get_rtt(request.node_id).sample(rtt)
+                    self.network_rtt.sample(rtt)
+                self.get_breaker(request.node_id).record_success()
+                request.process_response(message.data)
+                if request.is_upload and request.result is not None:
+                    self.cache.put(request.node_id, index, subindex, request.result)
+                return
+        elif CANopenMessage.COB_ID_PDO1_TX <= cob_id < CANopenMessage.COB_ID_SDO_TX:
+            self.cache.invalidate_pdo(cob_id)
+            rpdo = self.rpdos.get(cob_id)
+            if rpdo is not None:
+                rpdo.process(message)
+        elif CANopenMessage.COB_ID_HEARTBEAT < cob_id <= CANopenMessage.COB_ID_HEARTBEAT + 0x7F and message.data:
+            state = message.data[0] & 0x7F
+            now = time.monotonic()
+            self.heartbeats[cob_id - CANopenMessage.COB_ID_HEARTBEAT] = (state, now)
+            if state == CANopenNMT.STATE_INITIALIZING:
+                self.boot_ups[cob_id - CANopenMessage.COB_ID_HEARTBEAT] = now
+        handler = self._handlers.get(cob_id)
+        if handler:
+            handler(message)
+
+    def wait(self, requests, timeout=None):
+        """
+        Poll the bus until all requests are done.
+
+        With a timeout, all requests share one deadline. Without, every request gets the
+        timeout measured for its node and is resent with exponential backoff up to sdo_retries
+        times. Either way, requests that time out count against the node's circuit breaker.
+        Requests that fail are completed with an SDO timeout abort.
+
+        :param timeout: Shared deadline in seconds, or None for adaptive timeouts.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while any(not request.done for request in requests):
+            now = time.monotonic()
+            if deadline is not None:
+                if now >= deadline:
+                    # One failure per node, as a burst of requests to an absent node is one failure
+                    failed = set()
+                    for request in requests:
+                        if not request.done:
+                            self.cancel(request)
+                            failed.add(request.node_id)
+                            request.complete(abort_code=CANopenSDO.ABORT_TIMEOUT)
+                    for node_id in failed:
+                        self.get_breaker(node_id).record_failure(now)
+                    break
+            else:
+                for request in requests:
+                    self.check_request(request, now)
+            self.poll()
+        return requests
+
+    def check_request(self, request, now):
+        """
+        Resend a request whose adaptive timeout expired, or fail it once its retries are used up.
+
+        :param now: The current time.monotonic().
+        """
+        if request.done or request.sent_time is None:
+            return
+        if now - request.sent_time < self.get_rtt(request.node_id).timeout(request.attempts - 1):
+            return
+        if request.attempts <= self.sdo_retries:
+            self._send_request(request)
+        else:
+            self.cancel(request)
+            self.get_breaker(request.node_id).record_failure(now)
+            request.complete(abort_code=CANopenSDO.ABORT_TIMEOUT)
+
+    def cancel(self, request):
+        """Forget an outstanding request, e.g. after it timed out."""
+        requests = self._pending.get(request.key)
+        if requests and request in requests:
+            requests.remove(request)
+            if not requests:
+                del self._pending[request.key]
+
+    def send_nmt(self, command, node_id=0):
+        """
+        Send an NMT command.
+
+        :param command: One of the CANopenNMT.CMD_* commands.
+        :param node_id: The addressed node, or 0 for all nodes.
+        """
+        self.send(CANopenMessage(CANopenMessage.COB_ID_NMT, bytes([command, node_id])))
+
+    def read(self, node_id, index, subindex, timeout=None):
+        """
+        Read an object dictionary entry of a remote node, served from the cache when valid.
+
+        :return: The value as bytes.
+        """
+        value = self.cache.get(node_id, index, subindex)
+        if value is not None:
+            return value
+        request = self.submit(CANopenSDORequest(node_id, index, subindex))
+        self.wait([request], timeout)
+        if request.abort_code is not None:
+            raise Exception(f"SDO read of 0x{index:04X}:{subindex} from node {node_id} "
+                            f"aborted with code 0x{request.abort_code:08X}")
+        return request.result
+
+    def read_many(self, entries, timeout=None):
+        """
+        Read many entries, sending all cache misses back-to-back before collecting responses.
+
+        :param entries: Iterable of (node_id, index, subindex) tuples.
+        :param timeout: Shared deadline in seconds for all cache misses, or None for adaptive timeouts.
+        :return: Dict mapping each entry to its value, or None if the read failed.
+        """
+        results = {}
+        requests = []
+        for key in entries:
+            value = self.cache.get(*key)
+            if value is None:
+                requests.append(self.submit(CANopenSDORequest(*key)))
+            results[key] = value
+        self.wait(requests, timeout)
+        for request in requests:
+            if request.abort_code is not None:
+                logger.warning(f"SDO read of 0x{request.index:04X}:{request.subindex} from node "
+                               f"{request.node_id} aborted with code 0x{request.abort_code:08X}")
+            results[request.key] = request.result
+        return results
+
+    def scan(self, timeout=0.5, node_ids=range(1, 128)):
+        """
+        Find the nodes on the network.
+
+        Upload requests for the device type (0x1000) and identity (0x1018) are sent to every
+        node ID in one burst. Responses, including aborts, and boot-up or heartbeat frames
+        are collected until a single shared deadline.
+
+        :param timeout: Seconds to collect responses after the burst was sent.
+        :param node_ids: Node IDs to probe.
+        :return: Dict mapping each found node ID to a dict with device_type, vendor_id,
+            product_code, revision and serial, each an int or None if it could not be read.
+        """
+        start = time.monotonic()
+        requests = []
+        for node_id in node_ids:
+            for index, subindex in self.IDENTITY_ENTRIES:
+                requests.append(self.submit(CANopenSDORequest(node_id, index, subindex), fail_fast=False))
+            # Drain responses while sending so small controller receive buffers don't overflow
+            self.poll()
+        self.wait(requests, timeout)
+
+        found = {}
+        for request in requests:
+            if request.abort_code == CANopenSDO.ABORT_TIMEOUT:
+                continue
+            identity = found.setdefault(request.node_id, dict.fromkeys(self.IDENTITY_NAMES))
+            if request.result is not None and len(request.result) == 4:
+                name = self.IDENTITY_NAMES[self.IDENTITY_ENTRIES.index((request.index, request.subindex))]
+                identity[name], = struct.unpack("<I", request.result)
+        for node_id, (_, timestamp) in self.heartbeats.items():
+            if timestamp >= start and node_id in node_ids:
+                found.setdefault(node_id, dict.fromkeys(self.IDENTITY_NAMES))
+        return found
+
+    def write(self, node_id, index, subindex, data, timeout=None):
+        """Write up to 4 bytes to a remote node with an expedited download."""
+        self.cache.invalidate(node_id, index, subindex)
+        request = self.submit(CANopenSDORequest(node_id, index, subindex, bytes(data)))
+        self.wait([request], timeout)
+        if request.abort_code is not None:
+            raise Exception(f"SDO write of 0x{index:04X}:{subindex} to node {node_id} "
+                            f"aborted with code 0x{request.abort_code:08X}")
+
+    def send_mpdo(self, cob_id, node_id, index, subindex, data):
+        """
+        Write up to 4 bytes to an object of one node, or of all nodes if node_id is 0, with one
+        unconfirmed MPDO in destination address mode.
+
+        :param cob_id: COB-ID of the MPDO the nodes' CANopenMPDOConsumer listens to.
+        :return: True if the frame was put on the bus.
+        """
+        self.cache.invalidate(node_id, index, subindex)
+        return self.send(CANopenMPDO(cob_id, node_id, index, subindex, data))
 
     def send_read_request(self, index, subindex):
         if self.state != State.CO_SDO_ST_IDLE:
@@ -172,6 +561,7 @@ class CANopenMasterNode(CANopenNode):
             # Constructing an SDO request to write data to the slave
             request_msg = CANopenClientSDO(self.node_id)
             request_msg.set_data(CANopenSDO.SDO_DOWNLOAD_INITIATE, struct.pack("<HBB", index, subindex, data_to_write))
+            self.cache.invalidate(self.node_id, index, subindex)
             self.send(request_msg)
             self.state = State.CO_SDO_ST_DOWNLOAD_INITIATE_REQ
         except Exception as e:
@@ -187,7 +577,7 @@ class CANopenMasterNode(CANopenNode):
             response = self.mcp.read_message()
 
             if isinstance(response, Message):  # Assuming Message is an expected type
-                decoded_index, decoded_subindex = struct.unpack("<HB", response.data[:3])
+                decoded_index, decoded_subindex = struct.unpack("<HB", response.data[1:4])
                 if self.state == State.CO_SDO_ST_UPLOAD_INITIATE_REQ:
                     self.state = State.CO_SDO_ST_UPLOAD_INITIATE_RSP
                 else:
@@ -200,63 +590,476 @@ class CANopenMasterNode(CANopenNode):
             self.state = State.CO_SDO_ST_ABORT
             raise e
 
+    def start_transfer(self, transfer):
+        """Start a segmented or block transfer; poll() drives it from then on."""
+        if transfer.node_id in self._transfers:
+            raise Exception(f"A transfer with node {transfer.node_id} is already running.")
+        self._transfers[transfer.node_id] = transfer
+        transfer.start(self.send)
+        return transfer
+
+    def check_transfer(self, transfer, timeout, retries=0):
+        """
+        Handle an interrupted transfer.
+
+        A transfer without any response for timeout seconds is retransmitted from its last
+        acknowledged point, up to retries times, and then aborted.
+
+        :return: The number of retries left.
+        """
+        if transfer.done or time.monotonic() - transfer.last_activity < timeout:
+            return retries
+        if retries > 0:
+            logger.warning(f"Transfer with node {transfer.node_id} interrupted, retransmitting.")
+            transfer.retransmit()
+            return retries - 1
+        self.get_breaker(transfer.node_id).record_failure()
+        self.abort_transfer(transfer, CANopenSDO.ABORT_TIMEOUT)
+        return 0
+
+    def abort_transfer(self, transfer, abort_code=CANopenSDO.ABORT_GENERAL):
+        """Abort a running transfer and tell the node."""
+        if self._transfers.get(transfer.node_id) is transfer:
+            del self._transfers[transfer.node_id]
+        transfer.abort(abort_code)
+
+    def run_transfers(self, transfers, timeout=2.0, retries=0):
+        """
+        Run segmented or block transfers with several nodes concurrently.
+
+        While one node processes a sub-block, the sub-blocks of the other nodes are sent.
+
+        :param transfers: Transfers, at most one per node.
+        :param timeout: Seconds without a response from a node after which its transfer is retransmitted or aborted.
+        :param retries: Number of retransmissions before a transfer is aborted.
+        """
+        retries_left = {}
+        for transfer in transfers:
+            self.start_transfer(transfer)
+            retries_left[transfer.node_id] = retries
+        while any(not transfer.done for transfer in transfers):
+            # Timeouts are checked even while frames keep arriving, e.g. PDOs and heartbeats
+            self.poll()
+            for transfer in transfers:
+                retries_left[transfer.node_id] = self.check_transfer(transfer, timeout,
+                                                                     retries_left[transfer.node_id])
+        return transfers
+
+    def upload(self, node_id, index, subindex, sink=None, timeout=2.0):
+        """
+        Read a value of any size from a remote node, streaming segmented transfers into a sink.
+
+        :param sink: CANopenDomain or binary file object receiving the value.
+        :return: The value as bytes if no sink was given, else the number of bytes received.
+        """
+        transfer, = self.run_transfers([CANopenSegmentedUpload(node_id, index, subindex, sink)], timeout)
+        if transfer.abort_code is not None:
+            raise Exception(f"SDO upload of 0x{index:04X}:{subindex} from node {node_id} "
+                            f"aborted with code 0x{transfer.abort_code:08X}")
+        if sink is None:
+            return transfer.domain.getvalue()
+        return transfer.domain.size
+
+    def download_block(self, node_id, index, subindex, data, timeout=2.0):
+        """
+        Write data of any size to a remote node with an SDO block download.
+
+        :param data: Bytes, or a CANopenDomain or binary file object streamed one segment at a time.
+        """
+        self.cache.invalidate(node_id, index, subindex)
+        transfer, = self.run_transfers([CANopenBlockDownload(node_id, index, subindex, data)], timeout)
+        if transfer.abort_code is not None:
+            raise Exception(f"SDO block download of 0x{index:04X}:{subindex} to node {node_id} "
+                            f"aborted with code 0x{transfer.abort_code:08X}")
+
+    def usdo_upload(self, node_id, index, subindex, sink=None, timeout=2.0):
+        """
+        Read a value of any size from a remote node over USDO, in CAN FD frames of up to 64 bytes.
+
+        :param sink: CANopenDomain or binary file object receiving the value.
+        :return: The value as bytes if no sink was given, else the number of bytes received.
+        """
+        transfer, = self.run_transfers([CANopenUSDOUpload(node_id, index, subindex, sink)], timeout)
+        if transfer.abort_code is not None:
+            raise Exception(f"USDO upload of 0x{index:04X}:{subindex} from node {node_id} "
+                            f"aborted with code 0x{transfer.abort_code:08X}")
+        if sink is None:
+            return transfer.domain.getvalue()
+        return transfer.domain.size
+
+    def usdo_download(self, node_id, index, subindex, data, timeout=2.0):
+        """
+        Write data of any size to a remote node over USDO, in CAN FD frames of up to 64 bytes.
+
+        :param data: Bytes, or a CANopenDomain or binary file object streamed one segment at a time.
+        """
+        self.cache.invalidate(node_id, index, subindex)
+        transfer, = self.run_transfers([CANopenUSDODownload(node_id, index, subindex, data)], timeout)
+        if transfer.abort_code is not None:
+            raise Exception(f"USDO download of 0x{index:04X}:{subindex} to node {node_id} "
+                            f"aborted with code 0x{transfer.abort_code:08X}")
+
+    def download_concise_dcf(self, node_id, configuration, timeout=2.0):
+        """
+        Configure a remote node with a single block download of a Concise DCF to object 0x1F22.
+
+        :param configuration: A CANopenDCF, a dict of (index, subindex) -> bytes, or Concise DCF bytes.
+        """
+        self.download_block(node_id, CANopenDCF.CONCISE_DCF_INDEX, node_id,
+                            self._to_concise(configuration), timeout)
+        self.cache.clear(node_id)
+
+    def configure_many(self, configurations, timeout=2.0):
+        """
+        Download a Concise DCF to many nodes in parallel.
+
+        :param configurations: Dict mapping node ID to a configuration accepted by download_concise_dcf.
+        :return: Dict mapping node ID to None on success, or to the SDO abort code.
+        """
+        transfers = [CANopenBlockDownload(node_id, CANopenDCF.CONCISE_DCF_INDEX, node_id,
+                                          self._to_concise(configuration))
+                     for node_id, configuration in configurations.items()]
+        self.run_transfers(transfers, timeout)
+        for node_id in configurations:
+            self.cache.clear(node_id)
+        return {transfer.node_id: transfer.abort_code for transfer in transfers}
+
+    @staticmethod
+    def _to_concise(configuration):
+        if isinstance(configuration, dict):
+            configuration = CANopenDCF(configuration)
+        if isinstance(configuration, CANopenDCF):
+            return configuration.to_concise()
+        return bytes(configuration)
+
     def reset_state(self):
         self.state = State.CO_SDO_ST_IDLE
 
 class CANopenSlaveNode(CANopenNode):
+    # States in which listen_and_respond expects the next frame of a transfer
+    TRANSFER_STATES = (State.CO_SDO_ST_IDLE, State.CO_SDO_ST_UPLOAD_SEGMENT_REQ, State.CO_SDO_ST_DOWNLOAD_SEGMENT_REQ,
+                       State.CO_SDO_ST_DOWNLOAD_BLK_SUBBLOCK_REQ, State.CO_SDO_ST_DOWNLOAD_BLK_END_REQ)
 
-    def __init__(self, node_id, mcp):
+    def __init__(self, node_id, mcp, data_dict=None):
         super().__init__(node_id, mcp)
         # The dictionary represents the data on the Slave.
-        # The key is a tuple of (index, subindex) and the value is the data.
-        self.data_dict = {}
+        # The key is a tuple of (index, subindex) and the value is the data,
+        # or a CANopenDomain for large values kept in a file or memory map.
+        # A CANopenObjectDictionary shares the values of a template with other nodes.
+        self.data_dict = data_dict if data_dict is not None else {}
         self.state = State.CO_SDO_ST_IDLE
+        # Segmented transfer in progress: [index, subindex, domain, offset, toggle]
+        self._segmented = None
+        # Block download in progress: [index, subindex, domain, offset, last seqno, block done, crc, held bytes]
+        self._block = None
+        # Reusable segment buffers, so transfers stream without growing memory use
+        self._segment = bytearray(CANopenSDO.SDO_SEGMENT_SIZE)
+        self._held = bytearray(CANopenSDO.SDO_BLOCK_SEGMENT_SIZE)
+        # Optional CANopenLSSSlave handling LSS requests
+        self.lss = None
+        # Optional CANopenParameterStore persisting parameters on store commands (0x1010/0x1011)
+        self.storage = None
+        # Optional CANopenUSDOServer answering USDO requests sent in CAN FD frames
+        self.usdo = None
+        # Optional CANopenChangeNotifier telling subscribers about changed entries
+        self.notifier = None
+        # Reusable frame for expedited SDO responses
+        self._response = CANopenServerSDO(node_id, bytes(8))
 
     def write_data(self, index, subindex, data):
         """Writes data to the node's dictionary at the given index and subindex."""
-        self.data_dict[(index, subindex)] = data
+        value = self._own_domain(index, subindex)
+        if value is not None:
+            value.truncate(0)
+            value.write(0, data)
+            changed = True
+        else:
+            changed = self.notifier is not None and self.data_dict.get((index, subindex)) != data
+            self.data_dict[(index, subindex)] = data
+        if changed and self.notifier is not None:
+            self.notifier.changed((index, subindex))
+        if self.storage is not None:
+            self.storage.written(index, subindex)
+
+    def _own_domain(self, index, subindex):
+        """Return the entry if it is a domain that may be written in place, i.e. not shared with other nodes."""
+        value = self.data_dict.get((index, subindex))
+        if not isinstance(value, CANopenDomain):
+            return None
+        if isinstance(self.data_dict, CANopenObjectDictionary) and not self.data_dict.is_overridden((index, subindex)):
+            return None
+        return value
+
+    def apply_concise_dcf(self, data):
+        """Write every entry of a Concise DCF to the node's dictionary."""
+        for index, subindex, value in CANopenDCF.iter_concise(data):
+            self.write_data(index, subindex, value)
 
     def listen_and_respond(self):
-        if self.state != State.CO_SDO_ST_IDLE:
+        if self.state not in self.TRANSFER_STATES:
             print("Node is busy or in an error state.")
             return
 
-        message = self.mcp.read_message()
+        message = self.read_frame()
         if message:
+            if self.bus_load is not None:
+                self.bus_load.add_frame(len(message.data))
+            self.process_message(message)
+
+    def process_message(self, message):
+        """Handle a single received frame, then deliver the change notifications if the batch is complete."""
+        self._process_message(message)
+        if self.notifier is not None:
+            self.notifier.frame_processed(message)
+
+    def _process_message(self, message):
+        rpdo = self.rpdos.get(message.id)
+        if rpdo is not None:
+            rpdo.process(message)
+            return
+        if self.lss is not None and self.lss.process(message):
+            return
+        if self.usdo is not None and self.usdo.process(message):
+            return
+        if message.id == CANopenMessage.COB_ID_NMT and len(message.data) >= 2:
+            try:
+                self.process_nmt(message.data[0], message.data[1])
+            except ValueError as e:
+                logger.warning(f"Node {self.node_id}: {e}")
+            return
+        if message.id == CANopenSDO.COB_ID_SDO_RX + self.node_id:
             try:
                 cmd_specifier = message.data[0]
-                if cmd_specifier == CANopenSDO.SDO_UPLOAD_INITIATE:
-                    received_index, = struct.unpack("<H", message.data[1:3])
-                    received_subindex = message.data[3]
+                if cmd_specifier == CANopenSDO.SDO_ABORT:
+                    self._end_transfer()
+                    self.state = State.CO_SDO_ST_IDLE
+                elif self._block is not None:
+                    self.process_block_download(message.data)
+                elif self._segmented is not None:
+                    self.process_segment(message.data)
+                elif cmd_specifier == CANopenSDO.SDO_UPLOAD_INITIATE:
+                    received_index, received_subindex = struct.unpack_from("<HB", message.data, 1)
                     self.state = State.CO_SDO_ST_UPLOAD_INITIATE_RSP
                     self.send_response(received_index, received_subindex)
-                elif cmd_specifier == CANopenSDO.SDO_DOWNLOAD_INITIATE:
+                elif cmd_specifier & 0xE0 == CANopenSDO.SDO_DOWNLOAD_INITIATE:
                     received_index, = struct.unpack("<H", message.data[1:3])
                     received_subindex = message.data[3]
+                    if cmd_specifier & CANopenSDO.SDO_SIZE_INDICATED and not cmd_specifier & CANopenSDO.SDO_EXPEDITED:
+                        self.start_segmented_download(received_index, received_subindex)
+                        return
                     received_data = message.data[4:]
+                    if cmd_specifier & CANopenSDO.SDO_EXPEDITED and cmd_specifier & CANopenSDO.SDO_SIZE_INDICATED:
+                        received_data = received_data[:4 - ((cmd_specifier >> 2) & 0x03)]
+                    if self.storage is not None and received_index in (self.storage.INDEX_STORE,
+                                                                       self.storage.INDEX_RESTORE):
+                        abort_code = self.storage.command(received_index, received_subindex, received_data)
+                        if abort_code is not None:
+                            response = CANopenServerSDO(self.node_id)
+                            self.set_abort(response, received_index, received_subindex, abort_code)
+                            self.send(response)
+                            return
+                        self.send_write_ack(received_index, received_subindex)
+                        return
                     self.write_data(received_index, received_subindex, received_data)
                     self.state = State.CO_SDO_ST_DOWNLOAD_SEGMENT_RSP
                     self.send_write_ack(received_index, received_subindex)
+                elif cmd_specifier & 0xE0 == CANopenSDO.SDO_BLOCK_DOWNLOAD:
+                    self.process_block_download(message.data)
             except Exception as e:
+                self._end_transfer()
                 self.state = State.CO_SDO_ST_ABORT
                 print("Error:", e)
 
+    def process_nmt(self, command, node_id):
+        """
+        Apply an NMT command addressed to this node or to all nodes (node_id 0).
+
+        A reset completes at once: the node enters pre-operational and sends its boot-up frame.
+        """
+        if node_id not in (0, self.node_id):
+            return
+        self.nmt.transition(command)
+        if command in (CANopenNMT.CMD_RESET_NODE, CANopenNMT.CMD_RESET_COMMUNICATION):
+            self.nmt.transition(CANopenNMT.CMD_ENTER_PRE_OPERATIONAL)
+            self.send_boot_up()
+
+    def send_boot_up(self):
+        """Send the boot-up frame, a heartbeat with the state initialising."""
+        self.send(CANopenMessage(CANopenMessage.COB_ID_HEARTBEAT + self.node_id,
+                                 bytes([CANopenNMT.STATE_INITIALIZING])))
+
+    def _sdo_response(self):
+        """Return the reusable server SDO frame, addressed with the current node ID."""
+        response = self._response
+        response.id = CANopenSDO.COB_ID_SDO_TX + self.node_id
+        return response
+
     def send_response(self, index, subindex):
-        if (index, subindex) in self.data_dict:
-            data = self.data_dict[(index, subindex)]
-            response = CANopenServerSDO(self.node_id)
-            response.set_data(State.CO_SDO_ST_UPLOAD_SEGMENT_RSP, data)
-            self.mcp.send(response)
-            self.state = State.CO_SDO_ST_IDLE
+        response = self._sdo_response()
+        data = self.data_dict.get((index, subindex))
+        if data is not None:
+            if isinstance(data, CANopenDomain) or len(data) > 4:
+                # Too large for an expedited transfer: announce the size and stream segments
+                domain = to_domain(data)
+                self._segmented = [index, subindex, domain, 0, 0]
+                response.data = struct.pack("<BHBI", CANopenSDO.SDO_UPLOAD_RESPONSE | CANopenSDO.SDO_SIZE_INDICATED,
+                                            index, subindex, domain.size)
+                self.send(response)
+                self.state = State.CO_SDO_ST_UPLOAD_SEGMENT_REQ
+                return
+            response.set_expedited(CANopenSDO.SDO_UPLOAD_RESPONSE, index, subindex, data)
         else:
             print("Requested data not found!")
+            self.set_abort(response, index, subindex, CANopenSDO.ABORT_NOT_EXIST)
+        self.send(response)
+        self.state = State.CO_SDO_ST_IDLE
 
     def send_write_ack(self, index, subindex):
-        response_msg = CANopenServerSDO(self.node_id)
-        response_msg.set_data(State.CO_SDO_ST_DOWNLOAD_SEGMENT_RSP, struct.pack("<HB", index, subindex))
-        self.mcp.send(response_msg)
+        response = self._sdo_response()
+        struct.pack_into("<BHB4x", response.data, 0, CANopenSDO.SDO_DOWNLOAD_RESPONSE, index, subindex)
+        self.send(response)
         self.state = State.CO_SDO_ST_IDLE
 
+    def _download_target(self, index, subindex):
+        """
+        Return the domain receiving a download: a replacement of the entry if it is a domain, else a memory buffer.
+
+        The entry keeps its value until _download_complete() swaps the replacement in, so a
+        failed transfer doesn't destroy it.
+        """
+        value = self._own_domain(index, subindex)
+        if value is not None:
+            return value.open_replacement()
+        return CANopenDomain()
+
+    def _download_complete(self, index, subindex, domain):
+        target = domain.replaces
+        if target is not None and self.data_dict.get((index, subindex)) is target:
+            target.replace(domain)
+            if self.notifier is not None:
+                self.notifier.changed((index, subindex))
+            return
+        value = domain.getvalue()
+        domain.discard()
+        if index == CANopenDCF.CONCISE_DCF_INDEX:
+            self.apply_concise_dcf(value)
+        self.write_data(index, subindex, value)
+
+    def start_segmented_download(self, index, subindex):
+        self._segmented = [index, subindex, self._download_target(index, subindex), 0, 0]
+        self.send_write_ack(index, subindex)
+        self.state = State.CO_SDO_ST_DOWNLOAD_SEGMENT_REQ
+
+    def process_segment(self, data):
+        """Server side of the segments of an SDO segmented upload or download."""
+        index, subindex, domain, offset, toggle = self._segmented
+        response = CANopenServerSDO(self.node_id)
+        command = data[0]
+        if command & CANopenSDO.SDO_TOGGLE != toggle:
+            self._end_transfer()
+            self.state = State.CO_SDO_ST_IDLE
+            self.set_abort(response, index, subindex, CANopenSDO.ABORT_TOGGLE)
+            self.send(response)
+            return
+        if self.state == State.CO_SDO_ST_UPLOAD_SEGMENT_REQ and command & 0xE0 == CANopenSDO.SDO_UPLOAD_SEGMENT:
+            segment = self._segment
+            count = domain.readinto(offset, segment)
+            for position in range(count, CANopenSDO.SDO_SEGMENT_SIZE):
+                segment[position] = 0
+            offset += count
+            command = toggle | ((CANopenSDO.SDO_SEGMENT_SIZE - count) << 1)
+            if offset >= domain.size:
+                command |= CANopenSDO.SDO_NO_MORE_SEGMENTS
+            response.data = struct.pack("<B7s", command, segment)
+        elif self.state == State.CO_SDO_ST_DOWNLOAD_SEGMENT_REQ and command & 0xE0 == CANopenSDO.SDO_DOWNLOAD_SEGMENT:
+            count = CANopenSDO.SDO_SEGMENT_SIZE - ((command >> 1) & 0x07)
+            domain.write(offset, memoryview(data)[1:1 + count])
+            offset += count
+            if command & CANopenSDO.SDO_NO_MORE_SEGMENTS:
+                self._download_complete(index, subindex, domain)
+            response.data = struct.pack("<B7x", CANopenSDO.SDO_DOWNLOAD_INITIATE | toggle)
+        else:
+            self._end_transfer()
+            self.state = State.CO_SDO_ST_IDLE
+            self.set_abort(response, index, subindex, CANopenSDO.ABORT_GENERAL)
+            self.send(response)
+            return
+        if command & CANopenSDO.SDO_NO_MORE_SEGMENTS:
+            self._segmented = None
+            self.state = State.CO_SDO_ST_IDLE
+        else:
+            self._segmented[3] = offset
+            self._segmented[4] = toggle ^ CANopenSDO.SDO_TOGGLE
+        self.send(response)
+
+    def process_block_download(self, data):
+        """Server side of an SDO block download, streaming the segments into the target domain."""
+        response = CANopenServerSDO(self.node_id)
+        if self._block is None:
+            index, subindex = struct.unpack("<HB", bytes(data[1:4]))
+            self._block = [index, subindex, self._download_target(index, subindex), 0, 0, False, 0, 0]
+            response.data = struct.pack("<BHBB3x", CANopenSDO.SDO_BLOCK_DOWNLOAD_RESPONSE | CANopenSDO.SDO_BLOCK_CRC,
+                                        index, subindex, CANopenSDO.SDO_BLOCK_MAX_SEGMENTS)
+            self.state = State.CO_SDO_ST_DOWNLOAD_BLK_SUBBLOCK_REQ
+            self.send(response)
+            return
+
+        block = self._block
+        index, subindex, domain = block[0], block[1], block[2]
+        if self.state == State.CO_SDO_ST_DOWNLOAD_BLK_SUBBLOCK_REQ:
+            seqno = data[0] & 0x7F
+            last = data[0] & CANopenSDO.SDO_BLOCK_LAST_SEGMENT
+            if seqno == block[4] + 1:
+                # The previous segment is not the last one, so all of it is data
+                self._flush_held(block)
+                self._held[:] = memoryview(data)[1:8]
+                block[7] = CANopenSDO.SDO_BLOCK_SEGMENT_SIZE
+                block[4] = seqno
+                if last:
+                    block[5] = True
+            if last or seqno >= CANopenSDO.SDO_BLOCK_MAX_SEGMENTS:
+                # Acknowledge the last segment received in sequence; the client repeats the rest
+                response.data = struct.pack("<BBB5x", CANopenSDO.SDO_BLOCK_DOWNLOAD_RESPONSE | CANopenSDO.SDO_BLOCK_ACK,
+                                            block[4], CANopenSDO.SDO_BLOCK_MAX_SEGMENTS)
+                block[4] = 0
+                if block[5]:
+                    self.state = State.CO_SDO_ST_DOWNLOAD_BLK_END_REQ
+                self.send(response)
+        elif self.state == State.CO_SDO_ST_DOWNLOAD_BLK_END_REQ:
+            self._block = None
+            block[7] -= (data[0] >> 2) & 0x07
+            self._flush_held(block)
+            crc, = struct.unpack("<H", bytes(data[1:3]))
+            if crc != block[6]:
+                domain.discard()
+                self.set_abort(response, index, subindex, CANopenSDO.ABORT_CRC)
+            else:
+                self._download_complete(index, subindex, domain)
+                response.data = struct.pack("<B7x", CANopenSDO.SDO_BLOCK_DOWNLOAD_RESPONSE | CANopenSDO.SDO_BLOCK_END)
+            self.state = State.CO_SDO_ST_IDLE
+            self.send(response)
+
+    def _end_transfer(self):
+        """Forget the transfer in progress, dropping the partly received value of a download."""
+        for transfer in (self._segmented, self._block):
+            if transfer is not None:
+                transfer[2].discard()
+        self._segmented = None
+        self._block = None
+
+    def _flush_held(self, block):
+        count = block[7]
+        if count > 0:
+            held = memoryview(self._held)[:count]
+            block[2].write(block[3], held)
+            block[6] = crc16(held, block[6])
+            block[3] += count
+        block[7] = 0
+
+    @staticmethod
+    def set_abort(message, index, subindex, abort_code):
+        """Fill a server SDO message with an abort transfer frame."""
+        message.data = struct.pack("<BHBI", CANopenSDO.SDO_ABORT, index, subindex, abort_code)
+
     def reset_state(self):
         self.state = State.CO_SDO_ST_IDLE
-
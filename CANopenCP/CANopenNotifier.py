@@ -0,0 +1,88 @@
+from .CANopenMessage import CANopenMessage
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class CANopenChangeNotifier:
+    """
+    Batched change notifications for the object dictionary of a slave.
+
+    Attach it with node.notifier = CANopenChangeNotifier(node). Entries changed by RPDOs, MPDOs
+    and SDO/USDO downloads are collected, and every subscriber is called once per batch with
+    the set of changed (index, subindex) keys it subscribed to, instead of once per variable.
+    A batch ends after every received frame (BATCH_FRAME), on every SYNC (BATCH_SYNC), or
+    when the application calls flush() (BATCH_MANUAL).
+    """
+
+    BATCH_FRAME = 0
+    BATCH_SYNC = 1
+    BATCH_MANUAL = 2
+
+    def __init__(self, node, batch=BATCH_FRAME):
+        """
+        :param node: The CANopenSlaveNode whose object dictionary is watched.
+        :param batch: When notifications are delivered, BATCH_FRAME, BATCH_SYNC or BATCH_MANUAL.
+        """
+        self.node = node
+        self.batch = batch
+        # [callback, first index, last index, subindex or None] of every subscription
+        self.subscriptions = []
+        # Keys changed since the last delivery
+        self.pending = set()
+
+    def subscribe(self, callback, index=None, subindex=None, last_index=None):
+        """
+        Subscribe to changes of an entry, an object or a range of objects.
+
+        :param callback: Called with the set of changed keys within the subscription.
+        :param index: Index of the object, or the first of a range; None for the whole dictionary.
+        :param subindex: Subindex of the entry, None for all subindexes.
+        :param last_index: Last index of a range, the same as index if None.
+        :return: The subscription, to pass to unsubscribe().
+        """
+        if index is None:
+            first, last = 0, 0xFFFF
+        else:
+            first, last = index, index if last_index is None else last_index
+        subscription = [callback, first, last, subindex]
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscriptions = [entry for entry in self.subscriptions if entry is not subscription]
+
+    def changed(self, key):
+        """Record a change of the entry with key (index, subindex), delivered with the current batch."""
+        self.pending.add(key)
+
+    def frame_processed(self, message):
+        """End the batch if the batch mode says so; called by the node after every received frame."""
+        if not self.pending:
+            return
+        if self.batch == self.BATCH_FRAME or (self.batch == self.BATCH_SYNC and
+                                              message.id == CANopenMessage.COB_ID_SYNC):
+            self.flush()
+
+    def flush(self):
+        """
+        Deliver the changes collected since the last delivery.
+
+        :return: The number of callbacks made.
+        """
+        if not self.pending:
+            return 0
+        pending = self.pending
+        self.pending = set()
+        calls = 0
+        for callback, first, last, subindex in list(self.subscriptions):
+            keys = {key for key in pending if first <= key[0] <= last and (subindex is None or key[1] == subindex)}
+            if not keys:
+                continue
+            calls += 1
+            try:
+                callback(keys)
+            except Exception as e:
+                logger.error(f"Change notification callback failed: {e}")
+        return calls
@@ -0,0 +1,77 @@
+class CANopenObjectDictionary:
+    """
+    Object dictionary of a node sharing its default values with other nodes.
+
+    Reads fall through to a template dictionary shared by all nodes built from it, writes
+    go to a per-node override dictionary (copy-on-write), so nodes cost memory only for the
+    entries in which they differ. Keys are (index, subindex) tuples like in a plain dict
+    data_dict, for which an instance can be used as a drop-in replacement.
+    """
+
+    def __init__(self, template=None, overrides=None):
+        """
+        :param template: Dict of (index, subindex) -> value shared by reference, never modified.
+        :param overrides: Initial node specific values.
+        """
+        self.template = template if template is not None else {}
+        self.overrides = dict(overrides) if overrides else {}
+
+    def __getitem__(self, key):
+        try:
+            return self.overrides[key]
+        except KeyError:
+            return self.template[key]
+
+    def __setitem__(self, key, value):
+        self.overrides[key] = value
+
+    def __delitem__(self, key):
+        if key in self.template:
+            raise KeyError(f"Entry {key} of the template can't be deleted.")
+        del self.overrides[key]
+
+    def __contains__(self, key):
+        return key in self.overrides or key in self.template
+
+    def __iter__(self):
+        yield from self.overrides
+        for key in self.template:
+            if key not in self.overrides:
+                yield key
+
+    def __len__(self):
+        return len(self.template) + sum(1 for key in self.overrides if key not in self.template)
+
+    def get(self, key, default=None):
+        value = self.overrides.get(key, self)
+        if value is self:
+            return self.template.get(key, default)
+        return value
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        self.overrides[key] = default
+        return default
+
+    def pop(self, key, *default):
+        """Remove a node specific entry. Entries of the template are reverted to their template value."""
+        if key in self.overrides:
+            return self.overrides.pop(key)
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def is_overridden(self, key):
+        """Return True if the node has its own value for the entry."""
+        return key in self.overrides
+
+    def reset(self):
+        """Revert all entries to the template values."""
+        self.overrides.clear()
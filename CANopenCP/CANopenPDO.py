@@ -1,7 +1,11 @@
+import struct
+import time
+
 from .CANopenMessage import CANopenMessage
+from .CANopenObjectDictionary import CANopenObjectDictionary
 
 
-class CANopenPDO:
+class CANopenPDO(CANopenMessage):
     """Base class for CANopen PDOs."""
 
     # Default COB-IDs for PDOs
@@ -14,21 +18,503 @@ class CANopenPDO:
     COB_ID_PDO4_TX = 0x480
     COB_ID_PDO4_RX = 0x500
 
-    def __init__(self, cob_id, data=bytes()):
-        super().__init__(cob_id, data)
+    def __init__(self, cob_id, data=bytes(), fd=False):
+        """
+        :param fd: Send as a CAN FD frame of up to 64 bytes.
+        """
+        super().__init__(cob_id, data, fd=fd)
 
 
 class CANopenTPDO(CANopenPDO):
     """CANopen Transmit PDO."""
 
-    def __init__(self, node_id, data=bytes()):
+    def __init__(self, node_id, data=bytes(), fd=False):
         cob_id = self.COB_ID_PDO1_TX + node_id
-        super().__init__(cob_id, data)
+        super().__init__(cob_id, data, fd)
 
 
 class CANopenRPDO(CANopenPDO):
     """CANopen Receive PDO."""
 
-    def __init__(self, node_id, data=bytes()):
+    def __init__(self, node_id, data=bytes(), fd=False):
         cob_id = self.COB_ID_PDO1_RX + node_id
-        super().__init__(cob_id, data)
+        super().__init__(cob_id, data, fd)
+
+
+class CANopenMPDO(CANopenPDO):
+    """
+    Multiplexed PDO (CiA 301): one object per frame, addressed by index and subindex.
+
+    Byte 0 holds the address type and a node ID, bytes 1-3 the index and subindex and
+    bytes 4-7 up to 4 bytes of data. In destination address mode (DAM) the node ID is the
+    consumer, 0 for all nodes, and index and subindex are those of the consumer's object. In
+    source address mode (SAM) it is the producer, and every consumer maps the producer's
+    object to a local one with its object dispatcher list.
+    """
+
+    ADDRESS_DAM = 0x80
+    NODE_ID_MASK = 0x7F
+    ALL_NODES = 0
+    DATA_SIZE = 4
+    FORMAT = "<BHB4s"
+
+    # Object scanner list of a SAM producer and object dispatcher list of a consumer
+    INDEX_SCANNER_LIST = 0x1FA0
+    INDEX_SCANNER_LIST_LAST = 0x1FCF
+    INDEX_DISPATCHER_LIST = 0x1FD0
+    INDEX_DISPATCHER_LIST_LAST = 0x1FFF
+
+    def __init__(self, cob_id, node_id, index, subindex, data, dam=True):
+        """
+        :param node_id: Destination node ID (DAM, 0 for all nodes) or node ID of the producer (SAM).
+        :param data: Up to 4 bytes, padded with zeros.
+        :param dam: Destination address mode if True, else source address mode.
+        """
+        if len(data) > self.DATA_SIZE:
+            raise ValueError("MPDOs carry at most 4 bytes.")
+        address = (node_id & self.NODE_ID_MASK) | (self.ADDRESS_DAM if dam else 0)
+        super().__init__(cob_id, struct.pack(self.FORMAT, address, index, subindex, bytes(data)))
+
+    @staticmethod
+    def scanner_entry(index, subindex, block_size=1):
+        """Value of an object scanner list entry (0x1FA0-0x1FCF) sending block_size subindexes from subindex on."""
+        return struct.pack("<I", (block_size << 24) | (index << 8) | subindex)
+
+    @staticmethod
+    def dispatcher_entry(local_index, local_subindex, sender_node_id, sender_index, sender_subindex, block_size=1):
+        """Value of an object dispatcher list entry (0x1FD0-0x1FFF) mapping a producer's objects to local ones."""
+        return struct.pack("<Q", (local_index << 48) | (local_subindex << 40) | (sender_node_id << 32)
+                           | (sender_index << 16) | (sender_subindex << 8) | block_size)
+
+
+class CANopenBusLoad:
+    """Estimates the bus load caused by the frames it is told about."""
+
+    def __init__(self, bitrate=1000000, window=0.1, data_bitrate=None):
+        """
+        :param bitrate: Bus bit rate in bit/s.
+        :param window: Averaging time constant in seconds.
+        :param data_bitrate: Bit rate of the data phase of CAN FD frames in bit/s, the bus bit rate if None.
+        """
+        self.bitrate = bitrate
+        self.window = window
+        self.data_bitrate = data_bitrate or bitrate
+        self._bits = 0.0
+        self._last = time.monotonic()
+
+    @staticmethod
+    def frame_bits(length):
+        """Approximate number of bits of a standard data frame, including worst case bit stuffing."""
+        return 47 + 8 * length + (34 + 8 * length - 1) // 4
+
+    @staticmethod
+    def fd_frame_bits(length, data_phase_ratio=1.0):
+        """
+        Approximate number of nominal bit times of a CAN FD data frame.
+
+        :param length: Payload length, rounded up to the next CAN FD payload size.
+        :param data_phase_ratio: Data phase bit rate divided by the nominal bit rate.
+        """
+        length = CANopenMessage.fd_padded_length(length)
+        # Arbitration, ACK and end of frame at the nominal rate; control field, data,
+        # stuff count and CRC with worst case bit stuffing in the data phase
+        crc_bits = 17 if length <= 16 else 21
+        data_bits = 8 * length + (8 * length - 1) // 4 + crc_bits + crc_bits // 4 + 10
+        return 30 + data_bits / data_phase_ratio
+
+    def _decay(self, now):
+        elapsed = now - self._last
+        if elapsed > 0:
+            self._bits *= max(0.0, 1.0 - elapsed / self.window)
+            self._last = now
+
+    def add_frame(self, length, now=None):
+        now = time.monotonic() if now is None else now
+        self._decay(now)
+        if length > CANopenMessage.MAX_DATA_LENGTH:
+            self._bits += self.fd_frame_bits(length, self.data_bitrate / self.bitrate)
+        else:
+            self._bits += self.frame_bits(length)
+
+    def load(self, now=None):
+        """Return the estimated bus load as a fraction of the bit rate."""
+        self._decay(time.monotonic() if now is None else now)
+        return self._bits / (self.bitrate * self.window)
+
+
+class CANopenEventTPDO:
+    """
+    Event-driven TPDO (transmission type 254/255) that is only sent on change of state.
+
+    Register it with node.add_event_tpdo(); every TPDO the application sends on the same
+    COB-ID is then compared to the last transmitted payload and suppressed when nothing
+    changed, when the change is within the dead-bands, or while the inhibit time runs.
+    The event timer forces a periodic refresh.
+    """
+
+    TRANSMISSION_EVENT_MANUFACTURER = 254
+    TRANSMISSION_EVENT_PROFILE = 255
+
+    def __init__(self, node, mapping=None, cob_id=None, transmission_type=TRANSMISSION_EVENT_PROFILE,
+                 inhibit_time=0.0, event_timer=0.0, deadbands=None, max_bus_load=None, busy_inhibit_time=0.1,
+                 fd=False):
+        """
+        :param node: The CANopenNode sending the TPDO.
+        :param mapping: List of (index, subindex, struct format character) of the mapped
+            variables, used by process() to pack the payload from node.data_dict and to
+            apply dead-bands.
+        :param cob_id: COB-ID of the TPDO, defaults to that of TPDO1 of the node.
+        :param transmission_type: 254 or 255.
+        :param inhibit_time: Minimum time between two transmissions, in seconds.
+        :param event_timer: Time after which the TPDO is sent even if unchanged, in seconds, 0 to disable.
+        :param deadbands: Dict mapping a position in the mapping to the minimum change that triggers a send.
+        :param max_bus_load: Bus load fraction above which changes are sent at most every busy_inhibit_time;
+            requires node.bus_load.
+        :param busy_inhibit_time: Inhibit time in seconds used while the bus load is above max_bus_load.
+        :param fd: Send CAN FD frames; implied by mappings of more than 8 bytes.
+        """
+        if transmission_type not in (self.TRANSMISSION_EVENT_MANUFACTURER, self.TRANSMISSION_EVENT_PROFILE):
+            raise ValueError("Event-driven TPDOs use transmission type 254 or 255.")
+        self.node = node
+        self.cob_id = CANopenPDO.COB_ID_PDO1_TX + node.node_id if cob_id is None else cob_id
+        self.transmission_type = transmission_type
+        self.inhibit_time = inhibit_time
+        self.event_timer = event_timer
+        self.deadbands = deadbands or {}
+        self.max_bus_load = max_bus_load
+        self.busy_inhibit_time = busy_inhibit_time
+        self.mapping = mapping or []
+        self._format = "<" + "".join(entry[2] for entry in self.mapping)
+        self._size = struct.calcsize(self._format)
+        self.fd = fd or self._size > CANopenMessage.MAX_DATA_LENGTH
+        self._buffer = bytearray(self._size)
+        # (key, format, offset, size, view of the payload buffer) of every mapped variable
+        self._layout = []
+        view = memoryview(self._buffer)
+        offset = 0
+        for index, subindex, data_format in self.mapping:
+            size = struct.calcsize("<" + data_format)
+            self._layout.append(((index, subindex), "<" + data_format, offset, size, view[offset:offset + size]))
+            offset += size
+        self._last = None  # Payload last transmitted
+        self._last_sent = None
+        self._pending = None  # Changed payload held back by the inhibit time
+        self._message = None  # Frame reused by process()
+        self.sent = 0
+        # Changes held back by the dead-bands or the inhibit time; repeats of the last payload are not counted
+        self.suppressed = 0
+
+    def should_send(self, data, now=None):
+        """
+        Decide whether a TPDO payload goes on the bus, and record it if so.
+
+        :return: True if the payload must be transmitted now.
+        """
+        now = time.monotonic() if now is None else now
+        refresh = self._last is None or (self.event_timer and now - self._last_sent >= self.event_timer)
+        if not refresh and data == self._last:
+            # Not counted, so that the steady state does not allocate on CPython (ints above 256 are heap objects)
+            self._pending = None
+            return False
+        if not refresh and not self._changed(data):
+            self._pending = None
+            self.suppressed += 1
+            return False
+        if not refresh and now - self._last_sent < self._current_inhibit_time(now):
+            self._pending = bytes(data)
+            self.suppressed += 1
+            return False
+        if self._last is not None and len(self._last) == len(data):
+            self._last[:] = data
+        else:
+            self._last = bytearray(data)
+        self._last_sent = now
+        self._pending = None
+        self.sent += 1
+        return True
+
+    def process(self):
+        """
+        Send the TPDO if the mapped values changed, a held back change can go out, or the event timer expired.
+
+        Call this from the application loop.
+
+        :return: True if a frame was sent.
+        """
+        if self.mapping:
+            data = self.pack()
+        elif self._pending is not None:
+            data = self._pending
+        elif self._last is not None:
+            data = self._last
+        else:
+            return False
+        message = self._message
+        if message is None or len(message.data) != len(data):
+            message = self._message = CANopenPDO(self.cob_id, data,
+                                                 self.fd or len(data) > CANopenMessage.MAX_DATA_LENGTH)
+        else:
+            message.data[:] = data
+        return self.node.send(message)
+
+    def pack(self):
+        """Pack the mapped values from node.data_dict into the reusable payload buffer."""
+        data_dict = self.node.data_dict
+        # Indexed loop and memoryview copies: neither allocates, also on CPython
+        layout = self._layout
+        position = 0
+        while position < len(layout):
+            key, data_format, offset, size, view = layout[position]
+            value = data_dict[key]
+            if isinstance(value, (bytes, bytearray)):
+                view[:] = value if len(value) == size else value[:size]
+            else:
+                struct.pack_into(data_format, self._buffer, offset, value)
+            position += 1
+        return self._buffer
+
+    def _changed(self, data):
+        if data == self._last:
+            return False
+        if not self.deadbands or len(data) != len(self._last) or len(data) != self._size:
+            return True
+        new_values = struct.unpack_from(self._format, data)
+        old_values = struct.unpack_from(self._format, self._last)
+        for position, (new, old) in enumerate(zip(new_values, old_values)):
+            deadband = self.deadbands.get(position)
+            if deadband is None:
+                if new != old:
+                    return True
+            elif abs(new - old) >= deadband:
+                return True
+        return False
+
+    def _current_inhibit_time(self, now):
+        bus_load = getattr(self.node, "bus_load", None)
+        if self.max_bus_load is not None and bus_load is not None and bus_load.load(now) > self.max_bus_load:
+            return max(self.inhibit_time, self.busy_inhibit_time)
+        return self.inhibit_time
+
+
+class CANopenReceivePDO:
+    """
+    Receive PDO that writes the mapped variables of every received frame into node.data_dict.
+
+    The mapped entries are bytearrays updated in place, so receiving a PDO in steady state
+    does not allocate memory. Mappings of up to 64 bytes are received in CAN FD frames, whose
+    payload may be padded up to the next CAN FD frame size.
+    """
+
+    def __init__(self, node, mapping, cob_id=None, on_receive=None):
+        """
+        :param node: The CANopenNode receiving the RPDO.
+        :param mapping: List of (index, subindex, struct format character) of the mapped variables.
+        :param cob_id: COB-ID of the RPDO, defaults to that of RPDO1 of the node.
+        :param on_receive: Called with this object after every received frame.
+        """
+        self.node = node
+        self.cob_id = CANopenPDO.COB_ID_PDO1_RX + node.node_id if cob_id is None else cob_id
+        self.on_receive = on_receive
+        self.size = struct.calcsize("<" + "".join(entry[2] for entry in mapping))
+        # Length of a CAN FD frame carrying the mapping, padded to the next payload size
+        self.padded_size = CANopenMessage.fd_padded_length(self.size)
+        # The last received frame and views of it for every mapped variable, created once
+        self._frame = bytearray(self.size)
+        view = memoryview(self._frame)
+        # [key, target bytearray, view of the target, view of the frame] of every mapped variable
+        self._layout = []
+        offset = 0
+        for index, subindex, data_format in mapping:
+            size = struct.calcsize("<" + data_format)
+            entry = [(index, subindex), None, None, view[offset:offset + size]]
+            self._bind(entry)
+            self._layout.append(entry)
+            offset += size
+        self.length_errors = 0
+        # Receive time in time.monotonic_ns() of the last applied frame, if it was stamped
+        self.timestamp_ns = None
+
+    def _bind(self, entry):
+        """Make the object dictionary entry a bytearray of the mapped size that frames are copied into."""
+        key, _, _, source = entry
+        size = len(source)
+        data_dict = self.node.data_dict
+        value = data_dict.get(key)
+        # A value read through from a shared template is never written into, but copied to the node
+        owned = not isinstance(data_dict, CANopenObjectDictionary) or data_dict.is_overridden(key)
+        if not owned or not isinstance(value, bytearray) or len(value) != size:
+            old = value
+            value = bytearray(size)
+            if old is not None:
+                # Truncated or zero-padded to the mapped size; bytes have no ljust() on CircuitPython
+                old = bytes(old)[:size]
+                value[:len(old)] = old
+            data_dict[key] = value
+        entry[1] = value
+        entry[2] = memoryview(value)
+
+    def process(self, message):
+        """
+        Handle a received frame.
+
+        :return: True if the frame was an RPDO of this object and was applied.
+        """
+        if message.id != self.cob_id:
+            return False
+        data = message.data
+        if len(data) != self.size:
+            if len(data) != self.padded_size or not getattr(message, "fd", False):
+                # Frames of the wrong length are not applied (CiA 301 PDO length error)
+                self.length_errors += 1
+                return False
+            # Drop the CAN FD padding
+            data = memoryview(data)[:self.size]
+        self._frame[:] = data
+        self.timestamp_ns = getattr(message, "timestamp_ns", None)
+        data_dict = self.node.data_dict
+        notifier = getattr(self.node, "notifier", None)
+        # Indexed loop and memoryview copies: neither allocates, also on CPython
+        layout = self._layout
+        position = 0
+        while position < len(layout):
+            entry = layout[position]
+            if data_dict.get(entry[0]) is not entry[1]:
+                # The entry was replaced, e.g. by an SDO download
+                self._bind(entry)
+            if notifier is None:
+                entry[2][:] = entry[3]
+            elif entry[2] != entry[3]:
+                entry[2][:] = entry[3]
+                notifier.changed(entry[0])
+            position += 1
+        if self.on_receive is not None:
+            self.on_receive(self)
+        return True
+
+
+class CANopenMPDOProducer:
+    """
+    Producer of MPDOs on one COB-ID.
+
+    send_to() writes an object of one node, or of all nodes with node ID 0, in destination
+    address mode. In source address mode, send() and send_all() publish the node's own objects
+    listed in its object scanner list (0x1FA0-0x1FCF).
+    """
+
+    def __init__(self, node, cob_id):
+        """
+        :param node: The CANopenNode sending the MPDOs.
+        :param cob_id: COB-ID of the MPDO, the RPDO COB-ID its consumers are configured with.
+        """
+        self.node = node
+        self.cob_id = cob_id
+
+    def send_to(self, node_id, index, subindex, data):
+        """Write up to 4 bytes to an object of one node, or of all nodes if node_id is 0, in one unconfirmed frame."""
+        return self.node.send(CANopenMPDO(self.cob_id, node_id, index, subindex, data))
+
+    def scanner_list(self):
+        """Return the (index, subindex) of the objects in the scanner list, with blocks expanded."""
+        objects = []
+        data_dict = self.node.data_dict
+        for list_index in range(CANopenMPDO.INDEX_SCANNER_LIST, CANopenMPDO.INDEX_SCANNER_LIST_LAST + 1):
+            count = data_dict.get((list_index, 0))
+            if count is None:
+                continue
+            for entry_subindex in range(1, count[0] + 1):
+                entry = data_dict.get((list_index, entry_subindex))
+                if entry is None:
+                    continue
+                value, = struct.unpack("<I", bytes(entry))
+                index, subindex = (value >> 8) & 0xFFFF, value & 0xFF
+                for offset in range(max(1, value >> 24)):
+                    objects.append((index, subindex + offset))
+        return objects
+
+    def send(self, index, subindex):
+        """Publish one of the node's objects in source address mode."""
+        value = bytes(self.node.data_dict[(index, subindex)])[:CANopenMPDO.DATA_SIZE]
+        return self.node.send(CANopenMPDO(self.cob_id, self.node.node_id, index, subindex, value, dam=False))
+
+    def send_all(self):
+        """Publish every object of the scanner list, one frame each; return the number of frames sent."""
+        sent = 0
+        for index, subindex in self.scanner_list():
+            if (index, subindex) in self.node.data_dict and self.send(index, subindex):
+                sent += 1
+        return sent
+
+
+class CANopenMPDOConsumer:
+    """
+    Consumer of the MPDOs received on one COB-ID, writing them into node.data_dict.
+
+    Register it with node.add_rpdo(). DAM frames addressed to the node or to all nodes are
+    written to the object they name; SAM frames are written to the local object the node's
+    object dispatcher list (0x1FD0-0x1FFF) maps the producer's object to, and ignored if it
+    maps none. Objects keep their size, new ones get the 4 bytes of the frame.
+    """
+
+    def __init__(self, node, cob_id, on_receive=None):
+        """
+        :param node: The CANopenSlaveNode receiving the MPDOs.
+        :param cob_id: COB-ID of the MPDO.
+        :param on_receive: Called with (index, subindex) of every object written.
+        """
+        self.node = node
+        self.cob_id = cob_id
+        self.on_receive = on_receive
+        # (producer node ID, index, subindex) -> (local index, local subindex)
+        self.dispatch = {}
+        self.length_errors = 0
+        self.load_dispatcher_list()
+
+    def load_dispatcher_list(self):
+        """Read the object dispatcher list from the object dictionary; call it again after changing the list."""
+        self.dispatch = {}
+        data_dict = self.node.data_dict
+        for list_index in range(CANopenMPDO.INDEX_DISPATCHER_LIST, CANopenMPDO.INDEX_DISPATCHER_LIST_LAST + 1):
+            count = data_dict.get((list_index, 0))
+            if count is None:
+                continue
+            for entry_subindex in range(1, count[0] + 1):
+                entry = data_dict.get((list_index, entry_subindex))
+                if entry is None:
+                    continue
+                value, = struct.unpack("<Q", bytes(entry))
+                local_index, local_subindex = value >> 48, (value >> 40) & 0xFF
+                sender = (value >> 32) & 0xFF
+                sender_index, sender_subindex = (value >> 16) & 0xFFFF, (value >> 8) & 0xFF
+                for offset in range(max(1, value & 0xFF)):
+                    self.dispatch[(sender, sender_index, sender_subindex + offset)] = (local_index,
+                                                                                       local_subindex + offset)
+
+    def process(self, message):
+        """
+        Handle a received frame.
+
+        :return: True if the frame was an MPDO on this object's COB-ID.
+        """
+        if message.id != self.cob_id:
+            return False
+        data = message.data
+        if len(data) != struct.calcsize(CANopenMPDO.FORMAT):
+            self.length_errors += 1
+            return True
+        address, index, subindex, value = struct.unpack(CANopenMPDO.FORMAT, data)
+        node_id = address & CANopenMPDO.NODE_ID_MASK
+        if address & CANopenMPDO.ADDRESS_DAM:
+            if node_id != CANopenMPDO.ALL_NODES and node_id != self.node.node_id:
+                return True
+        else:
+            target = self.dispatch.get((node_id, index, subindex))
+            if target is None:
+                return True
+            index, subindex = target
+        current = self.node.data_dict.get((index, subindex))
+        if isinstance(current, (bytes, bytearray)) and 0 < len(current) <= CANopenMPDO.DATA_SIZE:
+            value = value[:len(current)]
+        self.node.write_data(index, subindex, value)
+        if self.on_receive is not None:
+            self.on_receive(index, subindex)
+        return True
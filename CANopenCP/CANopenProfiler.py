@@ -0,0 +1,174 @@
+import gc
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    # CircuitPython: allocations are measured with gc.mem_alloc() instead
+    tracemalloc = None
+
+from adafruit_mcp2515 import Message
+
+_clock_ns = getattr(time, "perf_counter_ns", None) or time.monotonic_ns
+
+
+class CANopenScriptedController:
+    """
+    Fake CAN controller replaying a script of received frames, for profiling and tests.
+
+    read_message() returns the scripted frames in order, starting over at the end if loop is
+    set. The frames are created once, so reading them does not allocate. Only the last sent
+    frame is kept.
+    """
+
+    def __init__(self, script=(), loop=True):
+        """
+        :param script: Iterable of (COB-ID, data) tuples or Message objects.
+        :param loop: Repeat the script forever instead of returning None at its end.
+        """
+        self.script = [frame if isinstance(frame, Message) else Message(frame[0], bytes(frame[1]))
+                       for frame in script]
+        self.loop = loop
+        self.position = 0
+        self.last_sent = None
+
+    @property
+    def unread_message_count(self):
+        if self.loop and self.script:
+            return 1
+        return len(self.script) - self.position
+
+    def send(self, message):
+        self.last_sent = message
+        return True
+
+    def read_message(self):
+        if self.position >= len(self.script):
+            if not self.loop or not self.script:
+                return None
+            self.position = 0
+        message = self.script[self.position]
+        self.position += 1
+        return message
+
+
+class CANopenHotPathProfiler:
+    """
+    Measures the time and memory allocations per frame of hot code paths, against budgets.
+
+    Every path is a callable processing one frame. After a warm-up, it is timed for the
+    given number of frames with the garbage collector disabled, then run again under
+    tracemalloc (CPython) or gc.mem_alloc() (CircuitPython) to count allocations.
+
+    Under tracemalloc, a frame counts as allocating if memory was allocated during the frame,
+    even if freed again before it ended, and its bytes are the peak reached above the memory
+    in use at its end. CPython serves some small objects (e.g. floats, short tuples) from free
+    lists that tracemalloc can't see, while others are heap objects in CPython only (ints above
+    256, list iterators, argument tuples of f(*args) calls), so measure on the device for exact
+    figures. A budget of 0 allocations still catches any new buffer, message or container in
+    a hot loop.
+    """
+
+    def __init__(self, frames=1000, warmup=100):
+        self.frames = frames
+        self.warmup = warmup
+        # (name, step, max_allocs, max_bytes, max_ns)
+        self.paths = []
+
+    def add(self, name, step, max_allocs=None, max_bytes=None, max_ns=None):
+        """
+        Add a hot path.
+
+        :param step: Callable processing one frame.
+        :param max_allocs: Budget of allocating frames per frame (0 to 1), None for no budget.
+        :param max_bytes: Budget of allocated bytes per frame, None for no budget.
+        :param max_ns: Budget of nanoseconds per frame, None for no budget.
+        """
+        self.paths.append((name, step, max_allocs, max_bytes, max_ns))
+
+    def run(self):
+        """
+        Measure all paths.
+
+        :return: List of dicts with name, ns_per_frame, allocs_per_frame (None if unknown),
+            bytes_per_frame and violations, a list of the exceeded budgets.
+        """
+        return [self.measure(*path) for path in self.paths]
+
+    def measure(self, name, step, max_allocs=None, max_bytes=None, max_ns=None):
+        frames = self.frames
+        for _ in range(self.warmup):
+            step()
+        gc.collect()
+
+        gc.disable()
+        try:
+            start = _clock_ns()
+            for _ in range(frames):
+                step()
+            ns_per_frame = (_clock_ns() - start) / frames
+            if tracemalloc is None:
+                before = gc.mem_alloc()
+                for _ in range(frames):
+                    step()
+                allocs_per_frame = None
+                bytes_per_frame = (gc.mem_alloc() - before) / frames
+        finally:
+            gc.enable()
+        if tracemalloc is not None:
+            allocs_per_frame, bytes_per_frame = self._trace(step, frames)
+
+        violations = []
+        if max_allocs is not None:
+            # Without allocation counts, a budget of 0 allocations requires 0 bytes
+            measured = allocs_per_frame if allocs_per_frame is not None else bytes_per_frame
+            if measured > max_allocs:
+                violations.append(f"allocs/frame {measured:.3f} > {max_allocs}")
+        if max_bytes is not None and bytes_per_frame > max_bytes:
+            violations.append(f"bytes/frame {bytes_per_frame:.1f} > {max_bytes}")
+        if max_ns is not None and ns_per_frame > max_ns:
+            violations.append(f"ns/frame {ns_per_frame:.0f} > {max_ns}")
+        return {
+            "name": name,
+            "ns_per_frame": ns_per_frame,
+            "allocs_per_frame": allocs_per_frame,
+            "bytes_per_frame": bytes_per_frame,
+            "violations": violations,
+        }
+
+    @staticmethod
+    def _trace(step, frames):
+        tracemalloc.start()
+        try:
+            allocating = 0
+            transient = 0
+            start = tracemalloc.get_traced_memory()[0]
+            for _ in range(frames):
+                tracemalloc.reset_peak()
+                step()
+                current, peak = tracemalloc.get_traced_memory()
+                if peak > current:
+                    allocating += 1
+                    transient += peak - current
+            # Memory still held after all frames, e.g. a list growing by one entry per frame.
+            # Less than a byte per frame is the counters of this loop.
+            retained = tracemalloc.get_traced_memory()[0] - start
+            if retained < frames:
+                retained = 0
+        finally:
+            tracemalloc.stop()
+        if retained and not allocating:
+            allocating = frames
+        return allocating / frames, (transient + retained) / frames
+
+    @staticmethod
+    def report(results):
+        """Format results as a table."""
+        lines = [f"{'path':<44} {'ns/frame':>10} {'allocs/frame':>13} {'bytes/frame':>12}  budget"]
+        for result in results:
+            allocs = result["allocs_per_frame"]
+            allocs = "n/a" if allocs is None else f"{allocs:.3f}"
+            status = "; ".join(result["violations"]) or "ok"
+            lines.append(f"{result['name']:<44} {result['ns_per_frame']:>10.0f} {allocs:>13} "
+                         f"{result['bytes_per_frame']:>12.1f}  {status}")
+        return "\n".join(lines)
@@ -0,0 +1,231 @@
+import time
+
+from .CANopenDomain import CANopenDomain, CANopenStreamDomain
+from .CANopenSDO import CANopenBlockDownload, CANopenSDO, CANopenSDORequest
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class CANopenProgramDownload:
+    """Program download to one node through objects 0x1F50 and 0x1F51 (CiA 302-3)."""
+
+    INDEX_PROGRAM_DATA = 0x1F50
+    INDEX_PROGRAM_CONTROL = 0x1F51
+
+    # Program control (0x1F51) commands
+    CONTROL_STOP = 0x00
+    CONTROL_START = 0x01
+    CONTROL_RESET = 0x02
+    CONTROL_CLEAR = 0x03
+
+    # Steps of the download
+    STEP_STOP = 0
+    STEP_CLEAR = 1
+    STEP_DOWNLOAD = 2
+    STEP_START = 3
+    STEP_DONE = 4
+    STEP_NAMES = ("stop", "clear", "download", "start", "done")
+
+    def __init__(self, node_id, image, program_number=1, size=None, clear=True, start=True):
+        """
+        :param node_id: Node receiving the program.
+        :param image: The program: bytes, a file path, a binary file object, a CANopenDomain,
+            or an iterable of byte chunks that is streamed without being held in memory.
+        :param program_number: Subindex of 0x1F50/0x1F51 to use.
+        :param size: Size of an iterable image if known, so the node can check it up front.
+        :param clear: Clear the program memory before the download.
+        :param start: Start the program after the download.
+        """
+        self.node_id = node_id
+        self.image = image
+        self.program_number = program_number
+        self.size = size
+        self.clear = clear
+        self.start = start
+        self.step = self.STEP_STOP
+        self.abort_code = None
+        self.request = None
+        self.transfer = None
+        self.deadline = None
+        self.retries_left = 0
+        self.bytes_done = 0
+        self.throughput = 0.0
+        self.start_time = None
+        self.end_time = None
+        self._stream_started = False
+
+    @property
+    def done(self):
+        return self.step == self.STEP_DONE
+
+    @property
+    def failed(self):
+        return self.abort_code is not None
+
+    def open_image(self):
+        """Return a domain reading the image from its beginning."""
+        if isinstance(self.image, CANopenDomain):
+            return self.image
+        if isinstance(self.image, str):
+            return CANopenDomain.open(self.image, writable=False)
+        if isinstance(self.image, (bytes, bytearray, memoryview)):
+            return CANopenDomain(bytes(self.image))
+        if hasattr(self.image, "readinto"):
+            self.image.seek(0)
+            return CANopenDomain(self.image)
+        if self._stream_started:
+            raise Exception(f"The image stream for node {self.node_id} was partly consumed and cannot be restarted.")
+        self._stream_started = True
+        return CANopenStreamDomain(self.image, self.size)
+
+    def progress(self):
+        """Return a dict describing the state of the download."""
+        return {
+            "node_id": self.node_id,
+            "step": self.STEP_NAMES[self.step],
+            "bytes": self.bytes_done,
+            "size": self.size,
+            "throughput": self.throughput,
+            "abort_code": self.abort_code,
+        }
+
+
+class CANopenProgramUpdater:
+    """Runs program downloads to many nodes in parallel over one master."""
+
+    def __init__(self, master, timeout=2.0, retries=3, on_progress=None):
+        """
+        :param master: The CANopenMasterNode used for all transfers.
+        :param timeout: Seconds without a response from a node before a request is repeated.
+        :param retries: Repetitions of a request, or retransmissions of a sub-block, before the node fails.
+        :param on_progress: Optional callable(CANopenProgramDownload) run whenever a node makes progress.
+        """
+        self.master = master
+        self.timeout = timeout
+        self.retries = retries
+        self.on_progress = on_progress
+        self.downloads = {}
+
+    def add(self, node_id, image, **kwargs):
+        """Add a node to update; keyword arguments are passed to CANopenProgramDownload."""
+        download = CANopenProgramDownload(node_id, image, **kwargs)
+        self.downloads[node_id] = download
+        return download
+
+    def run(self):
+        """
+        Update all nodes, each one advancing as soon as its previous step completes.
+
+        :return: Dict mapping node ID to None on success, or to the SDO abort code of the failed step.
+        """
+        for download in self.downloads.values():
+            if not download.done and not download.failed:
+                download.start_time = time.monotonic()
+                self._start_step(download)
+        while True:
+            # Timeouts are checked even while frames keep arriving, e.g. PDOs and heartbeats
+            self.master.poll()
+            active = [download for download in self.downloads.values() if not download.done and not download.failed]
+            if not active:
+                break
+            for download in active:
+                self._check(download)
+        return {node_id: download.abort_code for node_id, download in self.downloads.items()}
+
+    def resume(self):
+        """
+        Continue the failed downloads from the step that failed.
+
+        The image transfer itself starts over from the beginning, as 0x1F50 has no offset;
+        interruptions during the transfer are bridged by retransmitting sub-blocks.
+        """
+        for download in self.downloads.values():
+            if download.failed:
+                logger.info(f"Resuming program download to node {download.node_id} at step "
+                            f"{CANopenProgramDownload.STEP_NAMES[download.step]}.")
+                download.abort_code = None
+        return self.run()
+
+    def _start_step(self, download):
+        download.retries_left = self.retries
+        if download.step == download.STEP_CLEAR and not download.clear:
+            download.step += 1
+        if download.step == download.STEP_START and not download.start:
+            download.step += 1
+        if download.step == download.STEP_DONE:
+            download.end_time = time.monotonic()
+            self._report(download)
+        elif download.step == download.STEP_DOWNLOAD:
+            try:
+                domain = download.open_image()
+            except Exception as e:
+                logger.error(str(e))
+                download.abort_code = CANopenSDO.ABORT_GENERAL
+                return
+            download.bytes_done = 0
+            transfer = CANopenBlockDownload(download.node_id, download.INDEX_PROGRAM_DATA,
+                                            download.program_number, domain, self._on_transfer_done)
+            transfer.on_progress = self._on_transfer_progress
+            download.transfer = transfer
+            self.master.start_transfer(transfer)
+        else:
+            self._send_control(download)
+
+    def _send_control(self, download):
+        command = {download.STEP_STOP: download.CONTROL_STOP, download.STEP_CLEAR: download.CONTROL_CLEAR,
+                   download.STEP_START: download.CONTROL_START}[download.step]
+        download.request = CANopenSDORequest(download.node_id, download.INDEX_PROGRAM_CONTROL,
+                                             download.program_number, bytes([command]), self._on_request_done)
+        download.deadline = time.monotonic() + self.timeout
+        self.master.submit(download.request)
+
+    def _check(self, download):
+        if download.step == download.STEP_DOWNLOAD:
+            download.retries_left = self.master.check_transfer(download.transfer, self.timeout,
+                                                               download.retries_left)
+        elif download.request is not None and time.monotonic() >= download.deadline:
+            self.master.cancel(download.request)
+            self.master.get_breaker(download.node_id).record_failure()
+            download.request = None
+            if download.retries_left > 0:
+                download.retries_left -= 1
+                self._send_control(download)
+            else:
+                download.abort_code = CANopenSDO.ABORT_TIMEOUT
+                self._report(download)
+
+    def _on_request_done(self, request):
+        download = self.downloads[request.node_id]
+        if download.request is not request:
+            return
+        download.request = None
+        if request.abort_code is not None:
+            download.abort_code = request.abort_code
+            self._report(download)
+            return
+        download.step += 1
+        self._start_step(download)
+
+    def _on_transfer_progress(self, transfer):
+        download = self.downloads[transfer.node_id]
+        download.bytes_done = transfer.offset
+        download.throughput = transfer.throughput
+        self._report(download)
+
+    def _on_transfer_done(self, transfer):
+        download = self.downloads[transfer.node_id]
+        download.transfer = None
+        if transfer.abort_code is not None:
+            download.abort_code = transfer.abort_code
+            self._report(download)
+            return
+        download.bytes_done = transfer.offset
+        download.size = transfer.offset
+        download.throughput = transfer.throughput
+        download.step += 1
+        self._start_step(download)
+
+    def _report(self, download):
+        if self.on_progress:
+            self.on_progress(download)
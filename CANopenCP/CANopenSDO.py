@@ -1,3 +1,7 @@
+import struct
+import time
+
+from .CANopenDomain import CANopenDomain
 from .CANopenMessage import CANopenMessage
 
 
@@ -14,6 +18,39 @@ class CANopenSDO(CANopenMessage):
     SDO_DOWNLOAD_SEGMENT = 0x00
     SDO_UPLOAD_SEGMENT = 0x60
     SDO_ABORT = 0x80
+    SDO_BLOCK_DOWNLOAD = 0xC0
+
+    # SDO Command Specifier (SCS) for server responses
+    SDO_UPLOAD_RESPONSE = 0x40
+    SDO_DOWNLOAD_RESPONSE = 0x60
+    SDO_BLOCK_DOWNLOAD_RESPONSE = 0xA0
+
+    # Block transfer sub-commands and flags
+    SDO_BLOCK_INITIATE = 0x00
+    SDO_BLOCK_END = 0x01
+    SDO_BLOCK_ACK = 0x02
+    SDO_BLOCK_CRC = 0x04
+    SDO_BLOCK_SIZE_INDICATED = 0x02
+    SDO_BLOCK_LAST_SEGMENT = 0x80
+    SDO_BLOCK_SEGMENT_SIZE = 7
+    SDO_BLOCK_MAX_SEGMENTS = 127
+
+    # Flags of the initiate command byte
+    SDO_EXPEDITED = 0x02
+    SDO_SIZE_INDICATED = 0x01
+
+    # Flags of segment command bytes
+    SDO_TOGGLE = 0x10
+    SDO_NO_MORE_SEGMENTS = 0x01
+    SDO_SEGMENT_SIZE = 7
+
+    # Abort codes used by this library
+    ABORT_TOGGLE = 0x05030000
+    ABORT_TIMEOUT = 0x05040000
+    ABORT_NOT_EXIST = 0x06020000
+    ABORT_CRC = 0x05040004
+    ABORT_INVALID_SEQUENCE = 0x05040003
+    ABORT_GENERAL = 0x08000000
 
     def __init__(self, cob_id, data=bytes()):
         super().__init__(cob_id, data)
@@ -25,6 +62,46 @@ class CANopenSDO(CANopenMessage):
         data_format = 'B' + f'{len(data_bytes)}s'
         super().set_data(data_format, command_specifier, data_bytes)
 
+    def set_expedited(self, command_specifier, index, subindex, data=b''):
+        """
+        Set the data for an expedited transfer frame.
+
+        :param command_specifier: SDO_UPLOAD_RESPONSE or SDO_DOWNLOAD_INITIATE.
+        :param index: Object dictionary index.
+        :param subindex: Object dictionary subindex.
+        :param data: Up to 4 bytes of payload.
+        """
+        if len(data) > 4:
+            raise ValueError("Expedited transfers carry at most 4 bytes.")
+        command = (command_specifier | self.SDO_EXPEDITED | self.SDO_SIZE_INDICATED
+                   | ((4 - len(data)) << 2))
+        if len(self.data) == 8:
+            # Reuse the frame buffer, so responses sent in a loop don't allocate
+            struct.pack_into("<BHB4s", self.data, 0, command, index, subindex, data)
+        else:
+            self.data = struct.pack("<BHB4s", command, index, subindex, bytes(data))
+
+
+def to_domain(value):
+    """Wrap bytes or a binary file object in a CANopenDomain."""
+    if isinstance(value, CANopenDomain):
+        return value
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return CANopenDomain(bytes(value))
+    return CANopenDomain(value)
+
+
+def crc16(data, crc=0):
+    """CRC-16-CCITT (polynomial 0x1021, initial value 0) as used by SDO block transfers."""
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+    return crc
+
 
 class CANopenClientSDO(CANopenSDO):
     """CANopen Client SDO for sending requests."""
@@ -43,3 +120,327 @@ class CANopenServerSDO(CANopenSDO):
         self.id = node_id
         cob_id = self.COB_ID_SDO_TX + node_id  # Typically, server SDOs use TX base for responses.
         super().__init__(cob_id, data)
+
+
+class CANopenSDORequest:
+    """An outstanding SDO request issued by a master to a remote node."""
+
+    def __init__(self, node_id, index, subindex, data=None, callback=None):
+        """
+        :param node_id: The node ID of the remote SDO server.
+        :param index: Object dictionary index.
+        :param subindex: Object dictionary subindex.
+        :param data: Bytes to download, or None for an upload.
+        :param callback: Called with the request once it is done.
+        """
+        self.node_id = node_id
+        self.index = index
+        self.subindex = subindex
+        self.data = data
+        self.callback = callback
+        self.result = None
+        self.abort_code = None
+        self.done = False
+        self.attempts = 0  # Number of times the request was sent
+        self.sent_time = None  # time.monotonic() of the last send
+
+    @property
+    def key(self):
+        return self.node_id, self.index, self.subindex
+
+    @property
+    def is_upload(self):
+        return self.data is None
+
+    def to_message(self):
+        """Build the initiate frame for this request."""
+        message = CANopenClientSDO(self.node_id)
+        if self.is_upload:
+            message.data = struct.pack("<BHB4x", CANopenSDO.SDO_UPLOAD_INITIATE, self.index, self.subindex)
+        else:
+            message.set_expedited(CANopenSDO.SDO_DOWNLOAD_INITIATE, self.index, self.subindex, self.data)
+        return message
+
+    def complete(self, result=None, abort_code=None):
+        """Mark the request as done and run its callback."""
+        self.result = result
+        self.abort_code = abort_code
+        self.done = True
+        if self.callback:
+            self.callback(self)
+
+    def process_response(self, data):
+        """
+        Complete the request from a server response frame.
+
+        :param data: The 8 data bytes received from the server.
+        """
+        command = data[0]
+        if command == CANopenSDO.SDO_ABORT:
+            abort_code, = struct.unpack("<I", bytes(data[4:8]))
+            self.complete(abort_code=abort_code)
+        elif self.is_upload and command & 0xE0 == CANopenSDO.SDO_UPLOAD_RESPONSE:
+            if command & CANopenSDO.SDO_EXPEDITED:
+                size = 4
+                if command & CANopenSDO.SDO_SIZE_INDICATED:
+                    size = 4 - ((command >> 2) & 0x03)
+                self.complete(result=bytes(data[4:4 + size]))
+            else:
+                # Segmented uploads are not supported by this request type
+                self.complete(abort_code=CANopenSDO.ABORT_GENERAL)
+        elif not self.is_upload and command & 0xE0 == CANopenSDO.SDO_DOWNLOAD_RESPONSE:
+            self.complete(result=self.data)
+        else:
+            self.complete(abort_code=CANopenSDO.ABORT_GENERAL)
+
+
+class CANopenBlockDownload:
+    """Client side state machine of an SDO block download to a remote node."""
+
+    STATE_INITIATE = 0
+    STATE_SUBBLOCK = 1
+    STATE_END = 2
+    STATE_DONE = 3
+
+    def __init__(self, node_id, index, subindex, data, callback=None):
+        """
+        :param node_id: The node ID of the remote SDO server.
+        :param index: Object dictionary index.
+        :param subindex: Object dictionary subindex.
+        :param data: The value to download: bytes, a CANopenDomain or a binary file object.
+            Domains and files are streamed one segment at a time.
+        :param callback: Called with the transfer once it is done.
+        """
+        self.node_id = node_id
+        self.index = index
+        self.subindex = subindex
+        self.domain = to_domain(data)
+        self.size = self.domain.size  # None for streams of unknown size
+        self.callback = callback
+        self.on_progress = None  # Optional callable(transfer) run on every acknowledged sub-block
+        self.state = self.STATE_INITIATE
+        self.offset = 0  # Bytes acknowledged by the server
+        self.blksize = 0
+        self.crc = 0
+        self.abort_code = None
+        self.done = False
+        self.start_time = None
+        self.last_activity = None
+        self._sent_last = False
+        self._sent_count = 0  # Segments sent in the current sub-block
+        self._last_count = 0  # Data bytes in the last segment
+        self._send = None
+        self._crc_offset = 0  # Bytes included in the CRC so far
+        self._segment = bytearray(CANopenSDO.SDO_BLOCK_SEGMENT_SIZE)
+
+    @property
+    def throughput(self):
+        """Acknowledged bytes per second since the transfer started."""
+        elapsed = time.monotonic() - self.start_time if self.start_time is not None else 0
+        return self.offset / elapsed if elapsed > 0 else 0.0
+
+    def start(self, send):
+        """
+        Send the initiate request.
+
+        :param send: Callable used to put a CANopenMessage on the bus.
+        """
+        self._send = send
+        self.start_time = self.last_activity = time.monotonic()
+        self._send_initiate()
+
+    def _send_initiate(self):
+        command = CANopenSDO.SDO_BLOCK_DOWNLOAD | CANopenSDO.SDO_BLOCK_CRC | CANopenSDO.SDO_BLOCK_INITIATE
+        if self.size is not None:
+            command |= CANopenSDO.SDO_BLOCK_SIZE_INDICATED
+        self._send_frame(struct.pack("<BHBI", command, self.index, self.subindex, self.size or 0))
+
+    def retransmit(self):
+        """Repeat the last request after an interruption, continuing from the last acknowledged segment."""
+        self.last_activity = time.monotonic()
+        if self.state == self.STATE_INITIATE:
+            self._send_initiate()
+        elif self.state == self.STATE_SUBBLOCK:
+            self._send_subblock()
+        elif self.state == self.STATE_END:
+            self._send_end()
+
+    def process_response(self, data):
+        """Advance the transfer with a frame received from the server."""
+        self.last_activity = time.monotonic()
+        command = data[0]
+        if command == CANopenSDO.SDO_ABORT:
+            abort_code, = struct.unpack("<I", bytes(data[4:8]))
+            self._finish(abort_code)
+        elif command & 0xE0 != CANopenSDO.SDO_BLOCK_DOWNLOAD_RESPONSE:
+            self.abort(CANopenSDO.ABORT_GENERAL)
+        elif self.state == self.STATE_INITIATE and command & 0x03 == CANopenSDO.SDO_BLOCK_INITIATE:
+            self.blksize = data[4]
+            self.state = self.STATE_SUBBLOCK
+            self._send_subblock()
+        elif self.state == self.STATE_SUBBLOCK and command & 0x03 == CANopenSDO.SDO_BLOCK_ACK:
+            acked = min(data[1], self._sent_count)
+            all_acked = self._sent_last and acked == self._sent_count
+            if all_acked:
+                self.offset += (acked - 1) * CANopenSDO.SDO_BLOCK_SEGMENT_SIZE + self._last_count
+            else:
+                self.offset += acked * CANopenSDO.SDO_BLOCK_SEGMENT_SIZE
+            self.domain.release(self.offset)
+            self.blksize = data[2]
+            if self.on_progress:
+                self.on_progress(self)
+            if all_acked:
+                self.state = self.STATE_END
+                self._send_end()
+            else:
+                self._send_subblock()
+        elif self.state == self.STATE_END and command & 0x03 == CANopenSDO.SDO_BLOCK_END:
+            self._finish()
+        else:
+            self.abort(CANopenSDO.ABORT_GENERAL)
+
+    def abort(self, abort_code):
+        """Abort the transfer and notify the server."""
+        if not self.done:
+            self._send_frame(struct.pack("<BHBI", CANopenSDO.SDO_ABORT, self.index, self.subindex, abort_code))
+            self._finish(abort_code)
+
+    def _send_end(self):
+        unused = CANopenSDO.SDO_BLOCK_SEGMENT_SIZE - self._last_count
+        command = CANopenSDO.SDO_BLOCK_DOWNLOAD | (unused << 2) | CANopenSDO.SDO_BLOCK_END
+        self._send_frame(struct.pack("<BH5x", command, self.crc))
+
+    def _send_subblock(self):
+        """Send up to blksize segments starting at the last acknowledged offset."""
+        offset = self.offset
+        segment = self._segment
+        self._sent_last = False
+        self._sent_count = 0
+        for seqno in range(1, self.blksize + 1):
+            count = self.domain.readinto(offset, segment)
+            self._sent_count = seqno
+            for position in range(count, CANopenSDO.SDO_BLOCK_SEGMENT_SIZE):
+                segment[position] = 0
+            if offset == self._crc_offset and count:
+                # Repeated segments are already part of the CRC
+                self.crc = crc16(memoryview(segment)[:count], self.crc)
+                self._crc_offset += count
+            offset += CANopenSDO.SDO_BLOCK_SEGMENT_SIZE
+            if count < CANopenSDO.SDO_BLOCK_SEGMENT_SIZE or self.domain.at_end(offset):
+                seqno |= CANopenSDO.SDO_BLOCK_LAST_SEGMENT
+                self._sent_last = True
+                self._last_count = count
+            self._send_frame(struct.pack("<B7s", seqno, segment))
+            if self._sent_last:
+                break
+
+    def _send_frame(self, data):
+        message = CANopenClientSDO(self.node_id)
+        message.data = data
+        self._send(message)
+
+    def _finish(self, abort_code=None):
+        self.abort_code = abort_code
+        self.state = self.STATE_DONE
+        self.done = True
+        if self.callback:
+            self.callback(self)
+
+
+class CANopenSegmentedUpload:
+    """Client side state machine of an SDO upload streamed into a sink."""
+
+    STATE_INITIATE = 0
+    STATE_SEGMENT = 1
+    STATE_DONE = 2
+
+    def __init__(self, node_id, index, subindex, sink=None, callback=None):
+        """
+        :param node_id: The node ID of the remote SDO server.
+        :param index: Object dictionary index.
+        :param subindex: Object dictionary subindex.
+        :param sink: CANopenDomain or binary file object receiving the value, in memory if None.
+        :param callback: Called with the transfer once it is done.
+        """
+        self.node_id = node_id
+        self.index = index
+        self.subindex = subindex
+        self.domain = to_domain(sink) if sink is not None else CANopenDomain()
+        self.callback = callback
+        self.state = self.STATE_INITIATE
+        self.size = None  # Size announced by the server, if any
+        self.offset = 0
+        self.toggle = 0
+        self.abort_code = None
+        self.done = False
+        self.last_activity = None
+        self._send = None
+
+    def start(self, send):
+        self._send = send
+        self.last_activity = time.monotonic()
+        self.domain.truncate(0)
+        self._send_initiate()
+
+    def retransmit(self):
+        """Repeat the last request after an interruption."""
+        self.last_activity = time.monotonic()
+        if self.state == self.STATE_INITIATE:
+            self._send_initiate()
+        elif self.state == self.STATE_SEGMENT:
+            self._request_segment()
+
+    def _send_initiate(self):
+        self._send_frame(struct.pack("<BHB4x", CANopenSDO.SDO_UPLOAD_INITIATE, self.index, self.subindex))
+
+    def process_response(self, data):
+        """Advance the transfer with a frame received from the server."""
+        self.last_activity = time.monotonic()
+        command = data[0]
+        if command == CANopenSDO.SDO_ABORT:
+            abort_code, = struct.unpack("<I", bytes(data[4:8]))
+            self._finish(abort_code)
+        elif self.state == self.STATE_INITIATE and command & 0xE0 == CANopenSDO.SDO_UPLOAD_RESPONSE:
+            if command & CANopenSDO.SDO_EXPEDITED:
+                size = 4 - ((command >> 2) & 0x03) if command & CANopenSDO.SDO_SIZE_INDICATED else 4
+                self.domain.write(0, data[4:4 + size])
+                self._finish()
+                return
+            if command & CANopenSDO.SDO_SIZE_INDICATED:
+                self.size, = struct.unpack("<I", bytes(data[4:8]))
+            self.state = self.STATE_SEGMENT
+            self._request_segment()
+        elif self.state == self.STATE_SEGMENT and command & 0xE0 == 0x00:
+            if command & CANopenSDO.SDO_TOGGLE != self.toggle:
+                self.abort(CANopenSDO.ABORT_TOGGLE)
+                return
+            count = CANopenSDO.SDO_SEGMENT_SIZE - ((command >> 1) & 0x07)
+            self.domain.write(self.offset, memoryview(data)[1:1 + count])
+            self.offset += count
+            if command & CANopenSDO.SDO_NO_MORE_SEGMENTS:
+                self._finish()
+            else:
+                self.toggle ^= CANopenSDO.SDO_TOGGLE
+                self._request_segment()
+        else:
+            self.abort(CANopenSDO.ABORT_GENERAL)
+
+    def abort(self, abort_code):
+        if not self.done:
+            self._send_frame(struct.pack("<BHBI", CANopenSDO.SDO_ABORT, self.index, self.subindex, abort_code))
+            self._finish(abort_code)
+
+    def _request_segment(self):
+        self._send_frame(struct.pack("<B7x", CANopenSDO.SDO_UPLOAD_SEGMENT | self.toggle))
+
+    def _send_frame(self, data):
+        message = CANopenClientSDO(self.node_id)
+        message.data = data
+        self._send(message)
+
+    def _finish(self, abort_code=None):
+        self.abort_code = abort_code
+        self.state = self.STATE_DONE
+        self.done = True
+        if self.callback:
+            self.callback(self)
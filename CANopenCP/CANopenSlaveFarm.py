@@ -0,0 +1,143 @@
+from .CANopenLSS import CANopenLSS
+from .CANopenMessage import CANopenMessage
+from .CANopenNode import CANopenSlaveNode
+from .CANopenObjectDictionary import CANopenObjectDictionary
+from .CANopenPDO import CANopenMPDO, CANopenMPDOConsumer
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class CANopenSlaveFarm:
+    """
+    Many simulated slaves behind one CAN interface, e.g. to load-test a master.
+
+    All nodes are built from one shared object dictionary template and only keep the
+    entries they change (see CANopenObjectDictionary). Received frames are read once and
+    routed by COB-ID to the addressed node, instead of every node polling the controller.
+    """
+
+    def __init__(self, mcp, template=None, on_rpdo=None):
+        """
+        :param mcp: The CAN interface shared by all nodes.
+        :param template: Dict of (index, subindex) -> value, the default object dictionary of every node.
+        :param on_rpdo: Called with (node, PDO number 1-4, data) for every RPDO received by a node
+            without a CANopenReceivePDO registered for it. By default the node answers with the TPDO of the same number carrying the same data.
+        """
+        self.mcp = mcp
+        self.template = template if template is not None else {}
+        self.on_rpdo = on_rpdo if on_rpdo is not None else self.echo_rpdo
+        # node_id -> CANopenSlaveNode
+        self.nodes = {}
+        # Optional CANopenBusLoad fed with every received frame
+        self.bus_load = None
+        # Stamp received frames with time.monotonic_ns(), see CANopenNode.timestamps
+        self.timestamps = False
+        # COB-IDs of the MPDOs consumed by every node
+        self.mpdo_cob_ids = set()
+
+    def add_node(self, node_id, overrides=None):
+        """
+        Add a simulated node.
+
+        :param overrides: Dict of node specific entries, e.g. the serial number 0x1018:4.
+        :return: The CANopenSlaveNode.
+        """
+        if node_id in self.nodes:
+            raise Exception(f"Node {node_id} already exists in the farm.")
+        node = CANopenSlaveNode(node_id, self.mcp, CANopenObjectDictionary(self.template, overrides))
+        for cob_id in self.mpdo_cob_ids:
+            node.add_rpdo(CANopenMPDOConsumer(node, cob_id))
+        self.nodes[node_id] = node
+        return node
+
+    def add_mpdo(self, cob_id):
+        """Make every node, including those added later, consume the MPDOs sent on a COB-ID."""
+        self.mpdo_cob_ids.add(cob_id)
+        for node in self.nodes.values():
+            node.add_rpdo(CANopenMPDOConsumer(node, cob_id))
+
+    def remove_node(self, node_id):
+        self.nodes.pop(node_id, None)
+
+    def process(self):
+        """
+        Drain all frames available from the interface and dispatch them.
+
+        :return: The number of frames processed.
+        """
+        count = 0
+        while True:
+            message = self.mcp.read_message()
+            if message is None:
+                return count
+            if self.timestamps:
+                CANopenMessage.stamp(message, self.mcp)
+            if self.bus_load is not None:
+                self.bus_load.add_frame(len(message.data))
+            self.process_message(message)
+            count += 1
+
+    def process_message(self, message):
+        """Route a single received frame to the node it addresses."""
+        cob_id = message.id
+        function = cob_id & 0x780
+        if cob_id in self.mpdo_cob_ids:
+            self.process_mpdo(message)
+        elif function == CANopenMessage.COB_ID_SDO_RX:
+            node = self.nodes.get(cob_id & 0x7F)
+            if node is not None:
+                node.process_message(message)
+        elif CANopenMessage.COB_ID_PDO1_RX <= function <= CANopenMessage.COB_ID_PDO4_RX and function & 0x080 == 0:
+            node = self.nodes.get(cob_id & 0x7F)
+            if node is None:
+                return
+            rpdo = node.rpdos.get(cob_id)
+            if rpdo is not None:
+                rpdo.process(message)
+                if node.notifier is not None:
+                    node.notifier.frame_processed(message)
+            else:
+                self.on_rpdo(node, (function >> 8) - 1, message.data)
+        elif cob_id == CANopenMessage.COB_ID_SYNC:
+            # Ends the batch of change notifications of nodes batching per SYNC
+            for node in self.nodes.values():
+                if node.notifier is not None:
+                    node.notifier.frame_processed(message)
+        elif cob_id == CANopenMessage.COB_ID_NMT and len(message.data) >= 2:
+            self.process_nmt(message.data[0], message.data[1])
+        elif cob_id == CANopenLSS.COB_ID_LSS_MASTER:
+            for node in self.nodes.values():
+                if node.lss is not None:
+                    node.lss.process(message)
+
+    def process_mpdo(self, message):
+        """Hand an MPDO to the node it addresses, or to all nodes for broadcasts and source address mode."""
+        address = message.data[0] if message.data else 0
+        node_id = address & CANopenMPDO.NODE_ID_MASK
+        if address & CANopenMPDO.ADDRESS_DAM and node_id != CANopenMPDO.ALL_NODES:
+            nodes = [self.nodes[node_id]] if node_id in self.nodes else []
+        else:
+            nodes = self.nodes.values()
+        for node in nodes:
+            node.rpdos[message.id].process(message)
+            if node.notifier is not None:
+                node.notifier.frame_processed(message)
+
+    def process_nmt(self, command, node_id):
+        nodes = self.nodes.values() if node_id == 0 else [self.nodes.get(node_id)]
+        for node in nodes:
+            if node is None:
+                continue
+            try:
+                node.process_nmt(command, node_id)
+            except ValueError as e:
+                logger.warning(f"Node {node.node_id}: {e}")
+                break
+
+    @staticmethod
+    def echo_rpdo(node, number, data):
+        """Answer an RPDO with the TPDO of the same number and the same data."""
+        tpdo_cob_id = CANopenMessage.COB_ID_PDO1_TX + (number - 1) * 0x100 + node.node_id
+        node.send(CANopenMessage(tpdo_cob_id, bytes(data)))
@@ -0,0 +1,261 @@
+import os
+import struct
+
+from .CANopenDCF import CANopenDCF
+from .CANopenDomain import CANopenDomain, replace_file
+from .CANopenSDO import crc16
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class CANopenParameterStore:
+    """
+    Persistent storage of a slave's parameters, driven by objects 0x1010 (store) and 0x1011 (restore).
+
+    Parameters are the writable entries: those given to the constructor, e.g. the entries of
+    a DCF (which only holds writable ones), those written over SDO, USDO, MPDO or a Concise
+    DCF, and those restored from storage. Read-only, diagnostic and mapped process data
+    entries set by the device itself are not stored.
+
+    Parameters are kept in a snapshot file in Concise DCF format plus an append-only journal
+    of the entries changed since. A store command compares every parameter with its last
+    stored value and only appends records for those that differ to the journal; the snapshot
+    is rewritten (compaction) when the journal grows beyond compact_size, or when compact()
+    is called at a convenient time. On attach, the snapshot is loaded and the journal
+    replayed into the node's object dictionary.
+
+    Journal records are a header (type, index, subindex, length), the data and a CRC-16, so
+    a record torn by a power loss is detected and dropped on the next load.
+
+    On CircuitPython, the filesystem must be writable from code (see storage.remount() in boot.py).
+    """
+
+    INDEX_STORE = 0x1010
+    INDEX_RESTORE = 0x1011
+
+    # Signatures written to 0x1010 and 0x1011, "save" and "load" in ASCII
+    SIGNATURE_STORE = b"save"
+    SIGNATURE_RESTORE = b"load"
+
+    # Subindex -> range of indexes affected by a store or restore command
+    SUB_ALL = 1
+    SUB_COMMUNICATION = 2
+    SUB_APPLICATION = 3
+    SUB_MANUFACTURER = 4
+    RANGES = {
+        SUB_ALL: (0x1000, 0x9FFF),
+        SUB_COMMUNICATION: (0x1000, 0x1FFF),
+        SUB_APPLICATION: (0x6000, 0x9FFF),
+        SUB_MANUFACTURER: (0x2000, 0x5FFF),
+    }
+
+    # Value of 0x1010/0x1011 subindexes: the device saves/restores on command
+    CAPABILITY_ON_COMMAND = struct.pack("<I", 1)
+
+    # Journal records
+    RECORD_SET = 0x01  # Entry value
+    RECORD_DEFAULT = 0x02  # Revert the index range [index, data as UNSIGNED16] to defaults
+    RECORD_HEADER = "<BHBH"
+    RECORD_HEADER_SIZE = 6
+
+    ABORT_STORE = 0x08000020  # Data can't be transferred or stored to the application
+    ABORT_NO_SUBINDEX = 0x06090011
+
+    def __init__(self, path, compact_size=4096, parameters=None):
+        """
+        :param path: Snapshot file; the journal is kept next to it with a .journal suffix.
+        :param compact_size: Journal size in bytes beyond which a store rewrites the snapshot.
+        :param parameters: (index, subindex) keys of the parameters the application sets itself,
+            or a CANopenDCF whose entries are the writable parameters.
+        """
+        self.path = path
+        self.journal_path = path + ".journal"
+        # New snapshot written by compact() before it replaces the old one
+        self.temporary_path = path + ".tmp"
+        self.compact_size = compact_size
+        self.node = None
+        # (index, subindex) -> value as bytes in the snapshot and journal, i.e. restored on the next load
+        self.persisted = {}
+        if isinstance(parameters, CANopenDCF):
+            parameters = parameters.entries
+        # (index, subindex) of the entries stored by a store command
+        self.parameters = {key for key in parameters or () if self.is_storable(*key)}
+        self._journal_size = None  # Size of the valid part of the journal, known after load()
+
+    def attach(self, node):
+        """
+        Connect the store to a slave node and restore the stored parameters into its object dictionary.
+
+        :return: The number of entries restored.
+        """
+        self.node = node
+        node.storage = self
+        for index in (self.INDEX_STORE, self.INDEX_RESTORE):
+            node.data_dict[(index, 0)] = bytes([len(self.RANGES)])
+            for subindex in self.RANGES:
+                node.data_dict[(index, subindex)] = self.CAPABILITY_ON_COMMAND
+        entries = self.load()
+        for key, value in entries.items():
+            node.data_dict[key] = value
+        self.persisted = entries
+        self.parameters.update(entries)
+        return len(entries)
+
+    def written(self, index, subindex):
+        """Make an entry written over the network a parameter."""
+        if self.is_storable(index, subindex):
+            self.parameters.add((index, subindex))
+
+    def is_storable(self, index, subindex):
+        return self.RANGES[self.SUB_ALL][0] <= index <= self.RANGES[self.SUB_ALL][1] and \
+            index not in (self.INDEX_STORE, self.INDEX_RESTORE, CANopenDCF.CONCISE_DCF_INDEX)
+
+    def command(self, index, subindex, data):
+        """
+        Execute an SDO write to 0x1010 or 0x1011.
+
+        :return: None on success, else the SDO abort code.
+        """
+        if subindex not in self.RANGES:
+            return self.ABORT_NO_SUBINDEX
+        signature = self.SIGNATURE_STORE if index == self.INDEX_STORE else self.SIGNATURE_RESTORE
+        if bytes(data) != signature:
+            return self.ABORT_STORE
+        try:
+            if index == self.INDEX_STORE:
+                self.store(subindex)
+            else:
+                self.restore_defaults(subindex)
+        except OSError as e:
+            logger.error(f"Parameter storage failed: {e}")
+            return self.ABORT_STORE
+        return None
+
+    def store(self, subindex=SUB_ALL):
+        """
+        Append the parameters within the range of the subindex that differ from their stored value to the journal.
+
+        Parameters are compared with what is stored rather than tracked on write, so values the
+        application set directly in the node's data_dict are stored as well.
+        """
+        first, last = self.RANGES[subindex]
+        data_dict = self.node.data_dict
+        stored = {}
+        for key in sorted(key for key in self.parameters if first <= key[0] <= last):
+            value = data_dict.get(key)
+            if value is None or isinstance(value, CANopenDomain):
+                continue
+            value = bytes(value)
+            if self.persisted.get(key) != value:
+                stored[key] = value
+        self._append([self._record(self.RECORD_SET, key[0], key[1], value) for key, value in stored.items()])
+        self.persisted.update(stored)
+        if self._journal_size > self.compact_size:
+            self.compact()
+
+    def restore_defaults(self, subindex=SUB_ALL):
+        """
+        Drop the stored parameters within the range of the subindex.
+
+        Like on any CANopen device, the defaults become effective after the next reset.
+        """
+        first, last = self.RANGES[subindex]
+        self._append([self._record(self.RECORD_DEFAULT, first, 0, struct.pack("<H", last))])
+        for key in [key for key in self.persisted if first <= key[0] <= last]:
+            del self.persisted[key]
+
+    def load(self):
+        """
+        Read the snapshot and replay the journal.
+
+        :return: Dict of (index, subindex) -> stored value.
+        """
+        entries = {}
+        # Without a snapshot, a compaction was interrupted after removing it, and the new one is complete
+        for path in (self.path, self.temporary_path):
+            try:
+                snapshot = open(path, "rb")
+            except OSError:
+                continue
+            with snapshot:
+                try:
+                    for index, subindex, value in CANopenDCF.iter_concise(snapshot.read()):
+                        entries[(index, subindex)] = value
+                except ValueError as e:
+                    logger.error(f"Parameter snapshot {path} is corrupt: {e}")
+            break
+        self._journal_size = self._replay(entries)
+        return entries
+
+    def _replay(self, entries):
+        """Apply the journal records to entries and return the size of the valid part of the journal."""
+        try:
+            journal = open(self.journal_path, "rb")
+        except OSError:
+            return 0
+        valid = 0
+        with journal:
+            while True:
+                header = journal.read(self.RECORD_HEADER_SIZE)
+                if not header:
+                    break
+                if len(header) < self.RECORD_HEADER_SIZE:
+                    logger.warning("Dropping torn record at the end of the parameter journal.")
+                    break
+                record_type, index, subindex, length = struct.unpack(self.RECORD_HEADER, header)
+                body = journal.read(length + 2)
+                if len(body) < length + 2 or crc16(body[:length], crc16(header)) != \
+                        struct.unpack("<H", body[length:])[0]:
+                    logger.warning("Dropping torn record at the end of the parameter journal.")
+                    break
+                data = body[:length]
+                if record_type == self.RECORD_SET:
+                    entries[(index, subindex)] = data
+                elif record_type == self.RECORD_DEFAULT:
+                    last, = struct.unpack("<H", data)
+                    for key in [key for key in entries if index <= key[0] <= last]:
+                        del entries[key]
+                valid += self.RECORD_HEADER_SIZE + length + 2
+        return valid
+
+    def compact(self):
+        """Fold the journal into a new snapshot and empty the journal."""
+        entries = self.load()
+        with open(self.temporary_path, "wb") as snapshot:
+            snapshot.write(CANopenDCF(entries).to_concise())
+            self._sync(snapshot)
+        # A power loss leaves the old or the new snapshot with the journal. Where rename can't replace a
+        # file (CircuitPython) the old snapshot is removed first, and load() then reads the new one
+        replace_file(self.temporary_path, self.path)
+        with open(self.journal_path, "wb") as journal:
+            self._sync(journal)
+        self._journal_size = 0
+
+    def _record(self, record_type, index, subindex, data):
+        header = struct.pack(self.RECORD_HEADER, record_type, index, subindex, len(data))
+        return header + data + struct.pack("<H", crc16(data, crc16(header)))
+
+    def _append(self, records):
+        if self._journal_size is None:
+            self.load()
+        data = b"".join(records)
+        if not data:
+            return
+        try:
+            journal = open(self.journal_path, "r+b")
+        except OSError:
+            journal = open(self.journal_path, "wb")
+        with journal:
+            # Overwrite a torn record left by a power loss; any rest of it fails its CRC on load
+            journal.seek(self._journal_size)
+            journal.write(data)
+            self._sync(journal)
+        self._journal_size += len(data)
+
+    @staticmethod
+    def _sync(file):
+        file.flush()
+        if hasattr(os, "fsync"):
+            os.fsync(file.fileno())
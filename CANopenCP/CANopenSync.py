@@ -0,0 +1,310 @@
+import math
+import struct
+import time
+
+from .CANopenMessage import CANopenMessage
+
+# Start of CANopen TIME_OF_DAY, 1984-01-01 00:00 UTC, in seconds since 1970-01-01
+TIME_EPOCH = 441763200
+MS_PER_DAY = 86400000
+
+
+def encode_time_of_day(unix_time):
+    """Encode seconds since 1970-01-01 UTC as a 6 byte TIME_OF_DAY (ms after midnight, days since 1984-01-01)."""
+    ms = int(round((unix_time - TIME_EPOCH) * 1000))
+    days, ms = divmod(ms, MS_PER_DAY)
+    return struct.pack("<IH", ms & 0x0FFFFFFF, days & 0xFFFF)
+
+
+def decode_time_of_day(data):
+    """Decode a TIME_OF_DAY to seconds since 1970-01-01 UTC."""
+    ms, days = struct.unpack_from("<IH", data)
+    return TIME_EPOCH + days * 86400 + (ms & 0x0FFFFFFF) / 1000
+
+
+class CANopenTimingStats:
+    """
+    Running statistics of a series of durations in nanoseconds.
+
+    Count, mean, standard deviation, minimum and maximum cover all samples; percentiles
+    are computed over the last window samples.
+    """
+
+    def __init__(self, window=1024):
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = 0.0
+        self.min = None
+        self.max = None
+        self._m2 = 0.0
+        self._samples = [0] * self.window
+        self._position = 0
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self._samples[self._position] = value
+        self._position = (self._position + 1) % self.window
+
+    @property
+    def stdev(self):
+        return math.sqrt(self._m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+    def percentile(self, percent):
+        """Return the given percentile (0-100) of the last window samples, None without samples."""
+        samples = sorted(self._samples[:min(self.count, self.window)])
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+    def summary(self):
+        """Return a dict of count, mean, stdev, min, p50, p99 and max."""
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "stdev": self.stdev,
+            "min": self.min,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class CANopenSyncProducer:
+    """
+    SYNC producer sending a SYNC frame (0x080) every period from the application loop.
+
+    SYNCs are scheduled on a fixed grid, so a late one does not delay the following ones,
+    and the jitter of the actual transmission times against the grid is recorded in
+    send_jitter.
+    """
+
+    def __init__(self, node, period, counter_overflow=0, on_sync=None):
+        """
+        :param node: The CANopenNode sending the SYNC.
+        :param period: Communication cycle period (0x1006) in seconds.
+        :param counter_overflow: Synchronous counter overflow value (0x1019), 2-240; 0 for SYNCs without counter.
+        :param on_sync: Called with (timestamp_ns, counter) after every SYNC sent, e.g. CANopenSyncConsumer.record_sync.
+        """
+        if counter_overflow and not 2 <= counter_overflow <= 240:
+            raise ValueError("The SYNC counter overflow value must be 0 or 2-240.")
+        self.node = node
+        self.period_ns = int(period * 1e9)
+        self.counter_overflow = counter_overflow
+        self.on_sync = on_sync
+        self.counter = 0
+        self.last_sync_ns = None
+        # Transmission time minus the scheduled time of every SYNC
+        self.send_jitter = CANopenTimingStats()
+        self._next_ns = None
+        self._message = CANopenMessage(CANopenMessage.COB_ID_SYNC, bytes(1 if counter_overflow else 0))
+
+    def process(self, now_ns=None):
+        """
+        Send the SYNC if it is due. Call this from the application loop.
+
+        :return: True if a SYNC was sent.
+        """
+        now_ns = time.monotonic_ns() if now_ns is None else now_ns
+        if self._next_ns is None:
+            self._next_ns = now_ns
+        if now_ns < self._next_ns:
+            return False
+        if self.counter_overflow:
+            self.counter = self.counter % self.counter_overflow + 1
+            self._message.data[0] = self.counter
+        self.node.send(self._message)
+        sent_ns = time.monotonic_ns()
+        self.send_jitter.add(sent_ns - self._next_ns)
+        self.last_sync_ns = sent_ns
+        # Skip the periods missed entirely, but stay on the grid
+        self._next_ns += self.period_ns * max(1, (now_ns - self._next_ns) // self.period_ns + 1)
+        if self.on_sync is not None:
+            self.on_sync(sent_ns, self.counter if self.counter_overflow else None)
+        return True
+
+
+class CANopenSyncConsumer:
+    """
+    SYNC consumer analysing the timing of a synchronous network.
+
+    It records the interval between SYNCs and their deviation from the communication cycle
+    period (jitter), and the latency from the last SYNC to every synchronous PDO received.
+    All times come from the receive timestamps of the frames (CANopenMessage.stamp()).
+
+    On a slave, register it with node.add_rpdo() to receive the SYNC, which turns on the
+    node's timestamps; on a master, set master.timestamps and register it with
+    add_handler(CANopenMessage.COB_ID_SYNC, consumer.process), or connect a local
+    CANopenSyncProducer with on_sync=consumer.record_sync. PDO latencies are recorded by
+    watch() for CANopenReceivePDO objects, or by passing received frames to pdo_received(),
+    e.g. as a master handler.
+    """
+
+    # Makes CANopenNode.add_rpdo() turn on the node's timestamps
+    needs_timestamps = True
+
+    def __init__(self, period=None, sync_window=None, window=1024):
+        """
+        :param period: Expected communication cycle period (0x1006) in seconds, the mean interval if None.
+        :param sync_window: Synchronous window length (0x1007) in seconds; PDOs received later after
+            the SYNC are counted in late_pdos.
+        :param window: Samples kept for percentiles.
+        """
+        self.cob_id = CANopenMessage.COB_ID_SYNC
+        self.period_ns = None if period is None else int(period * 1e9)
+        self.sync_window_ns = None if sync_window is None else int(sync_window * 1e9)
+        self.last_sync_ns = None
+        self.last_counter = None
+        # Interval between consecutive SYNCs
+        self.intervals = CANopenTimingStats(window)
+        # Interval minus the period, only if the period is known
+        self.jitter = CANopenTimingStats(window)
+        # Time from the last SYNC to the PDOs received after it, for all PDOs and per COB-ID
+        self.latency = CANopenTimingStats(window)
+        self.pdo_latency = {}
+        self.window = window
+        self.missed_syncs = 0  # Gaps in the SYNC counter
+        self.late_pdos = 0
+
+    def process(self, message):
+        """
+        Handle a received frame.
+
+        :return: True if the frame was a SYNC.
+        """
+        if message.id != self.cob_id:
+            return False
+        timestamp_ns = getattr(message, "timestamp_ns", None)
+        self.record_sync(time.monotonic_ns() if timestamp_ns is None else timestamp_ns,
+                         message.data[0] if message.data else None)
+        return True
+
+    def record_sync(self, timestamp_ns, counter=None):
+        """Record a SYNC sent or received at timestamp_ns (time.monotonic_ns())."""
+        if self.last_sync_ns is not None:
+            interval = timestamp_ns - self.last_sync_ns
+            self.intervals.add(interval)
+            if self.period_ns is not None:
+                self.jitter.add(interval - self.period_ns)
+        if counter is not None and self.last_counter is not None and counter != self.last_counter + 1 and counter != 1:
+            self.missed_syncs += 1
+        self.last_counter = counter
+        self.last_sync_ns = timestamp_ns
+
+    def pdo_received(self, message):
+        """Record the latency of a synchronous PDO frame from the last SYNC."""
+        timestamp_ns = getattr(message, "timestamp_ns", None)
+        self.record_pdo(message.id, time.monotonic_ns() if timestamp_ns is None else timestamp_ns)
+
+    def record_pdo(self, cob_id, timestamp_ns):
+        if self.last_sync_ns is None:
+            return
+        latency = timestamp_ns - self.last_sync_ns
+        self.latency.add(latency)
+        stats = self.pdo_latency.get(cob_id)
+        if stats is None:
+            stats = self.pdo_latency[cob_id] = CANopenTimingStats(self.window)
+        stats.add(latency)
+        if self.sync_window_ns is not None and latency > self.sync_window_ns:
+            self.late_pdos += 1
+
+    def watch(self, rpdo):
+        """Record the latency of every frame applied by a CANopenReceivePDO, keeping its on_receive callback."""
+        rpdo.node.timestamps = True
+        previous = rpdo.on_receive
+
+        def on_receive(received):
+            timestamp_ns = received.timestamp_ns
+            self.record_pdo(received.cob_id, time.monotonic_ns() if timestamp_ns is None else timestamp_ns)
+            if previous is not None:
+                previous(received)
+
+        rpdo.on_receive = on_receive
+
+    @property
+    def period_jitter(self):
+        """Largest deviation in ns of a SYNC interval from the period, or from the mean interval without period."""
+        if self.intervals.count == 0:
+            return None
+        nominal = self.period_ns if self.period_ns is not None else self.intervals.mean
+        return max(self.intervals.max - nominal, nominal - self.intervals.min)
+
+    def report(self):
+        """Return the analysis as a dict of summaries, in ns."""
+        return {
+            "sync_interval": self.intervals.summary(),
+            "sync_jitter": self.jitter.summary() if self.period_ns is not None else None,
+            "period_jitter": self.period_jitter,
+            "missed_syncs": self.missed_syncs,
+            "pdo_latency": self.latency.summary(),
+            "pdo_latency_by_cob_id": {cob_id: stats.summary() for cob_id, stats in self.pdo_latency.items()},
+            "late_pdos": self.late_pdos,
+        }
+
+
+class CANopenTimeProducer:
+    """TIME producer (0x100) distributing the network time as TIME_OF_DAY."""
+
+    def __init__(self, node, cob_id=CANopenMessage.COB_ID_TIME):
+        self.node = node
+        self.cob_id = cob_id
+
+    def send(self, unix_time=None):
+        """
+        Send the time.
+
+        :param unix_time: Seconds since 1970-01-01 UTC, time.time() if None.
+        """
+        data = encode_time_of_day(time.time() if unix_time is None else unix_time)
+        return self.node.send(CANopenMessage(self.cob_id, data))
+
+
+class CANopenTimeConsumer:
+    """
+    TIME consumer keeping the network time.
+
+    The received time is related to the receive timestamp of its frame, so time() returns
+    the network time without the delay between reception and processing. Register it with
+    node.add_rpdo(), or set master.timestamps when it is a master handler.
+    """
+
+    # Makes CANopenNode.add_rpdo() turn on the node's timestamps
+    needs_timestamps = True
+
+    def __init__(self, cob_id=CANopenMessage.COB_ID_TIME, window=1024):
+        self.cob_id = cob_id
+        # Network time in ns minus time.monotonic_ns(), None until the first TIME frame
+        self.offset_ns = None
+        # Change of the offset between consecutive TIME frames, i.e. drift of the local clock plus jitter
+        self.offset_changes = CANopenTimingStats(window)
+
+    def process(self, message):
+        """
+        Handle a received frame.
+
+        :return: True if the frame was a TIME frame.
+        """
+        if message.id != self.cob_id or len(message.data) < 6:
+            return False
+        timestamp_ns = getattr(message, "timestamp_ns", None)
+        timestamp_ns = time.monotonic_ns() if timestamp_ns is None else timestamp_ns
+        offset_ns = int(decode_time_of_day(message.data) * 1e9) - timestamp_ns
+        if self.offset_ns is not None:
+            self.offset_changes.add(offset_ns - self.offset_ns)
+        self.offset_ns = offset_ns
+        return True
+
+    def time(self):
+        """Return the network time in seconds since 1970-01-01 UTC, None before the first TIME frame."""
+        if self.offset_ns is None:
+            return None
+        return (time.monotonic_ns() + self.offset_ns) / 1e9
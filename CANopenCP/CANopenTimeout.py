@@ -0,0 +1,97 @@
+import time
+
+
+class CANopenRTTEstimator:
+    """
+    Round-trip time estimator for one remote node, as used for TCP retransmission timers (RFC 6298).
+
+    The timeout is the smoothed round-trip time plus four times its variation, so it
+    follows the node's actual response time instead of a fixed worst case.
+    """
+
+    ALPHA = 0.125  # Gain of the smoothed RTT
+    BETA = 0.25  # Gain of the RTT variation
+    K = 4
+
+    def __init__(self, initial_timeout=0.5, min_timeout=0.01, max_timeout=1.0):
+        """
+        :param initial_timeout: Timeout in seconds before the first round trip was measured.
+        :param min_timeout: Lower bound of the timeout in seconds.
+        :param max_timeout: Upper bound of the timeout in seconds, also capping the backoff.
+        """
+        self.initial_timeout = initial_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.srtt = None
+        self.rttvar = None
+        self.samples = 0
+
+    def sample(self, rtt):
+        """Add a measured round-trip time in seconds."""
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.samples += 1
+
+    @property
+    def rto(self):
+        """Current retransmission timeout in seconds."""
+        if self.srtt is None:
+            return self.initial_timeout
+        return min(self.max_timeout, max(self.min_timeout, self.srtt + self.K * self.rttvar))
+
+    def timeout(self, attempt=0):
+        """Timeout of the given retry attempt, doubling each time and capped at max_timeout."""
+        return min(self.max_timeout, self.rto * (2 ** attempt))
+
+
+class CANopenCircuitBreaker:
+    """
+    Stops requests to a node that keeps failing, so they fail fast instead of blocking the master.
+
+    A probe let through after reset_timeout that gets neither a success nor a failure recorded
+    within another reset_timeout opens the breaker again, so it can't stay half open.
+    """
+
+    STATE_CLOSED = 0  # Requests go through
+    STATE_OPEN = 1  # Requests fail immediately
+    STATE_HALF_OPEN = 2  # One probe request is let through
+
+    def __init__(self, failure_threshold=3, reset_timeout=5.0):
+        """
+        :param failure_threshold: Consecutive failed requests that open the breaker.
+        :param reset_timeout: Seconds the breaker stays open before a probe request is allowed.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.STATE_CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probe_at = None
+
+    def allow(self, now=None):
+        """Return True if a request may be sent."""
+        if self.state == self.STATE_CLOSED:
+            return True
+        now = time.monotonic() if now is None else now
+        if self.state == self.STATE_HALF_OPEN and now - self.probe_at >= self.reset_timeout:
+            self.state = self.STATE_OPEN
+            self.opened_at = now
+        elif self.state == self.STATE_OPEN and now - self.opened_at >= self.reset_timeout:
+            self.state = self.STATE_HALF_OPEN
+            self.probe_at = now
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.state = self.STATE_CLOSED
+
+    def record_failure(self, now=None):
+        self.failures += 1
+        if self.state == self.STATE_HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.STATE_OPEN
+            self.opened_at = time.monotonic() if now is None else now
@@ -0,0 +1,507 @@
+import struct
+import time
+
+from .CANopenDCF import CANopenDCF
+from .CANopenDomain import CANopenDomain
+from .CANopenMessage import CANopenMessage
+from .CANopenSDO import CANopenSDO, to_domain
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class CANopenUSDO(CANopenMessage):
+    """
+    Universal SDO (CiA 1301) frame, sent as a CAN FD frame of up to 64 bytes.
+
+    USDO uses the COB-IDs of the default SDO; being CAN FD frames tells its requests apart
+    from those of the classic SDO. Initiate, response and abort frames start with an 8 byte
+    header: command, session ID, node ID of the server, data type, index, subindex and the
+    size of an expedited value or a window size. An expedited transfer carries up to 56 bytes
+    in one frame. Segments have a 4 byte header (command, session ID, sequence number, data
+    length) and carry up to 60 bytes; the receiving side acknowledges every window of segments
+    with the last sequence number it received in order, and the sender continues after it.
+    """
+
+    # Default COB-IDs, the same as those of the default SDO
+    COB_ID_USDO_TX = 0x580
+    COB_ID_USDO_RX = 0x600
+
+    # Commands; those of the server have CS_RESPONSE set
+    CS_DOWNLOAD_EXPEDITED = 0x01
+    CS_DOWNLOAD_INITIATE = 0x02
+    CS_DOWNLOAD_SEGMENT = 0x03
+    CS_UPLOAD_INITIATE = 0x04
+    CS_UPLOAD_EXPEDITED = 0x05
+    CS_UPLOAD_SEGMENT = 0x06
+    CS_SEGMENT_ACK = 0x07
+    CS_ABORT = 0x7F
+    CS_LAST_SEGMENT = 0x40
+    CS_RESPONSE = 0x80
+
+    # Command, session ID, server node ID, data type, index, subindex, size or window
+    HEADER = "<BBBBHBB"
+    HEADER_SIZE = 8
+    # Command, session ID, sequence number, data length
+    SEGMENT_HEADER = "<BBBB"
+    SEGMENT_HEADER_SIZE = 4
+    EXPEDITED_SIZE = 56
+    SEGMENT_SIZE = 60
+    MAX_WINDOW = 127
+    # Size of an initiate frame for a value of unknown size
+    SIZE_UNKNOWN = 0xFFFFFFFF
+
+    DATA_TYPE_DOMAIN = 0x0F
+
+    _last_session = 0
+
+    def __init__(self, cob_id, data=bytes()):
+        super().__init__(cob_id, data, fd=True)
+
+    @classmethod
+    def new_session(cls):
+        """Return the next session ID (1-255), which tells the frames of a transfer from those of earlier ones."""
+        cls._last_session = cls._last_session % 255 + 1
+        return cls._last_session
+
+    @classmethod
+    def header(cls, command, session, node_id, index, subindex, size=0, data_type=0):
+        return struct.pack(cls.HEADER, command, session, node_id, data_type, index, subindex, size)
+
+    @classmethod
+    def abort_frame(cls, command, session, node_id, index, subindex, abort_code):
+        return cls.header(command, session, node_id, index, subindex) + struct.pack("<I", abort_code)
+
+
+class _CANopenUSDOSender:
+    """Sending side of a segmented USDO transfer, shared by client downloads and server uploads."""
+
+    def _init_sender(self):
+        self.offset = 0  # Bytes acknowledged by the receiver
+        self.window = 1  # Segments the receiver accepts before it acknowledges
+        self._sent_last = False
+        self._sent_count = 0  # Segments sent in the current window
+        self._last_count = 0  # Data bytes in the last segment
+        self._segment = bytearray(CANopenUSDO.SEGMENT_SIZE)
+
+    def _send_window(self, command):
+        """Send up to window segments starting at the last acknowledged offset."""
+        offset = self.offset
+        segment = self._segment
+        self._sent_last = False
+        self._sent_count = 0
+        for seqno in range(1, self.window + 1):
+            count = self.domain.readinto(offset, segment)
+            self._sent_count = seqno
+            offset += count
+            flags = 0
+            if count < CANopenUSDO.SEGMENT_SIZE or self.domain.at_end(offset):
+                flags = CANopenUSDO.CS_LAST_SEGMENT
+                self._sent_last = True
+                self._last_count = count
+            self._send_frame(struct.pack(CANopenUSDO.SEGMENT_HEADER, command | flags, self.session, seqno, count)
+                             + bytes(memoryview(segment)[:count]))
+            if self._sent_last:
+                break
+
+    def _acknowledge(self, data):
+        """
+        Advance past the segments confirmed by an acknowledge frame.
+
+        :return: True if all data was acknowledged.
+        """
+        acked = min(data[2], self._sent_count)
+        all_acked = self._sent_last and acked == self._sent_count
+        if all_acked:
+            self.offset += (acked - 1) * CANopenUSDO.SEGMENT_SIZE + self._last_count
+        else:
+            self.offset += acked * CANopenUSDO.SEGMENT_SIZE
+        self.domain.release(self.offset)
+        self.window = max(1, min(data[3], CANopenUSDO.MAX_WINDOW))
+        return all_acked
+
+
+class CANopenUSDODownload(_CANopenUSDOSender):
+    """Client side state machine of a USDO download to a remote node."""
+
+    STATE_INITIATE = 0
+    STATE_SEGMENT = 1
+    STATE_DONE = 2
+
+    def __init__(self, node_id, index, subindex, data, callback=None, data_type=CANopenUSDO.DATA_TYPE_DOMAIN):
+        """
+        :param node_id: The node ID of the remote USDO server.
+        :param index: Object dictionary index.
+        :param subindex: Object dictionary subindex.
+        :param data: The value to download: bytes, a CANopenDomain or a binary file object.
+            Domains and files are streamed one segment at a time.
+        :param callback: Called with the transfer once it is done.
+        :param data_type: CiA 301 data type index of the value.
+        """
+        self.node_id = node_id
+        self.index = index
+        self.subindex = subindex
+        self.domain = to_domain(data)
+        self.size = self.domain.size  # None for streams of unknown size
+        self.data_type = data_type
+        self.callback = callback
+        self.on_progress = None  # Optional callable(transfer) run on every acknowledged window
+        self.session = CANopenUSDO.new_session()
+        self.state = self.STATE_INITIATE
+        self.abort_code = None
+        self.done = False
+        self.start_time = None
+        self.last_activity = None
+        self._send = None
+        self._init_sender()
+
+    @property
+    def throughput(self):
+        """Acknowledged bytes per second since the transfer started."""
+        elapsed = time.monotonic() - self.start_time if self.start_time is not None else 0
+        return self.offset / elapsed if elapsed > 0 else 0.0
+
+    def start(self, send):
+        """
+        Send the initiate request.
+
+        :param send: Callable used to put a CANopenMessage on the bus.
+        """
+        self._send = send
+        self.start_time = self.last_activity = time.monotonic()
+        self._send_initiate()
+
+    def _send_initiate(self):
+        if self.size is not None and self.size <= CANopenUSDO.EXPEDITED_SIZE:
+            count = self.domain.readinto(0, self._segment)
+            self._send_frame(CANopenUSDO.header(CANopenUSDO.CS_DOWNLOAD_EXPEDITED, self.session, self.node_id,
+                                                self.index, self.subindex, count, self.data_type)
+                             + bytes(memoryview(self._segment)[:count]))
+        else:
+            size = CANopenUSDO.SIZE_UNKNOWN if self.size is None else self.size
+            self._send_frame(CANopenUSDO.header(CANopenUSDO.CS_DOWNLOAD_INITIATE, self.session, self.node_id,
+                                                self.index, self.subindex, 0, self.data_type)
+                             + struct.pack("<I", size))
+
+    def retransmit(self):
+        """Repeat the last request after an interruption, continuing from the last acknowledged segment."""
+        self.last_activity = time.monotonic()
+        if self.state == self.STATE_INITIATE:
+            self._send_initiate()
+        elif self.state == self.STATE_SEGMENT:
+            self._send_window(CANopenUSDO.CS_DOWNLOAD_SEGMENT)
+
+    def process_response(self, data):
+        """Advance the transfer with a frame received from the server."""
+        if data[1] != self.session:
+            # A late response of an earlier transfer
+            return
+        self.last_activity = time.monotonic()
+        command = data[0]
+        if command == CANopenUSDO.CS_ABORT | CANopenUSDO.CS_RESPONSE:
+            abort_code, = struct.unpack_from("<I", data, CANopenUSDO.HEADER_SIZE)
+            self._finish(abort_code)
+        elif self.state == self.STATE_INITIATE and \
+                command == CANopenUSDO.CS_DOWNLOAD_EXPEDITED | CANopenUSDO.CS_RESPONSE:
+            self.offset = self.size
+            self._finish()
+        elif self.state == self.STATE_INITIATE and \
+                command == CANopenUSDO.CS_DOWNLOAD_INITIATE | CANopenUSDO.CS_RESPONSE:
+            self.window = max(1, min(data[7], CANopenUSDO.MAX_WINDOW))
+            self.state = self.STATE_SEGMENT
+            self._send_window(CANopenUSDO.CS_DOWNLOAD_SEGMENT)
+        elif self.state == self.STATE_SEGMENT and command == CANopenUSDO.CS_SEGMENT_ACK | CANopenUSDO.CS_RESPONSE:
+            all_acked = self._acknowledge(data)
+            if self.on_progress:
+                self.on_progress(self)
+            if all_acked:
+                self._finish()
+            else:
+                self._send_window(CANopenUSDO.CS_DOWNLOAD_SEGMENT)
+        else:
+            self.abort(CANopenSDO.ABORT_GENERAL)
+
+    def abort(self, abort_code):
+        """Abort the transfer and notify the server."""
+        if not self.done:
+            self._send_frame(CANopenUSDO.abort_frame(CANopenUSDO.CS_ABORT, self.session, self.node_id,
+                                                     self.index, self.subindex, abort_code))
+            self._finish(abort_code)
+
+    def _send_frame(self, data):
+        self._send(CANopenUSDO(CANopenUSDO.COB_ID_USDO_RX + self.node_id, data))
+
+    def _finish(self, abort_code=None):
+        self.abort_code = abort_code
+        self.state = self.STATE_DONE
+        self.done = True
+        if self.callback:
+            self.callback(self)
+
+
+class CANopenUSDOUpload:
+    """Client side state machine of a USDO upload streamed into a sink."""
+
+    STATE_INITIATE = 0
+    STATE_SEGMENT = 1
+    STATE_DONE = 2
+
+    def __init__(self, node_id, index, subindex, sink=None, callback=None, window=CANopenUSDO.MAX_WINDOW):
+        """
+        :param node_id: The node ID of the remote USDO server.
+        :param index: Object dictionary index.
+        :param subindex: Object dictionary subindex.
+        :param sink: CANopenDomain or binary file object receiving the value, in memory if None.
+        :param callback: Called with the transfer once it is done.
+        :param window: Segments the server may send before it waits for an acknowledge.
+        """
+        self.node_id = node_id
+        self.index = index
+        self.subindex = subindex
+        self.domain = to_domain(sink) if sink is not None else CANopenDomain()
+        self.callback = callback
+        self.window = max(1, min(window, CANopenUSDO.MAX_WINDOW))
+        self.session = CANopenUSDO.new_session()
+        self.state = self.STATE_INITIATE
+        self.size = None  # Size announced by the server, if any
+        self.offset = 0
+        self.abort_code = None
+        self.done = False
+        self.last_activity = None
+        self._seqno = 0  # Last segment of the current window received in order
+        self._send = None
+
+    def start(self, send):
+        self._send = send
+        self.last_activity = time.monotonic()
+        self.domain.truncate(0)
+        self._send_initiate()
+
+    def _send_initiate(self):
+        self._send_frame(CANopenUSDO.header(CANopenUSDO.CS_UPLOAD_INITIATE, self.session, self.node_id,
+                                            self.index, self.subindex, self.window))
+
+    def retransmit(self):
+        """Repeat the last request after an interruption; the server resends the unacknowledged segments."""
+        self.last_activity = time.monotonic()
+        if self.state == self.STATE_INITIATE:
+            self._send_initiate()
+        elif self.state == self.STATE_SEGMENT:
+            self._send_ack()
+
+    def process_response(self, data):
+        """Advance the transfer with a frame received from the server."""
+        if data[1] != self.session:
+            # A late response of an earlier transfer
+            return
+        self.last_activity = time.monotonic()
+        command = data[0]
+        if command == CANopenUSDO.CS_ABORT | CANopenUSDO.CS_RESPONSE:
+            abort_code, = struct.unpack_from("<I", data, CANopenUSDO.HEADER_SIZE)
+            self._finish(abort_code)
+        elif self.state == self.STATE_INITIATE and command == CANopenUSDO.CS_UPLOAD_EXPEDITED | CANopenUSDO.CS_RESPONSE:
+            size = data[7]
+            self.domain.write(0, memoryview(data)[CANopenUSDO.HEADER_SIZE:CANopenUSDO.HEADER_SIZE + size])
+            self.size = self.offset = size
+            self._finish()
+        elif self.state == self.STATE_INITIATE and command == CANopenUSDO.CS_UPLOAD_INITIATE | CANopenUSDO.CS_RESPONSE:
+            size, = struct.unpack_from("<I", data, CANopenUSDO.HEADER_SIZE)
+            self.size = None if size == CANopenUSDO.SIZE_UNKNOWN else size
+            self.state = self.STATE_SEGMENT
+        elif self.state == self.STATE_SEGMENT and \
+                command & ~CANopenUSDO.CS_LAST_SEGMENT == CANopenUSDO.CS_UPLOAD_SEGMENT | CANopenUSDO.CS_RESPONSE:
+            seqno = data[2]
+            last = command & CANopenUSDO.CS_LAST_SEGMENT
+            in_order = seqno == self._seqno + 1
+            if in_order:
+                count = data[3]
+                start = CANopenUSDO.SEGMENT_HEADER_SIZE
+                self.domain.write(self.offset, memoryview(data)[start:start + count])
+                self.offset += count
+                self._seqno = seqno
+            if last or seqno >= self.window:
+                # Acknowledge the last segment received in order; the server repeats the rest
+                self._send_ack()
+                if last and in_order:
+                    self._finish()
+        else:
+            self.abort(CANopenSDO.ABORT_GENERAL)
+
+    def abort(self, abort_code):
+        if not self.done:
+            self._send_frame(CANopenUSDO.abort_frame(CANopenUSDO.CS_ABORT, self.session, self.node_id,
+                                                     self.index, self.subindex, abort_code))
+            self._finish(abort_code)
+
+    def _send_ack(self):
+        self._send_frame(struct.pack(CANopenUSDO.SEGMENT_HEADER, CANopenUSDO.CS_SEGMENT_ACK, self.session,
+                                     self._seqno, self.window))
+        self._seqno = 0
+
+    def _send_frame(self, data):
+        self._send(CANopenUSDO(CANopenUSDO.COB_ID_USDO_RX + self.node_id, data))
+
+    def _finish(self, abort_code=None):
+        self.abort_code = abort_code
+        self.state = self.STATE_DONE
+        self.done = True
+        if self.callback:
+            self.callback(self)
+
+
+class CANopenUSDOServer(_CANopenUSDOSender):
+    """
+    USDO server of a CANopenSlaveNode, answering requests from its object dictionary.
+
+    Attach it with node.usdo = CANopenUSDOServer(node); the node then hands it every CAN FD
+    frame received on its SDO request COB-ID. One transfer runs at a time, a new initiate
+    request replaces it.
+    """
+
+    def __init__(self, node, window=CANopenUSDO.MAX_WINDOW):
+        """
+        :param node: The CANopenSlaveNode whose object dictionary is served.
+        :param window: Segments a client may send before it waits for an acknowledge.
+        """
+        self.node = node
+        self.receive_window = max(1, min(window, CANopenUSDO.MAX_WINDOW))
+        # Transfer in progress, session is None when idle
+        self.session = None
+        self.upload = False
+        self.index = 0
+        self.subindex = 0
+        self.domain = None
+        self._seqno = 0  # Last segment of the current window received in order
+        self._init_sender()
+
+    def process(self, message):
+        """
+        Handle a received frame.
+
+        :return: True if the frame was a USDO request to this node.
+        """
+        if not getattr(message, "fd", False) or message.id != CANopenUSDO.COB_ID_USDO_RX + self.node.node_id:
+            return False
+        data = message.data
+        if len(data) < CANopenUSDO.SEGMENT_HEADER_SIZE:
+            return True
+        command = data[0]
+        try:
+            if command == CANopenUSDO.CS_ABORT:
+                if data[1] == self.session:
+                    self._drop_download()
+                    self.session = None
+            elif command in (CANopenUSDO.CS_DOWNLOAD_EXPEDITED, CANopenUSDO.CS_DOWNLOAD_INITIATE,
+                             CANopenUSDO.CS_UPLOAD_INITIATE):
+                self._initiate(data)
+            elif data[1] != self.session:
+                # A late frame of a finished or aborted transfer
+                pass
+            elif not self.upload and command & ~CANopenUSDO.CS_LAST_SEGMENT == CANopenUSDO.CS_DOWNLOAD_SEGMENT:
+                self._receive_segment(data)
+            elif self.upload and command == CANopenUSDO.CS_SEGMENT_ACK:
+                if self._acknowledge(data):
+                    self.session = None
+                else:
+                    self._send_window(CANopenUSDO.CS_UPLOAD_SEGMENT | CANopenUSDO.CS_RESPONSE)
+            else:
+                self._abort(data[1], self.index, self.subindex, CANopenSDO.ABORT_GENERAL)
+        except Exception as e:
+            logger.warning(f"USDO request to node {self.node.node_id} failed: {e}")
+            self._abort(data[1], self.index, self.subindex, CANopenSDO.ABORT_GENERAL)
+        return True
+
+    def _initiate(self, data):
+        command, session, _, _, index, subindex, size = struct.unpack_from(CANopenUSDO.HEADER, data)
+        if self.session is not None:
+            # A new transfer replaces an unfinished one
+            self._drop_download()
+        self.session = None
+        self.index = index
+        self.subindex = subindex
+        if command == CANopenUSDO.CS_UPLOAD_INITIATE:
+            self._start_upload(session, index, subindex, size)
+        elif command == CANopenUSDO.CS_DOWNLOAD_EXPEDITED:
+            value = bytes(data[CANopenUSDO.HEADER_SIZE:CANopenUSDO.HEADER_SIZE + size])
+            abort_code = self._write(index, subindex, value)
+            if abort_code is not None:
+                self._abort(session, index, subindex, abort_code)
+            else:
+                self._send_frame(CANopenUSDO.header(CANopenUSDO.CS_DOWNLOAD_EXPEDITED | CANopenUSDO.CS_RESPONSE,
+                                                    session, self.node.node_id, index, subindex))
+        else:
+            self.session = session
+            self.upload = False
+            self.domain = self.node._download_target(index, subindex)
+            self.offset = 0
+            self._seqno = 0
+            self._send_frame(CANopenUSDO.header(CANopenUSDO.CS_DOWNLOAD_INITIATE | CANopenUSDO.CS_RESPONSE,
+                                                session, self.node.node_id, index, subindex, self.receive_window))
+
+    def _write(self, index, subindex, value):
+        """Write an expedited download to the object dictionary; return the abort code if it fails."""
+        node = self.node
+        storage = node.storage
+        if storage is not None and index in (storage.INDEX_STORE, storage.INDEX_RESTORE):
+            return storage.command(index, subindex, value)
+        if index == CANopenDCF.CONCISE_DCF_INDEX:
+            node.apply_concise_dcf(value)
+        node.write_data(index, subindex, value)
+        return None
+
+    def _receive_segment(self, data):
+        seqno = data[2]
+        last = data[0] & CANopenUSDO.CS_LAST_SEGMENT
+        in_order = seqno == self._seqno + 1
+        if in_order:
+            count = data[3]
+            start = CANopenUSDO.SEGMENT_HEADER_SIZE
+            self.domain.write(self.offset, memoryview(data)[start:start + count])
+            self.offset += count
+            self._seqno = seqno
+        if last or seqno >= self.receive_window:
+            # Acknowledge the last segment received in order; the client repeats the rest
+            acked = self._seqno
+            self._seqno = 0
+            if last and in_order:
+                self.session = None
+                self.node._download_complete(self.index, self.subindex, self.domain)
+            self._send_frame(struct.pack(CANopenUSDO.SEGMENT_HEADER,
+                                         CANopenUSDO.CS_SEGMENT_ACK | CANopenUSDO.CS_RESPONSE,
+                                         data[1], acked, self.receive_window))
+
+    def _start_upload(self, session, index, subindex, window):
+        value = self.node.data_dict.get((index, subindex))
+        if value is None:
+            self._abort(session, index, subindex, CANopenSDO.ABORT_NOT_EXIST)
+            return
+        if not isinstance(value, CANopenDomain) and len(value) <= CANopenUSDO.EXPEDITED_SIZE:
+            self._send_frame(CANopenUSDO.header(CANopenUSDO.CS_UPLOAD_EXPEDITED | CANopenUSDO.CS_RESPONSE,
+                                                session, self.node.node_id, index, subindex, len(value))
+                             + bytes(value))
+            return
+        self.session = session
+        self.upload = True
+        self.domain = to_domain(value)
+        self.offset = 0
+        self.window = max(1, min(window, CANopenUSDO.MAX_WINDOW))
+        size = self.domain.size
+        self._send_frame(CANopenUSDO.header(CANopenUSDO.CS_UPLOAD_INITIATE | CANopenUSDO.CS_RESPONSE,
+                                            session, self.node.node_id, index, subindex)
+                         + struct.pack("<I", CANopenUSDO.SIZE_UNKNOWN if size is None else size))
+        self._send_window(CANopenUSDO.CS_UPLOAD_SEGMENT | CANopenUSDO.CS_RESPONSE)
+
+    def _drop_download(self):
+        """Drop the partly received value of a download in progress."""
+        if self.domain is not None and not self.upload:
+            self.domain.discard()
+
+    def _abort(self, session, index, subindex, abort_code):
+        self._drop_download()
+        self.session = None
+        self._send_frame(CANopenUSDO.abort_frame(CANopenUSDO.CS_ABORT | CANopenUSDO.CS_RESPONSE, session,
+                                                 self.node.node_id, index, subindex, abort_code))
+
+    def _send_frame(self, data):
+        self.node.send(CANopenUSDO(CANopenUSDO.COB_ID_USDO_TX + self.node.node_id, data))
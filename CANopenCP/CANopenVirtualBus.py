@@ -0,0 +1,95 @@
+import time
+from collections import deque
+
+from adafruit_mcp2515 import Message
+
+from .CANopenMessage import CANopenMessage
+
+
+class CANopenVirtualBus:
+    """
+    A CAN bus in software, connecting any number of interfaces in one process.
+
+    Every frame sent by one interface is delivered to all others, so masters, slaves and
+    gateways can be run and tested without a CAN controller.
+
+    A CAN FD bus also carries frames whose fd attribute is set, with up to 64 bytes; like a
+    controller does, it pads their payload with zeros up to the length of the next DLC.
+    """
+
+    def __init__(self, fd=False):
+        """
+        :param fd: Carry CAN FD frames besides classic frames.
+        """
+        self.fd = fd
+        self.interfaces = []
+        # Number of frames sent on the bus
+        self.frame_count = 0
+
+    def interface(self, handler=None, rx_size=None):
+        """
+        Create an interface attached to the bus.
+
+        :param handler: Called with every received message instead of queueing it.
+        :param rx_size: Receive queue length, frames arriving at a full queue are lost. Unbounded if None.
+        :return: A CANopenVirtualInterface usable wherever an MCP2515 is expected.
+        """
+        interface = CANopenVirtualInterface(self, handler, rx_size)
+        self.interfaces.append(interface)
+        return interface
+
+    def detach(self, interface):
+        self.interfaces.remove(interface)
+
+    def transmit(self, sender, message):
+        fd = getattr(message, "fd", False)
+        if fd and not self.fd:
+            raise Exception("CAN FD frame sent on a classic CAN bus.")
+        self.frame_count += 1
+        data = bytes(message.data)
+        if fd:
+            data += bytes(CANopenMessage.fd_padded_length(len(data)) - len(data))
+        for interface in self.interfaces:
+            if interface is not sender:
+                if fd:
+                    interface.deliver(CANopenMessage(message.id, data, message.extended, fd=True))
+                else:
+                    interface.deliver(Message(message.id, data, extended=message.extended))
+
+
+class CANopenVirtualInterface:
+    """
+    Interface to a CANopenVirtualBus with the send/read_message API of the MCP2515 driver.
+
+    Like a controller with hardware timestamps, it stamps every frame in timestamp_ns when it arrives.
+    """
+
+    hardware_timestamps = True
+
+    def __init__(self, bus, handler=None, rx_size=None):
+        self.bus = bus
+        self.handler = handler
+        self.rx_size = rx_size
+        self._queue = deque()
+        # Frames lost because the receive queue was full
+        self.overruns = 0
+
+    @property
+    def unread_message_count(self):
+        return len(self._queue)
+
+    def send(self, message):
+        self.bus.transmit(self, message)
+        return True
+
+    def deliver(self, message):
+        message.timestamp_ns = time.monotonic_ns()
+        if self.handler is not None:
+            self.handler(message)
+        elif self.rx_size is not None and len(self._queue) >= self.rx_size:
+            self.overruns += 1
+        else:
+            self._queue.append(message)
+
+    def read_message(self):
+        return self._queue.popleft() if self._queue else None
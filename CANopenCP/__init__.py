@@ -1,6 +1,25 @@
-from CANopenCP.CANopenPDO import CANopenTPDO, CANopenRPDO
-from CANopenCP.CANopenSDO import CANopenSDO, CANopenClientSDO, CANopenServerSDO
+from CANopenCP.CANopenPDO import CANopenTPDO, CANopenRPDO, CANopenEventTPDO, CANopenReceivePDO, CANopenBusLoad, \
+    CANopenMPDO, CANopenMPDOProducer, CANopenMPDOConsumer
+from CANopenCP.CANopenSDO import CANopenSDO, CANopenClientSDO, CANopenServerSDO, CANopenSDORequest, CANopenBlockDownload, \
+    CANopenSegmentedUpload
+from CANopenCP.CANopenUSDO import CANopenUSDO, CANopenUSDODownload, CANopenUSDOUpload, CANopenUSDOServer
+from CANopenCP.CANopenDomain import CANopenDomain, CANopenStreamDomain
+from CANopenCP.CANopenCache import CANopenObjectCache
+from CANopenCP.CANopenDCF import CANopenDCF
+from CANopenCP.CANopenLSS import CANopenLSS, CANopenLSSMaster, CANopenLSSSlave
+from CANopenCP.CANopenEMCY import CANopenEMCY, CANopenEMCYProducer, CANopenEMCYConsumer
+from CANopenCP.CANopenProgram import CANopenProgramDownload, CANopenProgramUpdater
+from CANopenCP.CANopenTimeout import CANopenRTTEstimator, CANopenCircuitBreaker
 from CANopenCP.CANopenNode import CANopenMasterNode
+from CANopenCP.CANopenSync import CANopenTimingStats, CANopenSyncProducer, CANopenSyncConsumer, CANopenTimeProducer, \
+    CANopenTimeConsumer
+from CANopenCP.CANopenNetwork import CANopenNetwork
+from CANopenCP.CANopenBoot import CANopenBootSlave, CANopenBootMaster
+from CANopenCP.CANopenNotifier import CANopenChangeNotifier
+from CANopenCP.CANopenObjectDictionary import CANopenObjectDictionary
+from CANopenCP.CANopenSlaveFarm import CANopenSlaveFarm
+from CANopenCP.CANopenStorage import CANopenParameterStore
+from CANopenCP.CANopenVirtualBus import CANopenVirtualBus, CANopenVirtualInterface
 
 __all__ = [
     'CANopenMessage',
@@ -9,8 +28,49 @@ __all__ = [
     'CANopenPDO',
     'CANopenTPDO',
     'CANopenRPDO',
+    'CANopenEventTPDO',
+    'CANopenReceivePDO',
+    'CANopenBusLoad',
+    'CANopenMPDO',
+    'CANopenMPDOProducer',
+    'CANopenMPDOConsumer',
     'CANopenSDO',
     'CANopenClientSDO',
     'CANopenServerSDO',
+    'CANopenSDORequest',
+    'CANopenBlockDownload',
+    'CANopenSegmentedUpload',
+    'CANopenUSDO',
+    'CANopenUSDODownload',
+    'CANopenUSDOUpload',
+    'CANopenUSDOServer',
+    'CANopenDomain',
+    'CANopenStreamDomain',
+    'CANopenObjectCache',
+    'CANopenDCF',
+    'CANopenLSS',
+    'CANopenLSSMaster',
+    'CANopenLSSSlave',
+    'CANopenEMCY',
+    'CANopenEMCYProducer',
+    'CANopenEMCYConsumer',
+    'CANopenProgramDownload',
+    'CANopenProgramUpdater',
+    'CANopenRTTEstimator',
+    'CANopenCircuitBreaker',
+    'CANopenNetwork',
+    'CANopenBootSlave',
+    'CANopenBootMaster',
+    'CANopenTimingStats',
+    'CANopenSyncProducer',
+    'CANopenSyncConsumer',
+    'CANopenTimeProducer',
+    'CANopenTimeConsumer',
+    'CANopenChangeNotifier',
+    'CANopenObjectDictionary',
+    'CANopenSlaveFarm',
+    'CANopenParameterStore',
+    'CANopenVirtualBus',
+    'CANopenVirtualInterface',
     'States'
 ]
@@ -0,0 +1,85 @@
+"""
+CANopen protocol analyzer.
+
+Decodes the CANopen traffic of a live SocketCAN interface or of a candump trace and prints
+every frame, and a summary of per-node frame rates, NMT states, EMCY, SDO abort and protocol
+error counts and SDO latency percentiles every interval and at the end.
+
+    python examples/canopen_analyzer.py -i can0 [--summary-only] [--interval 5]
+    python examples/canopen_analyzer.py candump.log [--node 5 --node 6]
+
+Use --summary-only on a busy bus: printing every frame is slower than analysing it.
+"""
+import argparse
+import os
+import sys
+import time
+
+# Make the package importable when run from a checkout
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [root, os.path.join(root, "CANopenCP")]
+
+from CANopenCP.CANopenAnalyzer import CANopenAnalyzer, format_frame, read_candump, read_socketcan
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode and summarise CANopen traffic.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("trace", nargs="?", help="candump trace file, - for standard input")
+    source.add_argument("-i", "--interface", help="SocketCAN interface to read live, e.g. can0")
+    parser.add_argument("--summary-only", action="store_true", help="don't print the decoded frames")
+    parser.add_argument("--node", type=int, action="append", help="only print the frames of these nodes")
+    parser.add_argument("--interval", type=float, default=0.0,
+                        help="seconds between summaries, in trace time for files; 0 for a summary at the end only")
+    parser.add_argument("--window", type=int, default=10, help="seconds of the rolling rates and bus load")
+    parser.add_argument("--bitrate", type=int, default=1000000, help="bus bit rate for the bus load")
+    args = parser.parse_args()
+
+    out = sys.stdout
+    on_decode = None
+    if not args.summary_only:
+        nodes = set(args.node or ())
+
+        def on_decode(timestamp_ns, cob_id, data, text):
+            if nodes and (cob_id is None or cob_id & 0x7F not in nodes):
+                return
+            out.write(format_frame(timestamp_ns, cob_id, data, text) + "\n")
+
+    analyzer = CANopenAnalyzer(window=args.window, bitrate=args.bitrate, on_decode=on_decode)
+    if args.interface:
+        frames = read_socketcan(args.interface)
+    elif args.trace == "-":
+        frames = read_candump(sys.stdin)
+    else:
+        try:
+            frames = read_candump(open(args.trace))
+        except OSError as e:
+            sys.exit(f"Cannot read {args.trace}: {e}")
+
+    interval_ns = int(args.interval * 1e9)
+    next_summary_ns = None
+    process = analyzer.process
+    start = time.perf_counter()
+    try:
+        for cob_id, data, timestamp_ns in frames:
+            process(cob_id, data, timestamp_ns)
+            if interval_ns:
+                if next_summary_ns is None:
+                    next_summary_ns = timestamp_ns + interval_ns
+                elif timestamp_ns >= next_summary_ns:
+                    next_summary_ns += interval_ns * ((timestamp_ns - next_summary_ns) // interval_ns + 1)
+                    out.write(analyzer.format_summary() + "\n\n")
+                    out.flush()
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        sys.exit(f"Cannot read {args.interface or args.trace}: {e}")
+    elapsed = time.perf_counter() - start
+    out.write(analyzer.format_summary() + "\n")
+    if not args.interface and elapsed > 0:
+        sys.stderr.write(f"Analysed {analyzer.frames} frames in {elapsed:.2f} s "
+                         f"({analyzer.frames / elapsed:.0f} frames/s)\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Allocation and per-frame cost regression check of the hot paths.
+
+Runs every path for a number of frames against a scripted fake controller and reports
+nanoseconds, allocations and bytes per frame. Exits with status 1 if a path exceeds its
+budget, so an allocation put back into a hot loop is caught.
+
+    python examples/profile_hot_paths.py [frames]
+"""
+import os
+import struct
+import sys
+
+if hasattr(os, "path"):
+    # Make the package importable when run from a checkout
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path[:0] = [root, os.path.join(root, "CANopenCP")]
+
+from CANopenCP.CANopenMessage import CANopenMessage
+from CANopenCP.CANopenNode import CANopenMasterNode, CANopenSlaveNode
+from CANopenCP.CANopenPDO import CANopenEventTPDO, CANopenReceivePDO, CANopenTPDO
+from CANopenCP.CANopenProfiler import CANopenHotPathProfiler, CANopenScriptedController
+from CANopenCP.CANopenSDO import CANopenSDO
+
+NODE_ID = 2
+
+
+def slave_with_script(script):
+    controller = CANopenScriptedController(script)
+    slave = CANopenSlaveNode(NODE_ID, controller)
+    slave.data_dict.update({
+        (0x1000, 0): struct.pack("<I", 0x00020192),
+        (0x2000, 0): bytes(4),
+        (0x6000, 1): bytes(2),
+        (0x6000, 2): bytes(2),
+        (0x6001, 0): bytes(4),
+    })
+    return slave
+
+
+def main(frames):
+    profiler = CANopenHotPathProfiler(frames)
+
+    node = slave_with_script([])
+    tpdo = CANopenTPDO(NODE_ID, bytes(8))
+    profiler.add("CANopenNode.send (TPDO)", lambda: node.send(tpdo), max_allocs=0)
+
+    message = CANopenMessage(0x181, bytes(8))
+    # Only the argument tuple of the *values call, no new payload buffer
+    profiler.add("CANopenMessage.set_data", lambda: message.set_data("<HhI", 1, -2, 3), max_allocs=1, max_bytes=96)
+    # The unpacked tuple is the only allowed allocation
+    profiler.add("CANopenMessage.get_data", lambda: message.get_data("<HhI"), max_allocs=1, max_bytes=64)
+
+    upload = slave_with_script([(CANopenSDO.COB_ID_SDO_RX + NODE_ID,
+                                 struct.pack("<BHB4x", CANopenSDO.SDO_UPLOAD_INITIATE, 0x1000, 0))])
+    profiler.add("listen_and_respond (SDO expedited upload)", upload.listen_and_respond,
+                 max_allocs=1, max_bytes=128)
+
+    download = slave_with_script([(CANopenSDO.COB_ID_SDO_RX + NODE_ID,
+                                   struct.pack("<BHB4s", 0x23, 0x2000, 0, b"\x01\x02\x03\x04"))])
+    # The received value stored in the object dictionary is the only allowed allocation
+    profiler.add("listen_and_respond (SDO expedited download)", download.listen_and_respond,
+                 max_allocs=1, max_bytes=256)
+
+    rpdo_node = slave_with_script([(CANopenMessage.COB_ID_PDO1_RX + NODE_ID, struct.pack("<HhI", 1, -2, 3))])
+    rpdo_node.add_rpdo(CANopenReceivePDO(rpdo_node, [(0x6000, 1, "H"), (0x6000, 2, "h"), (0x6001, 0, "I")]))
+    profiler.add("listen_and_respond (RPDO receive)", rpdo_node.listen_and_respond, max_allocs=0)
+
+    event_node = slave_with_script([])
+    event_tpdo = event_node.add_event_tpdo(CANopenEventTPDO(
+        event_node, [(0x6000, 1, "H"), (0x6000, 2, "h"), (0x6001, 0, "I")], inhibit_time=0.0))
+    profiler.add("CANopenEventTPDO.process (unchanged)", event_tpdo.process, max_allocs=0)
+
+    master = CANopenMasterNode(1, CANopenScriptedController([(CANopenMessage.COB_ID_PDO1_TX + NODE_ID, bytes(8))]))
+    profiler.add("CANopenMasterNode.dispatch (TPDO)", lambda: master.dispatch(master.mcp.read_message()),
+                 max_allocs=0)
+
+    results = profiler.run()
+    print(profiler.report(results))
+    return 1 if any(result["violations"] for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000))